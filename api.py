@@ -1,23 +1,373 @@
-from flask import Flask, request, jsonify
-from jbot.main import create_chain
+import os
+import threading
+import time
+from contextlib import contextmanager
+from json import dumps
+from flask import Flask, Response, g, request, jsonify, stream_with_context
+from jbot import logfile
+from jbot.deadline import DeadlineExceeded, deadline, watch_disconnect
+from jbot.profiling import Profiler
 
-chain = create_chain()
 app = Flask(__name__)
 
+# The chain (langchain, database reflection, example index) is built in the
+# background so the server binds right away; /ready tells when it's done.
+_ready = threading.Event()
+_init_lock = threading.Lock()
+_start_lock = threading.Lock()
+_chain = None
+_router = None
+_warmer = None
+_watcher = None
+_log_lock = threading.Lock()
+_init_error = None
+_init_thread = None
+_sessions = None
+_sessions_lock = threading.Lock()
+startup = {}
+"""Seconds spent in each startup step."""
+# JBOT_PROFILE_RATE: fraction of the requests to profile, see /admin/profile
+profiler = Profiler(
+    rate=float(os.environ.get('JBOT_PROFILE_RATE', '0')),
+    interval=float(os.environ.get('JBOT_PROFILE_INTERVAL', '0.005')),
+)
+
+def init():
+    """Build the chain, once. Safe to call from any thread."""
+    global _chain, _router, _warmer, _watcher, _init_error
+    with _init_lock:
+        if _ready.is_set():
+            return
+        start = time.perf_counter()
+        try:
+            from jbot.main import create_chain, create_router, create_warmer, create_watcher
+            _chain = create_chain(startup)
+            _router = create_router(_chain)
+            _warmer = create_warmer(_chain)
+            if _warmer is not None:
+                _warmer.schedule()
+            _watcher = create_watcher(_chain)
+            if _watcher is not None:
+                _watcher.schedule()
+        except Exception as e:
+            _init_error = e
+            raise
+        finally:
+            startup['total'] = time.perf_counter() - start
+            _ready.set()
+
+def start_init():
+    global _init_thread
+    with _start_lock:
+        if _init_thread is None:
+            _init_thread = threading.Thread(target=init, name='jbot-init', daemon=True)
+            _init_thread.start()
+
+def get_sessions():
+    global _sessions
+    with _sessions_lock:
+        if _sessions is None:
+            from jbot.main import create_sessions
+            _sessions = create_sessions()
+        return _sessions
+
+def log_request(**entry):
+    """Append to JBOT_REQUEST_LOG, which `jbot.warm` mines, if set (it holds
+    the users' questions, so it is off by default), rotated past
+    JBOT_REQUEST_LOG_MAX_BYTES (see `jbot.logfile`)."""
+    path = os.environ.get('JBOT_REQUEST_LOG', 'off')
+    if path == 'off':
+        return
+    max_bytes = int(os.environ.get('JBOT_REQUEST_LOG_MAX_BYTES', str(logfile.DEFAULT_MAX_BYTES)))
+    line = dumps({'at': time.time(), **entry}, ensure_ascii=False) + '\n'
+    with _log_lock:
+        logfile.append(path, line, max_bytes)
+
+class NotReady(Exception):
+    pass
+
+def get_chain():
+    """The chain, waiting up to JBOT_INIT_WAIT seconds for startup to finish."""
+    start_init()
+    if not _ready.wait(float(os.environ.get('JBOT_INIT_WAIT', '30'))):
+        raise NotReady()
+    if _chain is None:
+        raise NotReady() from _init_error
+    return _chain
+
+def get_router():
+    get_chain()
+    return _router
+
+@app.errorhandler(NotReady)
+def not_ready(e):
+    return jsonify({'error': 'The bot is starting up, try again soon.'}), 503, {'Retry-After': '2'}
+
+@app.errorhandler(DeadlineExceeded)
+def deadline_exceeded(e):
+    return jsonify({'error': 'Demorei demais para responder, tente de novo.'}), 504
+
+@contextmanager
+def request_deadline(default=None):
+    """Deadline of the request, in seconds: the X-Timeout header, capped at
+    JBOT_MAX_REQUEST_TIMEOUT, or `default`, or JBOT_REQUEST_TIMEOUT. It is
+    cancelled if the client hangs up."""
+    seconds = default if default is not None else float(os.environ.get('JBOT_REQUEST_TIMEOUT', '90'))
+    header = request.headers.get('X-Timeout', type=float)
+    if header is not None and header > 0:
+        seconds = min(header, float(os.environ.get('JBOT_MAX_REQUEST_TIMEOUT', '300')))
+    with deadline(seconds) as d:
+        sock = request.environ.get('werkzeug.socket')
+        stop = watch_disconnect(sock, d) if sock is not None else lambda: None
+        try:
+            yield d
+        finally:
+            stop()
+
+@app.before_request
+def start_profile():
+    g.profile = profiler.start(f'{request.method} {request.path}')
+
+@app.teardown_request
+def stop_profile(e):
+    profiler.stop(g.pop('profile', None))
+
+def is_admin():
+    """With JBOT_ADMIN_TOKEN set, requests carrying it in X-Admin-Token;
+    otherwise requests from this machine."""
+    token = os.environ.get('JBOT_ADMIN_TOKEN')
+    if token:
+        return request.headers.get('X-Admin-Token') == token
+    return request.remote_addr in ('127.0.0.1', '::1')
+
+def is_bridge():
+    """With JBOT_BRIDGE_TOKEN set, requests carrying it in X-Bridge-Token;
+    otherwise admins (see `is_admin`)."""
+    token = os.environ.get('JBOT_BRIDGE_TOKEN')
+    if token:
+        return request.headers.get('X-Bridge-Token') == token
+    return is_admin()
+
+@app.route('/admin/profile', methods=['GET', 'POST'])
+def admin_profile():
+    """GET: the stacks sampled so far, collapsed (one `root;frame;... count`
+    line per stack, for flamegraph.pl or speedscope), or with `?format=json`
+    along with totals; `?reset=1` starts over. POST: profile a `rate`
+    fraction of the requests, for `seconds` if given. Counts are per worker
+    process."""
+    if not is_admin():
+        return jsonify({'error': 'Forbidden.'}), 403
+    if request.method == 'POST':
+        json = request.get_json()
+        try:
+            rate = float(json['rate'])
+            seconds = float(json['seconds']) if json.get('seconds') is not None else None
+        except (KeyError, TypeError, ValueError):
+            return jsonify({'error': '`rate` (and optionally `seconds`) must be numbers.'}), 400
+        profiler.set_rate(min(max(rate, 0.0), 1.0), seconds)
+        return jsonify(profiler.report())
+    stacks = profiler.collapsed()
+    body = profiler.report()
+    if request.args.get('reset'):
+        profiler.reset()
+    if request.args.get('format') == 'json':
+        return jsonify({**body, 'collapsed': [{'stack': stack, 'samples': n} for stack, n in stacks]})
+    return Response(''.join(f'{stack} {n}\n' for stack, n in stacks), mimetype='text/plain')
+
+@app.get('/admin/cascade')
+def admin_cascade():
+    """Attempts, hit rate, average latency and escalation reasons of each
+    model of the query and answer cascades, keyed by `stage:model`. Counts
+    are per worker process."""
+    if not is_admin():
+        return jsonify({'error': 'Forbidden.'}), 403
+    return jsonify(get_chain().cascade_report())
+
+@app.get('/ready')
+def ready():
+    if _chain is not None:
+        warm = _warmer.last_run if _warmer is not None else None
+        watch = _watcher.last_check if _watcher is not None else None
+        return jsonify({'ready': True, 'startup': startup, 'warm': warm, 'watch': watch})
+    body = {'ready': False}
+    if _init_error is not None:
+        body['error'] = repr(_init_error)
+    return jsonify(body), 503
+
 @app.post('/prompt')
 def prompt():
+    chain = get_chain()
+    from jbot.router import ToolTimeout
+    from jbot.sql.chain import wants_more
     json = request.get_json()
     prompt = json['prompt']
-    context = json['context']
-    full_prompt = (
-        f'Context (ignore if not relevant to the prompt): """{context}"""\n'
-        f'Prompt: """{prompt}"""'
-    )
-    answer = chain.run(full_prompt)
-    return jsonify({'answer': answer})
+    chat = json.get('chat')
+    with request_deadline():
+        if wants_more(prompt):
+            result = chain.page(chat=chat)
+            if result is not None:
+                return jsonify({'answer': result.sql_result, 'cursor': result.cursor_id})
+        sessions = get_sessions()
+        reply = _watcher.handle(chat, prompt) if _watcher is not None and chat is not None else None
+        if reply is not None:
+            sessions.add(chat, prompt, reply)
+            log_request(question=prompt, context=False, tool='avisos')
+            return jsonify({'answer': reply, 'cursor': None, 'tool': 'avisos', 'partial': False,
+                            'approximate': False})
+        # `quoted` is the message replied to; older clients send it as `context`
+        context = sessions.context(chat, prompt, json.get('quoted', json.get('context')))
+        try:
+            result = get_router().answer(prompt, context, chat)
+        except ToolTimeout:
+            return jsonify({'error': 'Demorei demais para responder, tente de novo.'}), 504
+    answer = result.response
+    if _watcher is not None and chat is not None and result.tool == 'cursos':
+        hint = _watcher.hint(chat, prompt)
+        if hint is not None:
+            answer = f'{answer}\n\n{hint}'
+    if chat is not None:
+        sessions.add(chat, prompt, result.response)
+    log_request(question=prompt, context=bool(context), tool=result.tool, sql_query=result.sql_query,
+                partial=result.partial)
+    return jsonify({'answer': answer, 'cursor': result.cursor, 'tool': result.tool, 'partial': result.partial,
+                    'approximate': result.approximate})
+
+@app.post('/prompt/batch')
+def prompt_batch():
+    """Answer `prompts` (strings, or objects with a `prompt` and optionally
+    an `id` and a `context`), streaming one JSON line per prompt as each is
+    answered and a last line with `done`. `concurrency` is capped by
+    JBOT_BATCH_CONCURRENCY. Each prompt has the time of a single request,
+    and the whole batch JBOT_BATCH_TIMEOUT seconds (or X-Timeout)."""
+    chain = get_chain()
+    from jbot.batch import parse_items, run_batch
+    from jbot.router import with_context
+    json = request.get_json()
+    items = parse_items(json.get('prompts'))
+    if items is None:
+        return jsonify({'error': '`prompts` must be a list of prompts.'}), 400
+    limit = int(os.environ.get('JBOT_BATCH_CONCURRENCY', '8'))
+    try:
+        concurrency = int(json.get('concurrency') or limit)
+    except (TypeError, ValueError):
+        return jsonify({'error': '`concurrency` must be an integer.'}), 400
+    if concurrency < 1:
+        return jsonify({'error': '`concurrency` must be at least 1.'}), 400
+    concurrency = min(concurrency, limit)
+    timeout = float(os.environ.get('JBOT_REQUEST_TIMEOUT', '90'))
+
+    def lines():
+        # the batch deadline is cancelled, with the prompts it runs, if the
+        # client hangs up
+        with request_deadline(float(os.environ.get('JBOT_BATCH_TIMEOUT', '600'))):
+            for result in run_batch(chain, items, with_context, concurrency, timeout):
+                yield dumps(result, ensure_ascii=False) + '\n'
+    return Response(stream_with_context(lines()), mimetype='application/x-ndjson')
 
 @app.post('/query')
 def query():
+    """Run a SELECT. Without `format`, the rows come rendered for chat, like
+    in answers. With `format` json (columnar), ndjson (streamed) or arrow
+    (Arrow IPC stream, if pyarrow is installed), they come typed and whole,
+    `limit` at a time from `offset`; `next_offset` tells where the next page
+    starts. json pages are capped at JBOT_QUERY_MAX_ROWS rows."""
+    chain = get_chain()
     json = request.get_json()
-    results = chain.run_sql(json['query'])
-    return jsonify({'results': results})
+    format = json.get('format')
+    if format is not None:
+        return structured_query(chain, json, format)
+    with request_deadline():
+        result = chain.run_sql(json['query'], chat=json.get('chat'))
+    log_request(sql_query=json['query'], tool='sql', error=result.sql_error)
+    return jsonify({'results': result.sql_result, 'cursor': result.cursor_id})
+
+def structured_query(chain, json, format):
+    from jbot.sql import structured
+    if format not in structured.FORMATS:
+        return jsonify({'error': f'`format` must be one of {", ".join(structured.FORMATS)}.'}), 400
+    if format == 'arrow' and not structured.arrow_available():
+        return jsonify({'error': 'Arrow results need pyarrow, which is not installed.'}), 501
+    try:
+        offset = int(json.get('offset') or 0)
+        limit = json.get('limit')
+        limit = int(limit) if limit is not None else None
+    except (TypeError, ValueError):
+        return jsonify({'error': '`offset` and `limit` must be integers.'}), 400
+    if offset < 0 or (limit is not None and limit < 1):
+        return jsonify({'error': '`offset` must be at least 0 and `limit` at least 1.'}), 400
+    if format == 'json':
+        max_rows = int(os.environ.get('JBOT_QUERY_MAX_ROWS', '1000'))
+        limit = min(limit or max_rows, max_rows)
+    # the deadline outlives this function: streamed queries stay interruptible
+    with request_deadline():
+        try:
+            result = chain.run_structured(json['query'], offset=offset, limit=limit)
+            if format == 'json':
+                body = structured.columnar_json(result)
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            log_request(sql_query=json['query'], tool='sql', error=True)
+            return jsonify({'error': str(e)}), 400
+    log_request(sql_query=json['query'], tool='sql', error=False)
+    if format == 'json':
+        return jsonify(body)
+    if format == 'ndjson':
+        return Response(stream_with_context(structured.ndjson_lines(result)), mimetype='application/x-ndjson')
+    return Response(stream_with_context(structured.arrow_stream(result)), mimetype='application/vnd.apache.arrow.stream')
+
+@app.post('/more')
+def more():
+    """The next rows of a truncated result: of `cursor`, or else of the
+    latest one of `chat`. `limit` rows at most, and no more than the chain's
+    `hard_limit`."""
+    chain = get_chain()
+    json = request.get_json()
+    limit = json.get('limit')
+    try:
+        limit = int(limit) if limit is not None else None
+    except (TypeError, ValueError):
+        return jsonify({'error': '`limit` must be an integer.'}), 400
+    if limit is not None and limit < 1:
+        return jsonify({'error': '`limit` must be at least 1.'}), 400
+    limit = min(limit or chain.hard_limit, chain.hard_limit)
+    with request_deadline():
+        result = chain.page(cursor_id=json.get('cursor'), chat=json.get('chat'), limit=limit)
+    if result is None:
+        return jsonify({'error': 'No results left to show.'}), 404
+    return jsonify({'results': result.sql_result, 'cursor': result.cursor_id})
+
+@app.get('/notifications')
+def notifications():
+    """Vacancy notifications not delivered yet, oldest first, for the bridge
+    to send and then acknowledge with /notifications/ack. `limit` is capped
+    at 1000. Only for the bridge, see `is_bridge`."""
+    if not is_bridge():
+        return jsonify({'error': 'Forbidden.'}), 403
+    limit = request.args.get('limit', 100, type=int)
+    if limit < 1:
+        return jsonify({'error': '`limit` must be at least 1.'}), 400
+    limit = min(limit, 1000)
+    get_chain()
+    if _watcher is None:
+        return jsonify({'notifications': []})
+    return jsonify({'notifications': [n.dict() for n in _watcher.store.pending(limit)]})
+
+@app.post('/notifications/ack')
+def notifications_ack():
+    if not is_bridge():
+        return jsonify({'error': 'Forbidden.'}), 403
+    get_chain()
+    ids = request.get_json().get('ids')
+    if not isinstance(ids, list) or not all(isinstance(i, int) for i in ids):
+        return jsonify({'error': '`ids` must be a list of notification ids.'}), 400
+    if _watcher is not None:
+        _watcher.store.ack(ids)
+    return jsonify({'acked': len(ids)})
+
+# JBOT_INIT: background (default), eager (before serving) or lazy (on the
+# first request)
+if os.environ.get('JBOT_INIT', 'background') == 'background':
+    start_init()
+elif os.environ.get('JBOT_INIT') == 'eager':
+    init()
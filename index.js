@@ -7,7 +7,6 @@ var allowed_chats = [
     /^Criazada da facul$/,
 ];
 
-var last_messages = {};
 var allowed_chat_ids = [];
 
 const client = new Client({
@@ -30,6 +29,7 @@ client.on('ready', async () => {
     });
 
     console.log(allowed_chat_ids);
+    setInterval(deliverNotifications, NOTIFY_INTERVAL_MS);
 });
 
 function isAllowedChat(chat_id) {
@@ -37,47 +37,195 @@ function isAllowedChat(chat_id) {
     return true;
 }
 
-async function fetchJson(url, data) {
-    return await fetch(url, {
-        method: 'POST',
-        body: JSON.stringify(data),
-        headers: {
-            'Content-Type': 'application/json'
-        },
-    }).then(res => res.json());
+// messages from the same sender arriving within DEBOUNCE_MS of each other are
+// answered as one prompt; at most MAX_INFLIGHT requests go to the API at once
+const API_URL = process.env.JBOT_API_URL || 'http://localhost:5000';
+const DEBOUNCE_MS = Number(process.env.JBOT_DEBOUNCE_MS || 1500);
+const MAX_INFLIGHT = Number(process.env.JBOT_MAX_INFLIGHT || 4);
+// the API gives up on a request after this many seconds (and returns what it
+// has); the bridge waits a little longer for that answer
+const REQUEST_TIMEOUT_S = Number(process.env.JBOT_REQUEST_TIMEOUT || 90);
+// how often vacancy notifications are fetched from the API; they are only
+// handed to the bridge, which proves it with the API's JBOT_BRIDGE_TOKEN
+const NOTIFY_INTERVAL_MS = Number(process.env.JBOT_NOTIFY_INTERVAL_MS || 15000);
+const BRIDGE_HEADERS = process.env.JBOT_BRIDGE_TOKEN ? { 'X-Bridge-Token': process.env.JBOT_BRIDGE_TOKEN } : {};
+
+class Semaphore {
+    constructor(size) {
+        this.free = size;
+        this.waiting = [];
+    }
+
+    async acquire() {
+        if (this.free > 0) {
+            this.free--;
+            return;
+        }
+        await new Promise(resolve => this.waiting.push(resolve));
+    }
+
+    release() {
+        let next = this.waiting.shift();
+        if (next) next();
+        else this.free++;
+    }
 }
 
-async function answerPrompt(prompt, context) {
-    return await fetchJson('http://localhost:5000/prompt', { prompt: prompt, context: context });
+const inflight = new Semaphore(MAX_INFLIGHT);
+
+// aborts when either signal does, like AbortSignal.any (Node >= 20.3 only)
+function anySignal(a, b) {
+    if (a.aborted) return a;
+    if (b.aborted) return b;
+    let controller = new AbortController();
+    let abort = source => () => {
+        a.removeEventListener('abort', onA);
+        b.removeEventListener('abort', onB);
+        controller.abort(source.reason);
+    };
+    let onA = abort(a), onB = abort(b);
+    a.addEventListener('abort', onA);
+    b.addEventListener('abort', onB);
+    return controller.signal;
 }
 
-async function answerQuery(query) {
-    return await fetchJson('http://localhost:5000/query', { query: query });
+async function fetchJson(url, data, signal) {
+    await inflight.acquire();
+    let timeout = AbortSignal.timeout((REQUEST_TIMEOUT_S + 5) * 1000);
+    try {
+        return await fetch(url, {
+            method: 'POST',
+            body: JSON.stringify(data),
+            headers: {
+                'Content-Type': 'application/json',
+                'X-Timeout': String(REQUEST_TIMEOUT_S),
+                ...BRIDGE_HEADERS,
+            },
+            signal: signal ? anySignal(signal, timeout) : timeout,
+        }).then(res => res.json());
+    } finally {
+        inflight.release();
+    }
 }
 
-client.on('message', async msg => {
-    if (!isAllowedChat(msg.from)) return;
-    let last_message = last_messages[msg.from] || '';
-    last_messages[msg.from] = msg.body;
+// the server keeps each chat's history; only the quoted message is sent along
+async function answerPrompt(prompt, quoted, chat, signal) {
+    return await fetchJson(`${API_URL}/prompt`, { prompt: prompt, quoted: quoted, chat: chat }, signal);
+}
 
-    let chat = await msg.getChat();
+async function answerQuery(query, chat) {
+    return await fetchJson(`${API_URL}/query`, { query: query, chat: chat });
+}
 
-    if (msg.body.length > 2 && (!chat.isGroup || msg.body.match(/^jota/i))) {
-        let reply = msg.hasQuotedMsg ? (await msg.getQuotedMessage()).body : '';
+// notifications are acknowledged once sent, so a failed delivery is retried
+// on the next round
+var delivering = false;
+
+async function deliverNotifications() {
+    if (delivering) return;
+    delivering = true;
+    try {
+        let response = await fetch(`${API_URL}/notifications`, { headers: BRIDGE_HEADERS }).then(res => res.json());
+        let sent = [];
+        for (let notification of response.notifications || []) {
+            try {
+                await client.sendMessage(notification.chat, notification.text);
+                sent.push(notification.id);
+            } catch (err) {
+                console.error(err);
+            }
+        }
+        if (sent.length) await fetchJson(`${API_URL}/notifications/ack`, { ids: sent });
+    } catch (err) {
+        console.error(err);
+    } finally {
+        delivering = false;
+    }
+}
 
-        await chat.sendStateTyping();
-        let response = await answerPrompt(msg.body, reply || last_message);
+// per chat: the burst being debounced, the request in flight and the tail of
+// the queue that runs them one at a time, in arrival order
+var chats = {};
 
-        await chat.clearState();
-        await msg.reply(response.answer);
-        last_messages[msg.from] = response.answer;
+function chatState(chat_id) {
+    if (!chats[chat_id]) {
+        chats[chat_id] = { burst: null, current: null, queue: Promise.resolve() };
+    }
+    return chats[chat_id];
+}
 
-        // await client.sendMessage(msg.from, `Gerado com o seguinte comando SQL:\n\`\`\`${response.sql}\`\`\``);
-    } else if (msg.body.match(/^!sql /i)) {
+function enqueue(state, task) {
+    state.queue = state.queue.then(task).catch(err => console.error(err));
+}
+
+function flush(chat_id) {
+    let state = chatState(chat_id);
+    let burst = state.burst;
+    if (!burst) return;
+    clearTimeout(burst.timer);
+    state.burst = null;
+    enqueue(state, () => sendBurst(chat_id, state, burst));
+}
+
+function addToBurst(chat_id, sender, msg, quoted) {
+    let state = chatState(chat_id);
+    if (state.burst && state.burst.sender !== sender) flush(chat_id);
+    if (!state.burst) {
+        state.burst = { sender: sender, messages: [], quoted: [] };
+        // a newer message from the same sender supersedes the request in
+        // flight: it is cancelled and its messages are asked again with this one
+        let current = state.current;
+        if (current && current.sender === sender) {
+            current.controller.abort();
+            state.burst.messages.push(...current.messages);
+            state.burst.quoted.push(...current.quoted);
+        }
+    }
+    clearTimeout(state.burst.timer);
+    state.burst.messages.push(msg);
+    state.burst.quoted.push(quoted);
+    state.burst.timer = setTimeout(() => flush(chat_id), DEBOUNCE_MS);
+}
+
+async function sendBurst(chat_id, state, burst) {
+    let controller = new AbortController();
+    state.current = { sender: burst.sender, messages: burst.messages, quoted: burst.quoted, controller: controller };
+    let last = burst.messages[burst.messages.length - 1];
+    let chat = await last.getChat();
+    try {
+        let quoted = (await Promise.all(burst.quoted)).filter(q => q).join('\n');
+        let prompt = burst.messages.map(m => m.body).join('\n');
         await chat.sendStateTyping();
-        let response = await answerQuery(msg.body.replace(/^!sql /i, ''));
+        let response = await answerPrompt(prompt, quoted, chat_id, controller.signal);
+        // answered: from here on a newer message starts a request of its own
+        state.current = null;
+        await last.reply(response.answer || response.error);
+    } catch (err) {
+        if (err.name === 'TimeoutError') await last.reply('Demorei demais para responder, tente de novo.');
+        else if (err.name !== 'AbortError') throw err;
+    } finally {
+        if (state.current && state.current.controller === controller) state.current = null;
         await chat.clearState();
-        await msg.reply(response.results);
+    }
+}
+
+client.on('message', msg => {
+    if (!isAllowedChat(msg.from)) return;
+    // everything up to the queueing is synchronous, so messages keep their order
+    let is_group = msg.from.endsWith('@g.us');
+
+    if (msg.body.length > 2 && (!is_group || msg.body.match(/^jota/i))) {
+        let quoted = msg.hasQuotedMsg ? msg.getQuotedMessage().then(q => q.body) : '';
+        addToBurst(msg.from, msg.author || msg.from, msg, quoted);
+    } else if (msg.body.match(/^!sql /i)) {
+        flush(msg.from);
+        enqueue(chatState(msg.from), async () => {
+            let chat = await msg.getChat();
+            await chat.sendStateTyping();
+            let response = await answerQuery(msg.body.replace(/^!sql /i, ''), msg.from);
+            await chat.clearState();
+            await msg.reply(response.results);
+        });
     }
 });
 
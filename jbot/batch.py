@@ -0,0 +1,114 @@
+"""Answering many prompts at once, for evaluations and pre-answered FAQs."""
+from __future__ import annotations
+
+import contextvars
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Iterator, Optional
+
+from . import deadline as request_deadline
+from .similarity import normalize
+from .sql.chain import SQLChain
+
+
+def batch_key(item: dict[str, Any]) -> tuple[str, str]:
+    """Items with the same key get the same answer, and are answered once."""
+    return normalize(item['prompt']), normalize(item.get('context') or '')
+
+
+def run_batch(
+    chain: SQLChain,
+    items: list[dict[str, Any]],
+    full_prompt: Callable[[str, str], str],
+    concurrency: int = 8,
+    timeout: float = 90.0,
+) -> Iterator[dict[str, Any]]:
+    """Answer `items` (dicts with a `prompt`, and optionally an `id` and a
+    `context`), yielding results as they complete.
+
+    At most `concurrency` distinct prompts run at a time, each through
+    `chain` with the prompt built by `full_prompt(prompt, context)`.
+    Duplicates are answered once and yielded together. The schema
+    description is built before the prompts fan out, and identical SQL is
+    executed once by `SQLDatabase.run_truncated`.
+
+    Each prompt runs under its own deadline of `timeout` seconds, or less
+    if the caller's deadline is sooner. Cancelling the caller's deadline,
+    or closing the iterator, cancels the prompts running and not started.
+    """
+    start = time.perf_counter()
+    groups: dict[tuple[str, str], list[int]] = {}
+    for i, item in enumerate(items):
+        groups.setdefault(batch_key(item), []).append(i)
+
+    # shared by every prompt, and otherwise built by the first few at once
+    chain.get_database_description()
+
+    caller = request_deadline.current()
+    batch = request_deadline.Deadline(float('inf'))
+    stop_following = caller.on_cancel(batch.cancel) if caller is not None else lambda: None
+
+    def answer(index: int) -> dict[str, Any]:
+        item = items[index]
+        started = time.perf_counter()
+        batch.check()
+        seconds = timeout if caller is None else min(timeout, caller.remaining())
+        with request_deadline.deadline(seconds) as d:
+            unregister = batch.on_cancel(d.cancel)
+            try:
+                outputs = chain({
+                    'prompt': full_prompt(item['prompt'], item.get('context') or ''),
+                    'question': item['prompt'],
+                    'context': item.get('context') or '',
+                })
+            finally:
+                unregister()
+        return {
+            'answer': outputs['response'],
+            'sql_query': outputs['sql_query'],
+            'cursor': outputs['cursor'],
+            'approximate': outputs.get('approximate', False),
+            'seconds': time.perf_counter() - started,
+        }
+
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix='jbot-batch')
+    futures: dict[Future, list[int]] = {
+        executor.submit(contextvars.copy_context().run, answer, indexes[0]): indexes
+        for indexes in groups.values()
+    }
+    try:
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result: dict[str, Any] = future.result()
+                except Exception as e:
+                    result = {'error': repr(e)}
+                for index in futures[future]:
+                    yield {'index': index, 'id': items[index].get('id'), **result}
+    finally:
+        stop_following()
+        batch.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+    yield {
+        'done': True,
+        'count': len(items),
+        'unique': len(groups),
+        'seconds': time.perf_counter() - start,
+    }
+
+
+def parse_items(data: Any) -> Optional[list[dict[str, Any]]]:
+    """Items from a request body: a list of prompts, or of dicts with a
+    `prompt`. None if malformed."""
+    if not isinstance(data, list):
+        return None
+    items = []
+    for entry in data:
+        if isinstance(entry, str):
+            entry = {'prompt': entry}
+        if not isinstance(entry, dict) or not isinstance(entry.get('prompt'), str):
+            return None
+        items.append(entry)
+    return items
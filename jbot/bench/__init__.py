@@ -0,0 +1,224 @@
+"""Offline benchmark of the SQL chain.
+
+Replays a corpus of questions with golden SQL through `SQLChain`, against a
+synthetic course database and a recorded or fake model, and reports per-stage
+timings, SQL execution time, result sizes, token counts and accuracy. Reports
+are JSON so runs on different commits can be compared.
+"""
+from __future__ import annotations
+
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import time
+from collections import Counter, defaultdict
+from typing import Any, Callable, Optional
+
+from langchain.callbacks import get_openai_callback
+from langchain.schema.language_model import BaseLanguageModel
+
+from ..sql.chain import SQLChain, _query_re
+from ..sql.cursors import ResultCursorStore
+from ..sql.db import SQLDatabase
+from ..sql.examples import ExampleStore
+from ..sql.prompt_gpt4 import COLUMN_COMMENTS_COURSES, DATABASE_PREAMBLE_COURSES
+
+CORPUS = os.path.join(os.path.dirname(__file__), 'corpus.jsonl')
+
+
+def load_corpus(path: str = CORPUS) -> list[dict[str, Any]]:
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def build_chain(db: SQLDatabase, llm: BaseLanguageModel, on_stage: Callable[[str, float, dict[str, Any]], None]) -> SQLChain:
+    """A chain set up like `main.create_chain`, minus the network."""
+    cursors = ResultCursorStore()
+    db.on_invalidate(cursors.clear)
+    return SQLChain(
+        llm=llm,
+        db=db,
+        database_preamble=DATABASE_PREAMBLE_COURSES,
+        column_comments=COLUMN_COMMENTS_COURSES,
+        cursors=cursors,
+        hard_limit=50,
+        sql_token_budget=400,
+        example_store=ExampleStore(),
+        on_stage=on_stage,
+    )
+
+
+def _normalized_rows(conn: sqlite3.Connection, sql: str) -> tuple[Optional[list[tuple]], Optional[str]]:
+    try:
+        rows = conn.execute(sql).fetchall()
+    except sqlite3.Error as e:
+        return None, str(e)
+    return [tuple('' if v is None else str(v) for v in row) for row in rows], None
+
+
+def results_match(golden: list[tuple], predicted: list[tuple], ordered: bool) -> bool:
+    if ordered:
+        return golden == predicted
+    return Counter(golden) == Counter(predicted)
+
+
+def summarize(values: list[float]) -> dict[str, float]:
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+
+    def pct(p: float) -> float:
+        return values[min(len(values) - 1, int(p * len(values)))]
+
+    return {
+        'count': len(values),
+        'total': sum(values),
+        'mean': sum(values) / len(values),
+        'p50': pct(0.5),
+        'p90': pct(0.9),
+        'p99': pct(0.99),
+        'max': values[-1],
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(__file__),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(
+    db_path: str,
+    llm: BaseLanguageModel,
+    corpus: list[dict[str, Any]],
+    repeat: int = 1,
+    replica: bool = False,
+) -> dict[str, Any]:
+    """Run every corpus question `repeat` times and return the report."""
+    stages: dict[str, list[float]] = defaultdict(list)
+    current: list[tuple[str, float, dict[str, Any]]] = []
+
+    def on_stage(name: str, seconds: float, info: dict[str, Any]) -> None:
+        stages[name].append(seconds)
+        current.append((name, seconds, info))
+
+    start = time.perf_counter()
+    db = SQLDatabase.from_sqlite_replica(db_path, watch_interval=0) if replica else SQLDatabase.from_uri(f'sqlite:///{db_path}')
+    setup = time.perf_counter() - start
+    chain = build_chain(db, llm, on_stage)
+    golden_conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+
+    questions = []
+    totals: Counter = Counter()
+    latencies = []
+    for round in range(repeat):
+        # examples learned in earlier rounds would change the prompts, and
+        # with them the cassette keys
+        chain.example_store = ExampleStore()
+        for entry in corpus:
+            current.clear()
+            with get_openai_callback() as cb:
+                start = time.perf_counter()
+                output = chain({'prompt': entry['question']})
+                elapsed = time.perf_counter() - start
+            latencies.append(elapsed)
+            totals['prompt_tokens'] += cb.prompt_tokens
+            totals['completion_tokens'] += cb.completion_tokens
+            totals['llm_calls'] += cb.successful_requests
+            if round:
+                continue
+
+            golden, _ = _normalized_rows(golden_conn, entry['sql'])
+            predicted, error = None, 'no query'
+            if output.get('sql_query'):
+                sql = _query_re.match(output['sql_query'].strip()).group('query')
+                predicted, error = _normalized_rows(golden_conn, sql)
+            correct = predicted is not None and results_match(
+                golden, predicted, ordered='order by' in entry['sql'].lower()
+            )
+            totals['correct'] += correct
+            execute = [info for name, _, info in current if name == 'execute']
+            questions.append({
+                'id': entry['id'],
+                'correct': correct,
+                'error': error,
+                'seconds': elapsed,
+                'stages': {name: seconds for name, seconds, _ in current},
+                'result_rows': sum(i['rows'] + i['omitted'] for i in execute),
+                'result_chars': sum(i['chars'] for i in execute),
+                'prompt_tokens': cb.prompt_tokens,
+                'completion_tokens': cb.completion_tokens,
+            })
+    tables = {
+        table: golden_conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+        for table in db.get_usable_table_names()
+    }
+    golden_conn.close()
+
+    runs = len(corpus) * repeat
+    return {
+        'meta': {
+            'commit': _git_commit(),
+            'python': platform.python_version(),
+            'llm': getattr(llm, 'model_name', llm._llm_type),
+            'db': db_path,
+            'db_bytes': os.path.getsize(db_path),
+            'tables': tables,
+            'questions': len(corpus),
+            'repeat': repeat,
+            'replica': replica,
+        },
+        'summary': {
+            'accuracy': totals['correct'] / len(corpus) if corpus else 0.0,
+            'setup_seconds': setup,
+            'latency': summarize(latencies),
+            'prompt_tokens_per_question': totals['prompt_tokens'] / runs if runs else 0,
+            'completion_tokens_per_question': totals['completion_tokens'] / runs if runs else 0,
+            'llm_calls_per_question': totals['llm_calls'] / runs if runs else 0,
+        },
+        'stages': {name: summarize(values) for name, values in sorted(stages.items())},
+        'cascade': chain.cascade_report(),
+        'questions': questions,
+    }
+
+
+def _flatten(report: dict[str, Any]) -> dict[str, float]:
+    flat = {}
+    for key, value in report['summary'].items():
+        if isinstance(value, dict):
+            for k, v in value.items():
+                flat[f'{key}.{k}'] = v
+        else:
+            flat[key] = value
+    for stage, stats in report['stages'].items():
+        for k in ('mean', 'p90', 'total'):
+            if k in stats:
+                flat[f'stages.{stage}.{k}'] = stats[k]
+    return flat
+
+
+def compare(base: dict[str, Any], head: dict[str, Any], threshold: float = 0.1) -> list[str]:
+    """Lines comparing two reports. Changes above `threshold` (relative) are
+    flagged, as are questions whose correctness changed."""
+    a, b = _flatten(base), _flatten(head)
+    lines = [f'{base["meta"].get("commit")} -> {head["meta"].get("commit")}']
+    for key in sorted(a.keys() | b.keys()):
+        old, new = a.get(key), b.get(key)
+        if old is None or new is None:
+            lines.append(f'  {key}: {old} -> {new}')
+            continue
+        change = (new - old) / old if old else (0.0 if new == old else float('inf'))
+        flag = ' !' if abs(change) > threshold else ''
+        lines.append(f'  {key}: {old:.4g} -> {new:.4g} ({change:+.1%}){flag}')
+    before = {q['id']: q['correct'] for q in base['questions']}
+    for q in head['questions']:
+        if q['id'] in before and before[q['id']] != q['correct']:
+            lines.append(f'  question {q["id"]}: {"fixed" if q["correct"] else "broken"}')
+    return lines
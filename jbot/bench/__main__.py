@@ -0,0 +1,96 @@
+"""python -m jbot.bench: run the offline benchmark or compare two reports.
+
+    python -m jbot.bench run --scale 10 --output head.json
+    python -m jbot.bench run --llm cassette --cassette bench.cassette.json
+    python -m jbot.bench run --llm record --cassette bench.cassette.json --model gpt-4
+    python -m jbot.bench compare base.json head.json
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+from typing import Optional
+
+from . import compare, load_corpus, run, CORPUS
+from . import synthetic
+from .llm import CassetteChatModel, CorpusChatModel
+from ..similarity import normalize
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m jbot.bench', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_cmd = commands.add_parser('run', help='run the corpus through the chain')
+    run_cmd.add_argument('--corpus', default=CORPUS)
+    run_cmd.add_argument('--db', help='database to use instead of a synthetic one')
+    run_cmd.add_argument('--scale', type=float, default=1.0, help='size of the synthetic database')
+    run_cmd.add_argument('--seed', type=int, default=0)
+    run_cmd.add_argument('--replica', action='store_true', help='serve the database from an in-memory replica')
+    run_cmd.add_argument('--repeat', type=int, default=3, help='runs per question, for steadier timings')
+    run_cmd.add_argument('--llm', choices=['fake', 'cassette', 'record'], default='fake',
+                         help='golden-SQL fake, replay a cassette, or record one with a real model')
+    run_cmd.add_argument('--cassette', default='bench.cassette.json')
+    run_cmd.add_argument('--replay-latency', action='store_true', help='sleep for recorded model latencies')
+    run_cmd.add_argument('--model', default='gpt-4', help='model to record with')
+    run_cmd.add_argument('--output', help='write the JSON report here')
+
+    compare_cmd = commands.add_parser('compare', help='compare two reports')
+    compare_cmd.add_argument('base')
+    compare_cmd.add_argument('head')
+    compare_cmd.add_argument('--threshold', type=float, default=0.1)
+
+    args = parser.parse_args(argv)
+    if args.command == 'compare':
+        with open(args.base) as f, open(args.head) as g:
+            print('\n'.join(compare(json.load(f), json.load(g), args.threshold)))
+        return 0
+
+    corpus = load_corpus(args.corpus)
+    if args.llm == 'fake':
+        llm = CorpusChatModel(golden={normalize(e['question']): e['sql'] for e in corpus})
+    else:
+        inner = None
+        if args.llm == 'record':
+            import dotenv
+            from ..llm import HedgedChatOpenAI
+            dotenv.load_dotenv()
+            inner = HedgedChatOpenAI(model=args.model, temperature=0)
+        llm = CassetteChatModel(path=args.cassette, inner=inner, replay_latency=args.replay_latency)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = args.db
+        if db_path is None:
+            db_path = os.path.join(tmp, f'synthetic-{args.scale:g}.sqlite3')
+            synthetic.build(db_path, args.scale, args.seed)
+        try:
+            report = run(db_path, llm, corpus, args.repeat, args.replica)
+        finally:
+            if args.llm == 'record':
+                llm.save()
+        report['meta']['scale'] = None if args.db else args.scale
+
+    summary = report['summary']
+    print(f'accuracy {summary["accuracy"]:.0%}  latency p50 {summary["latency"]["p50"] * 1000:.1f}ms'
+          f'  p90 {summary["latency"]["p90"] * 1000:.1f}ms'
+          f'  tokens/question {summary["prompt_tokens_per_question"]:.0f}+{summary["completion_tokens_per_question"]:.0f}')
+    for stage, stats in report['stages'].items():
+        print(f'  {stage:<10} mean {stats["mean"] * 1000:8.2f}ms  p90 {stats["p90"] * 1000:8.2f}ms  n={stats["count"]}')
+    for tier, stats in report['cascade'].items():
+        escalations = ', '.join(f'{reason} {n}' for reason, n in stats['escalations'].items())
+        print(f'  {tier:<24} hit rate {stats["hit_rate"]:.0%} of {stats["attempts"]}' + (f'  ({escalations})' if escalations else ''))
+    for q in report['questions']:
+        if not q['correct']:
+            print(f'  wrong: {q["id"]} ({q["error"] or "different rows"})', file=sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,146 @@
+"""Chat models for offline benchmarks: recorded cassettes and a deterministic fake."""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from typing import Any, Optional
+
+from langchain.adapters.openai import convert_message_to_dict
+from langchain.callbacks.manager import CallbackManagerForLLMRun
+from langchain.chat_models.base import BaseChatModel
+from langchain.schema import AIMessage, BaseMessage, ChatGeneration, ChatResult, HumanMessage
+from pydantic import PrivateAttr
+
+from ..similarity import normalize
+from ..sql.tokens import count_tokens
+
+_sql_result_re = re.compile(r'SQLResult:\s*```(.*?)```', re.DOTALL)
+
+
+def _result(content: str, messages: list[BaseMessage], model_name: str, usage: Optional[dict] = None) -> ChatResult:
+    if usage is None:
+        prompt_tokens = sum(count_tokens(m.content) + 4 for m in messages)
+        completion_tokens = count_tokens(content)
+        usage = {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens,
+        }
+    return ChatResult(
+        generations=[ChatGeneration(message=AIMessage(content=content))],
+        llm_output={'token_usage': usage, 'model_name': model_name},
+    )
+
+
+class CorpusChatModel(BaseChatModel):
+    """Answers corpus questions with their golden SQL, and phrases answers by
+    echoing the first lines of the SQL result. Fully deterministic, so the
+    benchmark measures everything but the model."""
+
+    golden: dict[str, str]
+    """Normalized question -> golden SQL."""
+    model_name: str = 'corpus-fake'
+
+    @property
+    def _llm_type(self) -> str:
+        return 'corpus-fake'
+
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: Optional[list[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        last = messages[-1]
+        if isinstance(last, AIMessage):
+            m = _sql_result_re.search(last.content)
+            lines = (m.group(1).strip() if m else '').splitlines()[:5]
+            content = 'Answer: ' + ('; '.join(lines) or 'Não encontrei resultados.')
+        else:
+            # retries follow the question with the rejected attempts
+            question = next(m for m in messages if isinstance(m, HumanMessage))
+            sql = self.golden.get(normalize(question.content))
+            if sql is None:
+                content = 'Answer: Não sei responder isso.'
+            else:
+                content = f'StepByStep: [Consultar o banco]\nSQLQuery: {sql}\n'
+        return _result(content, messages, self.model_name)
+
+
+class CassetteChatModel(BaseChatModel):
+    """Replays chat completions recorded in a JSON file.
+
+    With `inner` set, calls missing from the cassette are made with `inner`
+    and recorded; otherwise they raise KeyError. Calls are keyed by their
+    messages and stop words, so a changed prompt needs a new recording.
+    `replay_latency` sleeps for the recorded latency of each call.
+    """
+
+    path: str
+    inner: Optional[BaseChatModel] = None
+    replay_latency: bool = False
+    model_name: str = 'cassette'
+
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _entries: Optional[dict[str, dict[str, Any]]] = PrivateAttr(default=None)
+
+    def __init__(self, **kwargs: Any):
+        super().__init__(**kwargs)
+        # loaded now so that copies made by pydantic share the entries
+        self._load()
+
+    @property
+    def _llm_type(self) -> str:
+        return 'cassette'
+
+    def _load(self) -> dict[str, dict[str, Any]]:
+        if self._entries is None:
+            self._entries = {}
+            if os.path.exists(self.path):
+                with open(self.path, encoding='utf-8') as f:
+                    self._entries = json.load(f)
+        return self._entries
+
+    def save(self) -> None:
+        with self._lock:
+            entries = self._load()
+            with open(self.path, 'w', encoding='utf-8') as f:
+                json.dump(entries, f, ensure_ascii=False, indent=1, sort_keys=True)
+
+    @staticmethod
+    def key(messages: list[BaseMessage], stop: Optional[list[str]]) -> str:
+        data = json.dumps([[convert_message_to_dict(m) for m in messages], stop or []], sort_keys=True)
+        return hashlib.sha1(data.encode()).hexdigest()
+
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: Optional[list[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        key = self.key(messages, stop)
+        with self._lock:
+            entry = self._load().get(key)
+        if entry is None:
+            if self.inner is None:
+                raise KeyError(f'call {key} is not in cassette {self.path}')
+            start = time.perf_counter()
+            # not generate(), which would report the usage to callbacks twice
+            result = self.inner._generate(messages, stop=stop)
+            entry = {
+                'content': result.generations[0].text,
+                'usage': (result.llm_output or {}).get('token_usage'),
+                'model': getattr(self.inner, 'model_name', None),
+                'latency': time.perf_counter() - start,
+            }
+            with self._lock:
+                self._load()[key] = entry
+        elif self.replay_latency:
+            time.sleep(entry.get('latency', 0))
+        return _result(entry['content'], messages, entry.get('model') or self.model_name, entry.get('usage'))
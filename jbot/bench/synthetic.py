@@ -0,0 +1,121 @@
+"""Deterministic synthetic course database, scalable to stress the pipeline.
+
+Scale 1 is roughly the size of one real semester. Every scale contains the
+fixed courses, disciplines and professors the benchmark corpus asks about;
+larger scales add filler rows around them.
+"""
+from __future__ import annotations
+
+import random
+from typing import Any
+
+from ..sql import loader
+
+COURSES = [
+    ('G010', 'Ciência da Computação'),
+    ('G014', 'Sistemas de Informação'),
+    ('G007', 'Engenharia de Controle e Automação'),
+    ('G021', 'Matemática'),
+    ('G033', 'Física'),
+]
+
+DISCIPLINES = [
+    ('GCC125', 'Redes de Computadores', {'G010': 5, 'G014': None}),
+    ('GAC106', 'Fundamentos de Programação I', {'G010': 1, 'G014': 1, 'G007': 1}),
+    ('GCC218', 'Algoritmos em Grafos', {'G010': 4}),
+    ('GCC128', 'Inteligência Artificial', {'G010': 6, 'G014': None}),
+    ('GCC129', 'Sistemas Distribuídos', {'G010': 7}),
+    ('GEX104', 'Cálculo I', {'G010': 1, 'G007': 1, 'G021': 1, 'G033': 1}),
+    ('GEX110', 'Álgebra Linear', {'G010': 2, 'G021': 2, 'G033': 2}),
+    ('GSI501', 'Banco de Dados', {'G014': 3, 'G010': 3}),
+]
+
+PROFESSORS = [
+    'HERMES PIMENTA DE MORAES JUNIOR',
+    'ANA CAROLINA MAIOLI CAMPOS BARBOSA',
+    'LUIZ HENRIQUE ANDRADE CORREIA',
+    'MARLUCE RODRIGUES PEREIRA',
+    'ANDRE VITAL SAUDE',
+]
+
+_DAYS = ['segunda', 'terça', 'quarta', 'quinta', 'sexta', 'sábado']
+_ROOMS = ['PV1-101', 'PV2-201', 'PV3-305', 'DCC-LAB1', 'DEX-12']
+_WORDS = [
+    'Tópicos', 'Avançados', 'Introdução', 'Laboratório', 'Modelagem', 'Teoria',
+    'Métodos', 'Projeto', 'Análise', 'Sistemas', 'Computação', 'Dados',
+]
+
+
+def generate(scale: float = 1.0, seed: int = 0) -> dict[str, list[dict[str, Any]]]:
+    """Records per table, in the format `loader.load` takes."""
+    rng = random.Random(seed)
+    courses = [{'id_curso': c, 'nome_curso': n} for c, n in COURSES]
+    for i in range(int(20 * scale)):
+        courses.append({'id_curso': f'S{i:04d}', 'nome_curso': f'Curso Sintético {i}'})
+
+    disciplines = [{'id_disc': d, 'nome_disc': n} for d, n, _ in DISCIPLINES]
+    matrix = [
+        {'id_disc': d, 'id_curso': c, 'periodo': p, 'is_eletiva': int(p is None)}
+        for d, _, periods in DISCIPLINES for c, p in periods.items()
+    ]
+    for i in range(int(300 * scale)):
+        id_disc = f'SYN{i:05d}'
+        disciplines.append({'id_disc': id_disc, 'nome_disc': ' '.join(rng.sample(_WORDS, 3)) + f' {i}'})
+        for course in rng.sample(courses, rng.randint(1, 3)):
+            elective = rng.random() < 0.3
+            matrix.append({
+                'id_disc': id_disc,
+                'id_curso': course['id_curso'],
+                'periodo': None if elective else rng.randint(1, 10),
+                'is_eletiva': int(elective),
+            })
+
+    professors = [{'id_prof': i, 'nome_prof': n} for i, n in enumerate(PROFESSORS, 1)]
+    for i in range(len(professors) + 1, len(professors) + 1 + int(80 * scale)):
+        professors.append({'id_prof': i, 'nome_prof': f'PROFESSOR SINTETICO {i}'})
+
+    offers, classes = [], []
+    for m in matrix:
+        for turma in range(rng.randint(1, 2)):
+            id_oferta = len(offers) + 1
+            total = rng.choice([20, 30, 40, 60])
+            taken = rng.randint(0, total)
+            offers.append({
+                'id_oferta': id_oferta,
+                'id_disc': m['id_disc'],
+                'id_curso': m['id_curso'],
+                'id_prof': rng.choice(professors)['id_prof'] if rng.random() > 0.05 else None,
+                'turma': f'{m["id_curso"][-2:]}{chr(ord("A") + turma)}',
+                'vagas_restantes': total - taken,
+                'vagas_ocupadas': taken,
+            })
+            start = rng.choice([7, 8, 10, 13, 14, 16, 19, 21])
+            for day in rng.sample(_DAYS, rng.randint(1, 2)):
+                classes.append({
+                    'id_oferta': id_oferta,
+                    'id_disc': m['id_disc'],
+                    'nome_local': rng.choice(_ROOMS),
+                    'dia_semana': day,
+                    'hora_inicio': start,
+                    'hora_fim': start + 2,
+                })
+
+    return {
+        'Cursos': courses,
+        'Disciplinas': disciplines,
+        'DisciplinasMatriz': matrix,
+        'Professores': professors,
+        'OfertasDisciplina': offers,
+        'AulasOferta': classes,
+    }
+
+
+def build(path: str, scale: float = 1.0, seed: int = 0) -> dict[str, int]:
+    """Write the synthetic database to `path` with the loader. Returns row counts."""
+    conn = loader.connect(path)
+    try:
+        tables = generate(scale, seed)
+        return loader.load(conn, {t: iter(records) for t, records in tables.items()})
+    finally:
+        conn.close()
+
@@ -0,0 +1,205 @@
+"""Caches keyed by a data snapshot token, local to a process or shared by workers.
+
+Every entry is stored with the token of the database snapshot it was computed
+from (see `SQLDatabase.cache_token`), and lookups with a different token
+miss. Stale entries therefore never need to be invalidated to stay correct;
+they are only cleaned up to reclaim space.
+"""
+from __future__ import annotations
+
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+MISSING = object()
+
+
+class LocalCache:
+    """In-process LRU cache of at most `max_entries` entries."""
+
+    shared = False
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[tuple[str, Hashable], tuple[str, Any, Optional[float]]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, namespace: str, key: Hashable, token: str) -> Any:
+        """The cached value, or `MISSING`."""
+        with self._lock:
+            entry = self._entries.get((namespace, key))
+            if entry is None or entry[0] != token or (entry[2] is not None and entry[2] < time.time()):
+                self.misses += 1
+                return MISSING
+            self._entries.move_to_end((namespace, key))
+            self.hits += 1
+            return entry[1]
+
+    def set(self, namespace: str, key: Hashable, token: str, value: Any, ttl: Optional[float] = None) -> None:
+        with self._lock:
+            self._entries[(namespace, key)] = (token, value, time.time() + ttl if ttl else None)
+            self._entries.move_to_end((namespace, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def claim(self, namespace: str, key: Hashable, token: str, ttl: Optional[float] = None) -> bool:
+        """Set the entry to True unless it is set. Whether this call set it."""
+        with self._lock:
+            entry = self._entries.get((namespace, key))
+            if entry is not None and entry[0] == token and (entry[2] is None or entry[2] >= time.time()):
+                return False
+            self._entries[(namespace, key)] = (token, True, time.time() + ttl if ttl else None)
+            self._entries.move_to_end((namespace, key))
+            return True
+
+    def retain(self, token: str) -> None:
+        """Drop entries of every other snapshot."""
+        with self._lock:
+            for key in [k for k, e in self._entries.items() if e[0] != token]:
+                del self._entries[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+class SharedCache:
+    """Cache in a SQLite file in WAL mode, shared by the processes using it.
+
+    Readers never block the writer or each other, so prefork workers can all
+    read and fill the same cache. Values are pickled. Once the cache holds
+    more than `max_entries`, the oldest entries are deleted.
+
+    Workers `announce` the token of each snapshot they load. Entries of
+    tokens superseded more than `grace` seconds ago are deleted, which gives
+    workers still on the previous snapshot time to notice the new one.
+    """
+
+    shared = True
+
+    def __init__(self, path: str, max_entries: int = 50000, grace: float = 60.0):
+        self.path = path
+        self.max_entries = max_entries
+        self.grace = grace
+        self._local = threading.local()
+        self._writes = 0
+        conn = self._conn()
+        conn.executescript(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            ' namespace TEXT NOT NULL, key TEXT NOT NULL, token TEXT NOT NULL,'
+            ' value BLOB NOT NULL, expires_at REAL,'
+            ' PRIMARY KEY (namespace, key));'
+            'CREATE INDEX IF NOT EXISTS idx_entries_token ON entries (token);'
+            'CREATE TABLE IF NOT EXISTS tokens (token TEXT PRIMARY KEY, first_seen REAL NOT NULL);'
+        )
+
+    def _conn(self) -> sqlite3.Connection:
+        # one connection per thread and per process, as connections must not
+        # cross a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def _key(key: Hashable) -> str:
+        return key if isinstance(key, str) else repr(key)
+
+    def get(self, namespace: str, key: Hashable, token: str) -> Any:
+        """The cached value, or `MISSING`."""
+        row = self._conn().execute(
+            'SELECT value FROM entries WHERE namespace = ? AND key = ? AND token = ? '
+            'AND (expires_at IS NULL OR expires_at > ?)',
+            (namespace, self._key(key), token, time.time()),
+        ).fetchone()
+        return MISSING if row is None else pickle.loads(row[0])
+
+    def set(self, namespace: str, key: Hashable, token: str, value: Any, ttl: Optional[float] = None) -> None:
+        conn = self._conn()
+        conn.execute(
+            'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+            (namespace, self._key(key), token, pickle.dumps(value), time.time() + ttl if ttl else None),
+        )
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self.prune()
+
+    def claim(self, namespace: str, key: Hashable, token: str, ttl: Optional[float] = None) -> bool:
+        """Set the entry to True unless it is set, atomically across
+        processes. Whether this call set it."""
+        conn = self._conn()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(
+                'DELETE FROM entries WHERE namespace = ? AND key = ? AND (token != ? OR expires_at < ?)',
+                (namespace, self._key(key), token, now),
+            )
+            claimed = conn.execute(
+                'INSERT OR IGNORE INTO entries VALUES (?, ?, ?, ?, ?)',
+                (namespace, self._key(key), token, pickle.dumps(True), now + ttl if ttl else None),
+            ).rowcount == 1
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return claimed
+
+    def announce(self, token: str) -> None:
+        """Record that a worker is serving snapshot `token`."""
+        conn = self._conn()
+        conn.execute('INSERT OR IGNORE INTO tokens VALUES (?, ?)', (token, time.time()))
+        self.prune()
+
+    def prune(self) -> None:
+        conn = self._conn()
+        now = time.time()
+        latest = conn.execute('SELECT max(first_seen) FROM tokens').fetchone()[0]
+        if latest is not None and latest < now - self.grace:
+            # every worker had time to move to the latest snapshot
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('DELETE FROM tokens WHERE first_seen < ?', (latest,))
+                conn.execute('DELETE FROM entries WHERE token NOT IN (SELECT token FROM tokens)')
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        conn.execute('DELETE FROM entries WHERE expires_at < ?', (now,))
+        conn.execute(
+            'DELETE FROM entries WHERE rowid <= (SELECT max(rowid) FROM entries) - ?',
+            (self.max_entries,),
+        )
+
+    def retain(self, token: str) -> None:
+        self.announce(token)
+
+    def clear(self) -> None:
+        self._conn().execute('DELETE FROM entries')
+
+    def stats(self) -> dict[str, int]:
+        entries = self._conn().execute('SELECT count(*) FROM entries').fetchone()[0]
+        return {'entries': entries}
+
+
+def cached(cache: Any, namespace: str, key: Hashable, token: str, compute: Callable[[], Any], ttl: Optional[float] = None) -> Any:
+    """`cache.get`, or else `compute()` and store it."""
+    value = cache.get(namespace, key, token)
+    if value is MISSING:
+        value = compute()
+        cache.set(namespace, key, token, value, ttl)
+    return value
@@ -0,0 +1,126 @@
+"""Per-request deadlines, seen by everything the request runs.
+
+The API opens a `deadline` around each request. Model calls shorten their
+timeouts to it and SQLite queries are interrupted by it, through
+`current()`, which follows the request into threads started with
+`contextvars.copy_context().run`. A deadline can also be cancelled, e.g. when
+the client hangs up, which stops the work the same way.
+"""
+from __future__ import annotations
+
+import select
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterator, Optional
+
+
+class DeadlineExceeded(Exception):
+    """The request ran out of time, or was cancelled."""
+
+
+class Deadline:
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._callbacks: list[Callable[[], None]] = []
+
+    def remaining(self) -> float:
+        return 0.0 if self._cancelled else max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    @property
+    def expired(self) -> bool:
+        return self._cancelled or time.monotonic() >= self.expires_at
+
+    def check(self) -> None:
+        if self._cancelled:
+            raise DeadlineExceeded('request cancelled')
+        if time.monotonic() >= self.expires_at:
+            raise DeadlineExceeded('deadline exceeded')
+
+    def cancel(self) -> None:
+        with self._lock:
+            if self._cancelled:
+                return
+            self._cancelled = True
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            callback()
+
+    def on_cancel(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """Call `callback` when cancelled (now, if already). Returns a function
+        that unregisters it."""
+        with self._lock:
+            if not self._cancelled:
+                self._callbacks.append(callback)
+                return lambda: self._unregister(callback)
+        callback()
+        return lambda: None
+
+    def _unregister(self, callback: Callable[[], None]) -> None:
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+
+_current: ContextVar[Optional[Deadline]] = ContextVar('jbot_deadline', default=None)
+
+
+def current() -> Optional[Deadline]:
+    return _current.get()
+
+
+def check() -> None:
+    """Raise `DeadlineExceeded` if the current deadline is over."""
+    deadline = _current.get()
+    if deadline is not None:
+        deadline.check()
+
+
+def remaining(default: float) -> float:
+    """`default` seconds, or fewer if the current deadline is sooner."""
+    deadline = _current.get()
+    return default if deadline is None else min(default, deadline.remaining())
+
+
+@contextmanager
+def deadline(seconds: float) -> Iterator[Deadline]:
+    d = Deadline(seconds)
+    token = _current.set(d)
+    try:
+        yield d
+    finally:
+        _current.reset(token)
+
+
+def watch_disconnect(sock: socket.socket, deadline: Deadline, interval: float = 0.5) -> Callable[[], None]:
+    """Cancel `deadline` if the peer of `sock` hangs up. Call the returned
+    function to stop watching.
+
+    Only works once the request body is read: the socket then stays quiet
+    until the client closes it.
+    """
+    stop = threading.Event()
+
+    def watch() -> None:
+        while not stop.is_set() and not deadline.expired:
+            try:
+                readable, _, _ = select.select([sock], [], [], interval)
+                if not readable:
+                    continue
+                if sock.recv(1, socket.MSG_PEEK) == b'':
+                    deadline.cancel()
+            except (OSError, ValueError):
+                pass
+            # data (a pipelined request) or an error: nothing more to learn
+            return
+
+    threading.Thread(target=watch, name='jbot-disconnect', daemon=True).start()
+    return stop.set
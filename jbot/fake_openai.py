@@ -0,0 +1,238 @@
+"""Local OpenAI-compatible chat completions server for tests and benchmarks.
+
+Replies are produced by a responder function and delayed according to a
+latency profile, with optional injected 429 and 500 errors:
+
+    python -m jbot.fake_openai --port 8089 --latency 0.8 --jitter 0.2 --tail 0.05:6
+
+then point the bot at it with OPENAI_API_BASE=http://127.0.0.1:8089/v1.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Optional
+
+from .sql.tokens import count_tokens
+
+Responder = Callable[[list[dict[str, Any]], str], str]
+
+
+class LatencyProfile:
+    """Base latency plus uniform jitter, and a heavy tail: with probability
+    `tail_probability` the request takes `tail_latency` seconds instead."""
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        tail_probability: float = 0.0,
+        tail_latency: float = 0.0,
+        per_token: float = 0.0,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.tail_probability = tail_probability
+        self.tail_latency = tail_latency
+        self.per_token = per_token
+        """Extra seconds per completion token, like a streaming model."""
+
+    def sample(self, rng: random.Random, completion_tokens: int = 0) -> float:
+        if self.tail_probability and rng.random() < self.tail_probability:
+            base = self.tail_latency
+        else:
+            base = self.latency + rng.uniform(-self.jitter, self.jitter)
+        return max(0.0, base + self.per_token * completion_tokens)
+
+
+_table_re = re.compile(r'CREATE TABLE\s+(\w+)', re.IGNORECASE)
+
+
+def default_responder(messages: list[dict[str, Any]], model: str) -> str:
+    """Replies shaped like the SQL chain expects them: a query when asked to
+    write one, an answer when the conversation already holds a SQLResult."""
+    if not messages:
+        return 'Answer: Não entendi.'
+    last = messages[-1]
+    if last['role'] == 'assistant' or 'SQLResult:' in last['content']:
+        return 'Answer: Aqui está o que encontrei.'
+    tables = _table_re.findall(messages[0]['content'])
+    table = tables[0] if tables else 'sqlite_master'
+    return (
+        'StepByStep: [Listar os registros relevantes]\n'
+        f'SQLQuery: SELECT * FROM {table} LIMIT 5\n'
+    )
+
+
+class FakeOpenAIServer:
+    """Threaded HTTP/1.1 server speaking the `/v1/chat/completions` API.
+
+    `error_rate` and `rate_limit_rate` are the probabilities of answering 500
+    and 429. Counters of served requests are kept in `stats`.
+    """
+
+    def __init__(
+        self,
+        host: str = '127.0.0.1',
+        port: int = 0,
+        latency: Optional[LatencyProfile] = None,
+        responder: Responder = default_responder,
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        seed: Optional[int] = None,
+    ):
+        self.latency = latency or LatencyProfile()
+        self.responder = responder
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.stats = {'requests': 0, 'errors': 0, 'rate_limited': 0, 'disconnected': 0}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+    def _draw(self) -> tuple[float, float]:
+        with self._lock:
+            return self._rng.random(), self._rng.random()
+
+    def _delay(self, completion_tokens: int) -> float:
+        with self._lock:
+            return self.latency.sample(self._rng, completion_tokens)
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self.stats[key] += 1
+
+    def _handler(self) -> type[BaseHTTPRequestHandler]:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+            def _send(self, status: int, body: dict[str, Any]) -> None:
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self) -> None:
+                length = int(self.headers.get('Content-Length') or 0)
+                request = json.loads(self.rfile.read(length) or b'{}')
+                if not self.path.rstrip('/').endswith('/chat/completions'):
+                    self._send(404, {'error': {'message': f'unknown path {self.path}'}})
+                    return
+                server._count('requests')
+                error, limited = server._draw()
+                if limited < server.rate_limit_rate:
+                    server._count('rate_limited')
+                    self._send(429, {'error': {'message': 'Rate limit reached', 'type': 'requests'}})
+                    return
+
+                messages = request.get('messages', [])
+                model = request.get('model', 'gpt-3.5-turbo')
+                content = server.responder(messages, model)
+                for stop in request.get('stop') or ():
+                    content = content.split(stop)[0]
+                prompt_tokens = sum(count_tokens(m.get('content') or '') + 4 for m in messages)
+                completion_tokens = count_tokens(content)
+                time.sleep(server._delay(completion_tokens))
+
+                if error < server.error_rate:
+                    server._count('errors')
+                    self._send(500, {'error': {'message': 'The server had an error'}})
+                    return
+                try:
+                    self._send(200, {
+                        'id': f'chatcmpl-fake{server.stats["requests"]}',
+                        'object': 'chat.completion',
+                        'created': int(time.time()),
+                        'model': model,
+                        'choices': [{
+                            'index': 0,
+                            'message': {'role': 'assistant', 'content': content},
+                            'finish_reason': 'stop',
+                        }],
+                        'usage': {
+                            'prompt_tokens': prompt_tokens,
+                            'completion_tokens': completion_tokens,
+                            'total_tokens': prompt_tokens + completion_tokens,
+                        },
+                    })
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client cancelled, e.g. a losing hedged request
+                    server._count('disconnected')
+
+        return Handler
+
+    def start(self) -> 'FakeOpenAIServer':
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self) -> 'FakeOpenAIServer':
+        return self.start()
+
+    def __exit__(self, *exc: Any) -> None:
+        self.stop()
+
+
+def parse_tail(value: str) -> tuple[float, float]:
+    probability, latency = value.split(':')
+    return float(probability), float(latency)
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m jbot.fake_openai', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.5, help='base latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.1, help='uniform jitter around the base latency')
+    parser.add_argument('--tail', type=parse_tail, default=(0.0, 0.0), metavar='PROB:SECONDS',
+                        help='probability and latency of slow requests')
+    parser.add_argument('--per-token', type=float, default=0.0, help='seconds per completion token')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args(argv)
+
+    server = FakeOpenAIServer(
+        args.host, args.port,
+        latency=LatencyProfile(args.latency, args.jitter, args.tail[0], args.tail[1], args.per_token),
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        seed=args.seed,
+    )
+    print(f'Serving on {server.url}')
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
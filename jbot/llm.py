@@ -0,0 +1,342 @@
+"""OpenAI-compatible chat model with persistent connections and hedged requests."""
+from __future__ import annotations
+
+import http.client
+import json
+import os
+import random
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Optional
+from urllib.parse import urlsplit
+
+from langchain.adapters.openai import convert_dict_to_message, convert_message_to_dict
+from langchain.callbacks.manager import CallbackManagerForLLMRun
+from langchain.chat_models.base import BaseChatModel
+from langchain.schema import BaseMessage, ChatGeneration, ChatResult
+from pydantic import Field
+
+from . import deadline as request_deadline
+
+_RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class LLMRequestError(Exception):
+    def __init__(self, message: str, status: Optional[int] = None, retryable: bool = False):
+        super().__init__(message)
+        self.status = status
+        self.retryable = retryable
+
+
+class _Cancelled(Exception):
+    pass
+
+
+class ConnectionPool:
+    """Keep-alive HTTP(S) connections to a single host.
+
+    Idle connections are reused last-in first-out; at most `max_idle` are
+    kept. Connections that failed or were cancelled are closed, not returned.
+    """
+
+    def __init__(self, base_url: str, max_idle: int = 8):
+        parts = urlsplit(base_url)
+        self.https = parts.scheme == 'https'
+        self.host = parts.hostname or 'localhost'
+        self.port = parts.port or (443 if self.https else 80)
+        self.path = parts.path.rstrip('/')
+        self.max_idle = max_idle
+        self._idle: deque[http.client.HTTPConnection] = deque()
+        self._lock = threading.Lock()
+        self.opened = 0
+
+    def acquire(self, timeout: float) -> http.client.HTTPConnection:
+        with self._lock:
+            if self._idle:
+                conn = self._idle.pop()
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                conn.timeout = timeout
+                return conn
+            self.opened += 1
+        cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        return cls(self.host, self.port, timeout=timeout)
+
+    def release(self, conn: http.client.HTTPConnection) -> None:
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close(self) -> None:
+        with self._lock:
+            while self._idle:
+                self._idle.pop().close()
+
+
+class LatencyTracker:
+    """Rolling window of the latest request latencies of a model."""
+
+    def __init__(self, window: int = 200):
+        self._samples: deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def add(self, latency: float) -> None:
+        with self._lock:
+            self._samples.append(latency)
+
+    def percentile(self, p: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+
+_pools: dict[str, ConnectionPool] = {}
+_trackers: dict[tuple[str, str], LatencyTracker] = {}
+_registry_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix='jbot-llm')
+
+
+def get_pool(base_url: str) -> ConnectionPool:
+    with _registry_lock:
+        pool = _pools.get(base_url)
+        if pool is None:
+            pool = _pools[base_url] = ConnectionPool(base_url)
+        return pool
+
+
+def get_tracker(base_url: str, model: str) -> LatencyTracker:
+    with _registry_lock:
+        tracker = _trackers.get((base_url, model))
+        if tracker is None:
+            tracker = _trackers[(base_url, model)] = LatencyTracker()
+        return tracker
+
+
+class _InFlight:
+    """A request that another thread may cancel by shutting its socket down."""
+
+    def __init__(self):
+        self.conn: Optional[http.client.HTTPConnection] = None
+        self.cancelled = False
+        self._lock = threading.Lock()
+
+    def attach(self, conn: http.client.HTTPConnection) -> None:
+        with self._lock:
+            if self.cancelled:
+                raise _Cancelled()
+            self.conn = conn
+
+    def cancel(self) -> None:
+        with self._lock:
+            self.cancelled = True
+            conn = self.conn
+        if conn is not None and conn.sock is not None:
+            try:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class HedgedChatOpenAI(BaseChatModel):
+    """Chat model for OpenAI-compatible `/chat/completions` endpoints.
+
+    Requests go through a shared pool of keep-alive connections per base URL.
+    When a request takes longer than the `hedge_percentile` of the model's
+    recent latencies, a duplicate request is sent and whichever answers first
+    wins; the other one is cancelled. Failed requests are retried with jittered
+    exponential backoff as long as `request_timeout` allows.
+    """
+
+    model_name: str = Field(default='gpt-3.5-turbo', alias='model')
+    temperature: float = 0.7
+    max_tokens: Optional[int] = None
+    openai_api_key: Optional[str] = None
+    openai_api_base: Optional[str] = None
+    request_timeout: float = 60.0
+    """Deadline for the whole call, retries and hedges included."""
+    max_retries: int = 3
+    backoff_base: float = 0.5
+    backoff_max: float = 8.0
+    hedge_percentile: float = 0.9
+    hedge_min_samples: int = 10
+    """Don't hedge until this many latencies of the model were seen."""
+    hedge: bool = True
+
+    class Config:
+        allow_population_by_field_name = True
+
+    @property
+    def _llm_type(self) -> str:
+        return 'hedged-openai-chat'
+
+    @property
+    def _identifying_params(self) -> dict[str, Any]:
+        return {'model_name': self.model_name, 'temperature': self.temperature, 'base_url': self.base_url}
+
+    @property
+    def base_url(self) -> str:
+        return (
+            self.openai_api_base
+            or os.environ.get('OPENAI_API_BASE')
+            or 'https://api.openai.com/v1'
+        ).rstrip('/')
+
+    @property
+    def latency(self) -> LatencyTracker:
+        return get_tracker(self.base_url, self.model_name)
+
+    def _payload(self, messages: list[BaseMessage], stop: Optional[list[str]], **kwargs: Any) -> dict[str, Any]:
+        payload = {
+            'model': self.model_name,
+            'messages': [convert_message_to_dict(m) for m in messages],
+            'temperature': self.temperature,
+        }
+        if self.max_tokens is not None:
+            payload['max_tokens'] = self.max_tokens
+        if stop:
+            payload['stop'] = stop
+        payload.update(kwargs)
+        return payload
+
+    def _post(self, body: bytes, deadline: float, inflight: _InFlight) -> dict[str, Any]:
+        pool = get_pool(self.base_url)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise LLMRequestError('deadline exceeded')
+        conn = pool.acquire(remaining)
+        reusable = False
+        try:
+            if conn.sock is None:
+                conn.connect()
+                # headers and body go out in separate writes
+                conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            inflight.attach(conn)
+            headers = {'Content-Type': 'application/json', 'Connection': 'keep-alive'}
+            api_key = self.openai_api_key or os.environ.get('OPENAI_API_KEY')
+            if api_key:
+                headers['Authorization'] = f'Bearer {api_key}'
+            conn.request('POST', f'{pool.path}/chat/completions', body=body, headers=headers)
+            response = conn.getresponse()
+            data = response.read()
+            reusable = not response.will_close
+        except (OSError, http.client.HTTPException) as e:
+            if inflight.cancelled:
+                raise _Cancelled() from e
+            raise LLMRequestError(f'{e.__class__.__name__}: {e}', retryable=True) from e
+        finally:
+            if reusable and not inflight.cancelled:
+                pool.release(conn)
+            else:
+                conn.close()
+        if response.status != 200:
+            raise LLMRequestError(
+                f'HTTP {response.status}: {data[:200].decode(errors="replace")}',
+                status=response.status,
+                retryable=response.status in _RETRY_STATUSES,
+            )
+        return json.loads(data)
+
+    def _attempt(self, body: bytes, deadline: float) -> dict[str, Any]:
+        """One request, hedged with a duplicate if it runs longer than usual."""
+        tracker = self.latency
+        threshold = None
+        if self.hedge and len(tracker) >= self.hedge_min_samples:
+            threshold = tracker.percentile(self.hedge_percentile)
+
+        start = time.monotonic()
+        running: dict[Future, _InFlight] = {}
+
+        def launch() -> None:
+            inflight = _InFlight()
+            running[_executor.submit(self._post, body, deadline, inflight)] = inflight
+
+        def cancel() -> None:
+            for inflight in list(running.values()):
+                inflight.cancel()
+
+        launch()
+        hedged = threshold is None
+        error: Optional[BaseException] = None
+        # a cancelled request stops waiting for the model right away
+        request = request_deadline.current()
+        unregister = request.on_cancel(cancel) if request is not None else lambda: None
+        try:
+            while running:
+                timeout = deadline - time.monotonic()
+                if not hedged:
+                    timeout = min(timeout, start + threshold - time.monotonic())
+                done, _ = wait(list(running), timeout=max(0.0, timeout), return_when=FIRST_COMPLETED)
+                if not done:
+                    if hedged:
+                        raise LLMRequestError('deadline exceeded')
+                    hedged = True
+                    launch()
+                    continue
+                for future in done:
+                    running.pop(future)
+                    try:
+                        result = future.result()
+                    except _Cancelled:
+                        continue
+                    except LLMRequestError as e:
+                        error = e
+                        continue
+                    tracker.add(time.monotonic() - start)
+                    return result
+            raise error or LLMRequestError('request cancelled')
+        finally:
+            unregister()
+            cancel()
+
+    def completion_with_retry(self, payload: dict[str, Any]) -> dict[str, Any]:
+        """Raises `DeadlineExceeded` instead when the request's deadline
+        (see `jbot.deadline`) ends the call."""
+        request = request_deadline.current()
+        deadline = time.monotonic() + request_deadline.remaining(self.request_timeout)
+        body = json.dumps(payload).encode()
+        for attempt in range(self.max_retries + 1):
+            try:
+                if request is not None:
+                    request.check()
+                return self._attempt(body, deadline)
+            except LLMRequestError as e:
+                if request is not None and request.expired:
+                    raise request_deadline.DeadlineExceeded(str(e)) from e
+                if not e.retryable or attempt == self.max_retries:
+                    raise
+                # full jitter, never sleeping past the deadline
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+                if time.monotonic() + delay >= deadline:
+                    raise
+                time.sleep(delay)
+        raise AssertionError('unreachable')
+
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: Optional[list[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        response = self.completion_with_retry(self._payload(messages, stop, **kwargs))
+        generations = [
+            ChatGeneration(
+                message=convert_dict_to_message(choice['message']),
+                generation_info={'finish_reason': choice.get('finish_reason')},
+            )
+            for choice in response['choices']
+        ]
+        return ChatResult(
+            generations=generations,
+            llm_output={'token_usage': response.get('usage', {}), 'model_name': self.model_name},
+        )
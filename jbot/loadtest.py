@@ -0,0 +1,356 @@
+"""Load test of the HTTP API.
+
+Drives `/prompt` and `/query` with Poisson arrivals at one or more rates,
+against an `api.py` started on a synthetic database and the bundled fake
+OpenAI server, and reports throughput, latency percentiles, error and 429
+rates and the server's CPU and memory use at each rate:
+
+    python -m jbot.loadtest --rates 1,2,4,8 --duration 30 --latency 0.8 --tail 0.05:6
+
+`--target` points it at an already running server instead.
+"""
+from __future__ import annotations
+
+import argparse
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional
+from urllib.parse import urlsplit
+
+from .bench import load_corpus, summarize
+from .bench import synthetic
+from .fake_openai import FakeOpenAIServer, LatencyProfile, default_responder, parse_tail
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def corpus_responder(corpus: list[dict[str, Any]]):
+    """Fake model answering the benchmark questions with their golden SQL."""
+    golden = [(e['question'], e['sql']) for e in corpus]
+
+    def respond(messages: list[dict[str, Any]], model: str) -> str:
+        last = messages[-1]['content'] if messages else ''
+        if messages and messages[-1]['role'] == 'user':
+            for question, sql in golden:
+                if question in last:
+                    return f'StepByStep: [Consultar o banco]\nSQLQuery: {sql}\n'
+        return default_responder(messages, model)
+
+    return respond
+
+
+class ProcessStats:
+    """CPU time and peak resident memory of a process, sampled from /proc."""
+
+    def __init__(self, pid: int, interval: float = 0.5):
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_threads = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    def cpu_seconds(self) -> Optional[float]:
+        try:
+            with open(f'/proc/{self.pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            return None
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+    def _sample(self) -> None:
+        try:
+            with open(f'/proc/{self.pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        self.peak_rss = max(self.peak_rss, int(line.split()[1]) * 1024)
+                    elif line.startswith('Threads:'):
+                        self.peak_threads = max(self.peak_threads, int(line.split()[1]))
+        except OSError:
+            pass
+
+    def _loop(self) -> None:
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self) -> 'ProcessStats':
+        self._sample()
+        self._thread.start()
+        return self
+
+    def reset(self) -> None:
+        self.peak_rss = self.peak_threads = 0
+        self._sample()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+
+class Workload:
+    """Question templates to send: corpus questions to `/prompt`, their golden
+    SQL to `/query`, mixed with probability `query_share` of a `/query`."""
+
+    def __init__(self, corpus: list[dict[str, Any]], query_share: float = 0.2, chats: int = 50, seed: int = 0):
+        self.corpus = corpus
+        self.query_share = query_share
+        self.chats = chats
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def next(self) -> tuple[str, dict[str, Any]]:
+        with self._lock:
+            entry = self._rng.choice(self.corpus)
+            chat = f'loadtest-{self._rng.randrange(self.chats)}'
+            if self._rng.random() < self.query_share:
+                return '/query', {'query': entry['sql'], 'chat': chat}
+            return '/prompt', {'prompt': entry['question'], 'context': '', 'chat': chat}
+
+
+def _post(target: str, path: str, body: dict[str, Any], timeout: float) -> tuple[int, float]:
+    parts = urlsplit(target)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=timeout)
+    start = time.perf_counter()
+    try:
+        conn.request('POST', path, body=json.dumps(body), headers={'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        response.read()
+        return response.status, time.perf_counter() - start
+    finally:
+        conn.close()
+
+
+def _get(target: str, path: str, timeout: float) -> int:
+    parts = urlsplit(target)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=timeout)
+    try:
+        conn.request('GET', path)
+        response = conn.getresponse()
+        response.read()
+        return response.status
+    finally:
+        conn.close()
+
+
+def run_rate(
+    target: str,
+    workload: Workload,
+    rate: float,
+    duration: float,
+    timeout: float = 60.0,
+    max_inflight: int = 256,
+    seed: int = 0,
+) -> dict[str, Any]:
+    """Open-loop load: requests arrive as a Poisson process of `rate` per
+    second for `duration` seconds, whether or not earlier ones finished.
+    Arrivals beyond `max_inflight` outstanding requests are counted as
+    dropped rather than queued on the client."""
+    rng = random.Random(seed)
+    latencies: dict[str, list[float]] = defaultdict(list)
+    outcomes: dict[str, Counter] = defaultdict(Counter)
+    lock = threading.Lock()
+    inflight = threading.BoundedSemaphore(max_inflight)
+
+    def send(path: str, body: dict[str, Any]) -> None:
+        try:
+            status, seconds = _post(target, path, body, timeout)
+            outcome = 'ok' if status < 400 else str(status)
+        except (OSError, http.client.HTTPException) as e:
+            seconds, outcome = None, 'timeout' if isinstance(e, TimeoutError) else e.__class__.__name__
+        finally:
+            inflight.release()
+        with lock:
+            outcomes[path][outcome] += 1
+            if outcome == 'ok':
+                latencies[path].append(seconds)
+
+    start = time.perf_counter()
+    arrivals = 0
+    with ThreadPoolExecutor(max_workers=max_inflight) as pool:
+        at = start
+        while True:
+            at += rng.expovariate(rate)
+            if at - start >= duration:
+                break
+            time.sleep(max(0.0, at - time.perf_counter()))
+            arrivals += 1
+            path, body = workload.next()
+            if not inflight.acquire(blocking=False):
+                with lock:
+                    outcomes[path]['dropped'] += 1
+                continue
+            pool.submit(send, path, body)
+    elapsed = time.perf_counter() - start
+
+    endpoints = {}
+    for path in sorted(outcomes):
+        total = sum(outcomes[path].values())
+        endpoints[path] = {
+            'requests': total,
+            'outcomes': dict(outcomes[path]),
+            'error_rate': 1 - outcomes[path]['ok'] / total if total else 0.0,
+            'latency': summarize(latencies[path]),
+        }
+    completed = sum(c['ok'] for c in outcomes.values())
+    return {
+        'rate': rate,
+        'arrivals': arrivals,
+        'seconds': elapsed,
+        'throughput': completed / elapsed,
+        'error_rate': 1 - completed / arrivals if arrivals else 0.0,
+        'latency': summarize([s for values in latencies.values() for s in values]),
+        'endpoints': endpoints,
+    }
+
+
+def start_api(db_path: str, port: int, llm_url: str, workdir: str, env: dict[str, str]) -> subprocess.Popen:
+    """Run `api.py` on `port` in a child process, in `workdir` next to its database."""
+    os.symlink(os.path.abspath(db_path), os.path.join(workdir, 'db.sqlite3'))
+    env = dict(
+        os.environ,
+        OPENAI_API_BASE=llm_url,
+        OPENAI_API_KEY=os.environ.get('OPENAI_API_KEY', 'loadtest'),
+        JBOT_EXAMPLES=os.path.join(workdir, 'examples.jsonl'),
+        PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])),
+        **env,
+    )
+    code = f'import api; api.app.run(host="127.0.0.1", port={port}, threaded=True)'
+    log = open(os.path.join(workdir, 'api.log'), 'wb')
+    process = subprocess.Popen(
+        [sys.executable, '-c', code], cwd=workdir, env=env,
+        stdout=log, stderr=subprocess.STDOUT,
+    )
+    log.close()
+    target = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            with open(os.path.join(workdir, 'api.log'), errors='replace') as f:
+                raise RuntimeError(f'api.py exited: {f.read()[-2000:]}')
+        try:
+            if _get(target, '/ready', timeout=5) == 200:
+                return process
+        except OSError:
+            pass
+        time.sleep(0.2)
+    process.kill()
+    raise RuntimeError('api.py did not start in 60s')
+
+
+def _free_port() -> int:
+    import socket
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m jbot.loadtest', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', help='URL of a running api.py (default: start one)')
+    parser.add_argument('--rates', default='1,2,4', help='comma separated arrival rates, requests/s')
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds per rate')
+    parser.add_argument('--query-share', type=float, default=0.2, help='fraction of requests to /query')
+    parser.add_argument('--chats', type=int, default=50, help='distinct chat ids')
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--max-inflight', type=int, default=256)
+    parser.add_argument('--scale', type=float, default=1.0, help='size of the synthetic database')
+    parser.add_argument('--latency', type=float, default=0.5, help='fake model base latency')
+    parser.add_argument('--jitter', type=float, default=0.1)
+    parser.add_argument('--tail', type=parse_tail, default=(0.0, 0.0), metavar='PROB:SECONDS')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='fraction of model calls answered 429')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='extra environment for the started api.py')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the JSON report here')
+    args = parser.parse_args(argv)
+
+    corpus = load_corpus()
+    workload = Workload(corpus, args.query_share, args.chats, args.seed)
+    rates = [float(r) for r in args.rates.split(',')]
+    report: dict[str, Any] = {'config': {k: v for k, v in vars(args).items() if k != 'output'}, 'rates': []}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        llm_server = process = stats = None
+        target = args.target
+        if target is None:
+            llm_server = FakeOpenAIServer(
+                latency=LatencyProfile(args.latency, args.jitter, *args.tail),
+                responder=corpus_responder(corpus),
+                rate_limit_rate=args.rate_limit_rate,
+                seed=args.seed,
+            ).start()
+            db_path = os.path.join(tmp, 'synthetic.sqlite3')
+            synthetic.build(db_path, args.scale, args.seed)
+            workdir = os.path.join(tmp, 'api')
+            os.mkdir(workdir)
+            port = _free_port()
+            process = start_api(db_path, port, llm_server.url, workdir, dict(e.split('=', 1) for e in args.env))
+            target = f'http://127.0.0.1:{port}'
+            stats = ProcessStats(process.pid).start()
+        try:
+            for rate in rates:
+                llm_before = dict(llm_server.stats) if llm_server else None
+                cpu_before = stats.cpu_seconds() if stats else None
+                if stats:
+                    stats.reset()
+                result = run_rate(target, workload, rate, args.duration, args.timeout, args.max_inflight, args.seed)
+                if llm_server:
+                    calls = llm_server.stats['requests'] - llm_before['requests']
+                    limited = llm_server.stats['rate_limited'] - llm_before['rate_limited']
+                    result['llm'] = {
+                        'calls': calls,
+                        'rate_limited': limited,
+                        'rate_limited_rate': limited / calls if calls else 0.0,
+                    }
+                if stats:
+                    cpu = stats.cpu_seconds()
+                    result['server'] = {
+                        'cpu_seconds': cpu - cpu_before if cpu is not None and cpu_before is not None else None,
+                        'cpu_utilization': (cpu - cpu_before) / result['seconds'] if cpu is not None and cpu_before is not None else None,
+                        'peak_rss_bytes': stats.peak_rss,
+                        'peak_threads': stats.peak_threads,
+                    }
+                report['rates'].append(result)
+                _print_rate(result)
+        finally:
+            if stats:
+                stats.stop()
+            if process:
+                process.terminate()
+                process.wait(10)
+            if llm_server:
+                llm_server.stop()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    return 0
+
+
+def _print_rate(result: dict[str, Any]) -> None:
+    latency = result['latency']
+    line = (
+        f'{result["rate"]:>6g}/s  {result["throughput"]:6.2f} done/s  errors {result["error_rate"]:6.1%}'
+    )
+    if latency.get('count'):
+        line += f'  p50 {latency["p50"]:6.2f}s  p90 {latency["p90"]:6.2f}s  p99 {latency["p99"]:6.2f}s'
+    if 'llm' in result:
+        line += f'  429 {result["llm"]["rate_limited_rate"]:5.1%}'
+    server = result.get('server')
+    if server and server['cpu_utilization'] is not None:
+        line += f'  cpu {server["cpu_utilization"]:5.1%}  rss {server["peak_rss_bytes"] / 2 ** 20:.0f}MiB'
+        line += f'  threads {server["peak_threads"]}'
+    print(line, flush=True)
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,28 @@
+"""JSON lines logs of user questions, capped in size.
+
+A log past `max_bytes` is moved to `<path>.1`, replacing the one before, so
+at most twice that is kept on disk. Readers go through both files, older
+first, with `files`.
+"""
+from __future__ import annotations
+
+import os
+
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+
+
+def append(path: str, line: str, max_bytes: int = DEFAULT_MAX_BYTES) -> None:
+    """Append `line` to the log at `path`, rotating it first if it is full.
+    Callers serialize their appends to the same log."""
+    try:
+        if os.path.getsize(path) >= max_bytes:
+            os.replace(path, f'{path}.1')
+    except FileNotFoundError:
+        pass
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(line)
+
+
+def files(path: str) -> list[str]:
+    """The files of the log at `path` that exist, oldest first."""
+    return [p for p in (f'{path}.1', path) if os.path.exists(p)]
@@ -1,27 +1,166 @@
-import dotenv
-from langchain.chat_models import ChatOpenAI
-from langchain.agents import (
-  OpenAIFunctionsAgent,
-  AgentExecutor,
-  create_sql_agent,
-  AgentType
-)
-from langchain.callbacks import get_openai_callback
-from langchain.tools import Tool
-from langchain.schema import SystemMessage
-from langchain.agents.agent_toolkits import SQLDatabaseToolkit
-from .sql.db import SQLDatabase
-import langchain
-from .sql.chain import SQLChain
-from .sql.prompt_gpt4 import DATABASE_DESCRIPTION_COURSES
-import sys
-
-def create_chain():
+import os
+import time
+from typing import Optional
+
+def create_chain(timings: Optional[dict[str, float]] = None):
+  """Build the production chain. Imports are deferred to here so that
+  importing this module stays cheap; `timings`, if given, receives the
+  seconds spent in each step."""
+  timings = timings if timings is not None else {}
+  start = time.perf_counter()
+  def step(name):
+    nonlocal start
+    now = time.perf_counter()
+    timings[name] = now - start
+    start = now
+
+  import dotenv
+  from .cache import LocalCache, SharedCache
+  from .llm import HedgedChatOpenAI
+  from .sql.chain import SQLChain
+  from .sql.cursors import ResultCursorStore
+  from .sql.approximate import SampleStore
+  from .sql.db import SQLDatabase
+  from .sql.examples import ExampleStore
+  from .sql.partitions import SemesterPartitions
+  from .sql.semantic import SemanticCache
+  from .sql.prompt_gpt4 import COLUMN_COMMENTS_COURSES, DATABASE_PREAMBLE_COURSES
+  step('imports')
+
   dotenv.load_dotenv()
+  timeout = float(os.environ.get('JBOT_LLM_TIMEOUT', '60'))
+  def chat_model(model):
+    return HedgedChatOpenAI(temperature=0.5, verbose=True, model=model, request_timeout=timeout)
+
+  llm = chat_model('gpt-4')
+  query_models = os.environ.get('JBOT_QUERY_MODELS', 'gpt-3.5-turbo,gpt-4').split(',')
+  query_llms = [chat_model(m.strip()) for m in query_models if m.strip()]
+  answer_models = os.environ.get('JBOT_ANSWER_MODELS', 'gpt-3.5-turbo,gpt-4').split(',')
+  answer_llms = [chat_model(m.strip()) for m in answer_models if m.strip()]
+  step('llms')
+
+  # JBOT_CACHE: unset for a cache local to the process, the path of a cache
+  # file shared by the workers of `jbot.serve`, or "off"
+  cache_path = os.environ.get('JBOT_CACHE', '')
+  if cache_path == 'off':
+    cache = None
+  elif cache_path:
+    cache = SharedCache(cache_path)
+  else:
+    cache = LocalCache()
+  # JBOT_PROFILE_CATALOG: file keeping the column statistics the database
+  # description takes its example values from, or "off" to sample rows
+  catalog = os.environ.get('JBOT_PROFILE_CATALOG', 'catalog.sqlite3')
+  db_args = {'cache': cache, 'profile_catalog': None if catalog == 'off' else catalog}
+  archive_dir = os.environ.get('JBOT_ARCHIVE_DIR')
+  if archive_dir:
+    db_args['partitions'] = SemesterPartitions(
+      archive_dir,
+      current_semester=os.environ['JBOT_CURRENT_SEMESTER'],
+      tables=['Cursos', 'Disciplinas', 'DisciplinasMatriz', 'Professores', 'OfertasDisciplina', 'AulasOferta'],
+    )
+  # JBOT_APPROXIMATE_COST: rows an aggregate query must be estimated to visit
+  # to be answered from a sample of JBOT_SAMPLE_FRACTION of its largest table,
+  # or "off"
+  approximate_cost = os.environ.get('JBOT_APPROXIMATE_COST', '2000000')
+  approximate_cost = 0 if approximate_cost == 'off' else float(approximate_cost)
+  if approximate_cost > 0:
+    db_args['samples'] = SampleStore(
+      os.environ.get('JBOT_SAMPLES_DIR') or None,
+      fraction=float(os.environ.get('JBOT_SAMPLE_FRACTION', '0.1')),
+      strata={'OfertasDisciplina': 'id_curso', 'AulasOferta': 'dia_semana', 'DisciplinasMatriz': 'id_curso'},
+    )
 
-  llm = ChatOpenAI(temperature=0.5, verbose=True, model='gpt-4')
+  if os.environ.get('JBOT_DB_IN_MEMORY', '1') == '1':
+    db = SQLDatabase.from_sqlite_replica('db.sqlite3', **db_args)
+  else:
+    db = SQLDatabase.from_uri(f'sqlite:///db.sqlite3', **db_args)
+  step('database')
 
-  db = SQLDatabase.from_uri(f'sqlite:///db.sqlite3')
+  # truncated results are paged through from any worker when they share a
+  # cache file
+  cache = db.result_cache
+  cursors = ResultCursorStore(cache.path if isinstance(cache, SharedCache) else None)
+  db.on_invalidate(lambda: cursors.clear(db.cache_token()))
+  # JBOT_EXAMPLES: file of few-shot examples; answered questions are only
+  # added to it with JBOT_EXAMPLES_PERSIST=1, as nobody checks them
+  example_store = ExampleStore(os.environ.get('JBOT_EXAMPLES', 'examples.jsonl'),
+                               persist=os.environ.get('JBOT_EXAMPLES_PERSIST', '0') == '1')
+  step('examples')
 
-  sql_chain = SQLChain(llm=llm, db=db, database_description=DATABASE_DESCRIPTION_COURSES, verbose=True)
+  # JBOT_SEMANTIC_THRESHOLD: similarity from which a question reuses the SQL
+  # of an earlier one, or "off"
+  semantic_threshold = os.environ.get('JBOT_SEMANTIC_THRESHOLD', '0.65')
+  semantic_cache = None
+  if semantic_threshold != 'off':
+    semantic_cache = SemanticCache(threshold=float(semantic_threshold))
+    semantic_cache.add_many(example_store.queries())
+  step('semantic')
+
+  sql_chain = SQLChain(llm=llm, query_llms=query_llms, answer_llms=answer_llms, db=db, database_preamble=DATABASE_PREAMBLE_COURSES, column_comments=COLUMN_COMMENTS_COURSES, cursors=cursors, hard_limit=50, sql_token_budget=400,
+                       example_store=example_store, answer_cache=cache, semantic_cache=semantic_cache,
+                       approximate_cost=approximate_cost, verbose=True)
+  step('chain')
   return sql_chain
+
+def create_sessions():
+  """Build the store of chat histories. JBOT_SESSIONS is the file to keep
+  them in (default: memory only); JBOT_SUMMARY_MODEL, if set, summarizes old
+  turns with that model instead of shortening them."""
+  from .session import SessionStore, llm_summarizer
+  summarizer = None
+  summary_model = os.environ.get('JBOT_SUMMARY_MODEL')
+  if summary_model:
+    from .llm import HedgedChatOpenAI
+    timeout = float(os.environ.get('JBOT_LLM_TIMEOUT', '60'))
+    summarizer = llm_summarizer(HedgedChatOpenAI(temperature=0, model=summary_model, request_timeout=timeout))
+  return SessionStore(
+    os.environ.get('JBOT_SESSIONS') or None,
+    token_budget=int(os.environ.get('JBOT_CONTEXT_TOKENS', '400')),
+    summarizer=summarizer,
+  )
+
+def create_router(chain):
+  """Put `chain` and the other configured tools behind a router.
+  JBOT_MENU_SOURCE (file or URL) adds the restaurant menu, JBOT_NEWS_FEED
+  (RSS URL) the news; JBOT_ROUTER_MODEL picks a tool when the local
+  classifier can't, and JBOT_ROUTER_LOG (off by default, as it holds the
+  users' questions) keeps the decisions to learn from, rotated past
+  JBOT_ROUTER_LOG_MAX_BYTES."""
+  from .logfile import DEFAULT_MAX_BYTES
+  from .router import CoursesTool, MenuTool, NewsTool, Router
+  tools = [CoursesTool(chain, timeout=float(os.environ.get('JBOT_COURSES_TIMEOUT', '120')))]
+  if os.environ.get('JBOT_MENU_SOURCE'):
+    tools.append(MenuTool(os.environ['JBOT_MENU_SOURCE']))
+  if os.environ.get('JBOT_NEWS_FEED'):
+    tools.append(NewsTool(os.environ['JBOT_NEWS_FEED']))
+  llm = None
+  router_model = os.environ.get('JBOT_ROUTER_MODEL', 'gpt-3.5-turbo')
+  if len(tools) > 1 and router_model != 'off':
+    from .llm import HedgedChatOpenAI
+    llm = HedgedChatOpenAI(temperature=0, model=router_model, max_tokens=10,
+                           request_timeout=float(os.environ.get('JBOT_LLM_TIMEOUT', '60')))
+  log_path = os.environ.get('JBOT_ROUTER_LOG', 'off')
+  return Router(tools, llm=llm, log_path=None if log_path == 'off' else log_path,
+                log_max_bytes=int(os.environ.get('JBOT_ROUTER_LOG_MAX_BYTES', str(DEFAULT_MAX_BYTES))))
+
+def create_warmer(chain):
+  """Warm `chain`'s caches from JBOT_REQUEST_LOG (off by default) after
+  startup and snapshot swaps, spending at most JBOT_WARM_TOKENS tokens each
+  time (0 disables)."""
+  budget = int(os.environ.get('JBOT_WARM_TOKENS', '50000'))
+  log_path = os.environ.get('JBOT_REQUEST_LOG', 'off')
+  if budget <= 0 or log_path == 'off':
+    return None
+  from .warm import Warmer
+  return Warmer(chain, log_path, token_budget=budget)
+
+def create_watcher(chain):
+  """Watch the vacancies chats ask to be told about, in the JBOT_WATCHES
+  file (default watches.sqlite3, "off" disables), checking at least every
+  JBOT_WATCH_INTERVAL seconds."""
+  path = os.environ.get('JBOT_WATCHES', 'watches.sqlite3')
+  if path == 'off':
+    return None
+  from .watch import VacancyWatcher, WatchStore
+  return VacancyWatcher(chain.db, WatchStore(path), interval=float(os.environ.get('JBOT_WATCH_INTERVAL', '60')))
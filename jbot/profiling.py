@@ -0,0 +1,211 @@
+"""Sampling profiler for a fraction of the requests.
+
+Each request is profiled with probability `rate`; with a rate of 0 the only
+cost is a comparison. While a profiled request runs, a background thread
+takes the stack of each thread working for it every `interval` seconds,
+through `sys._current_frames`, and counts identical stacks. Stacks are wall
+time: a thread waiting for a model or the database is sampled waiting.
+
+`collapsed` gives the counts in the "collapsed stacks" format, one
+`root;frame;frame count` line per stack, which flamegraph.pl, speedscope
+and inferno turn into flame graphs. Counts are kept per process.
+"""
+from __future__ import annotations
+
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from types import FrameType
+from typing import Any, Callable, Optional, TypeVar
+
+T = TypeVar('T')
+
+# the outermost frames of these modules only show how a thread got to the
+# request (the server loop, the thread pool) and are left out
+_OUTER_MODULES = ('threading', 'socketserver', 'http.server', 'concurrent.futures', 'werkzeug', 'flask', 'contextlib', __name__)
+
+
+class Profiler:
+    """Counts the stacks of the threads working for sampled requests.
+
+    At most `max_stacks` distinct stacks are kept; samples of new stacks past
+    that count as `<root>;[other]`.
+    """
+
+    def __init__(self, rate: float = 0.0, interval: float = 0.005, max_stacks: int = 20000):
+        self.rate = rate
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.requests = 0
+        self.samples = 0
+        self.since = time.time()
+        self._lock = threading.Lock()
+        self._override: Optional[tuple[float, float]] = None
+        # thread id -> (root, number of times attached)
+        self._threads: dict[int, tuple[str, int]] = {}
+        self._stacks: Counter = Counter()
+        self._wake = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+        self._outer_paths: Optional[tuple[str, ...]] = None
+
+    def set_rate(self, rate: float, seconds: Optional[float] = None) -> None:
+        """Sample `rate` of the requests, for `seconds` if given, after which
+        the rate goes back to what it was."""
+        if seconds is None:
+            self.rate = rate
+            self._override = None
+        else:
+            self._override = (rate, time.monotonic() + seconds)
+
+    def current_rate(self) -> float:
+        override = self._override
+        if override is not None:
+            if time.monotonic() < override[1]:
+                return override[0]
+            self._override = None
+        return self.rate
+
+    def start(self, root: str) -> Optional[Any]:
+        """Maybe profile the calling thread under `root`, as sampled by the
+        rate. Returns a token for `stop`, or None if not sampled."""
+        rate = self.rate if self._override is None else self.current_rate()
+        if rate <= 0.0 or (rate < 1.0 and random.random() >= rate):
+            return None
+        with self._lock:
+            self.requests += 1
+        self._attach(root)
+        return _active.set((self, root))
+
+    def stop(self, token: Optional[Any]) -> None:
+        if token is None:
+            return
+        _active.reset(token)
+        self._detach()
+
+    def _attach(self, root: str) -> None:
+        ident = threading.get_ident()
+        with self._lock:
+            _, count = self._threads.get(ident, (root, 0))
+            self._threads[ident] = (root, count + 1)
+            self._wake.set()
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._loop, name='jbot-profiler', daemon=True)
+                self._sampler.start()
+
+    def _detach(self) -> None:
+        ident = threading.get_ident()
+        with self._lock:
+            root, count = self._threads.get(ident, ('', 1))
+            if count > 1:
+                self._threads[ident] = (root, count - 1)
+            else:
+                self._threads.pop(ident, None)
+
+    def _loop(self) -> None:
+        while True:
+            self._wake.wait()
+            with self._lock:
+                threads = {ident: root for ident, (root, _) in self._threads.items()}
+                if not threads:
+                    self._wake.clear()
+                    continue
+            frames = sys._current_frames()
+            stacks = [
+                self._stack(root, frames[ident]) for ident, root in threads.items() if ident in frames
+            ]
+            del frames
+            with self._lock:
+                for stack in stacks:
+                    if stack not in self._stacks and len(self._stacks) >= self.max_stacks:
+                        stack = stack.split(';', 1)[0] + ';[other]'
+                    self._stacks[stack] += 1
+                self.samples += len(stacks)
+            time.sleep(self.interval)
+
+    def _stack(self, root: str, frame: Optional[FrameType]) -> str:
+        outer = self._outer()
+        frames = []
+        while frame is not None:
+            frames.append(frame)
+            frame = frame.f_back
+        frames.reverse()
+        start = 0
+        while start < len(frames) - 1 and frames[start].f_code.co_filename.startswith(outer):
+            start += 1
+        return ';'.join([root, *(_label(f) for f in frames[start:])])
+
+    def _outer(self) -> tuple[str, ...]:
+        if self._outer_paths is None:
+            paths = []
+            for name in _OUTER_MODULES:
+                module = sys.modules.get(name)
+                path = getattr(module, '__file__', None)
+                if path is None:
+                    continue
+                if hasattr(module, '__path__'):
+                    path = os.path.dirname(path) + os.sep
+                paths.append(path)
+            self._outer_paths = tuple(paths)
+        return self._outer_paths
+
+    def collapsed(self) -> list[tuple[str, int]]:
+        """(stack, samples) pairs, most sampled first."""
+        with self._lock:
+            return self._stacks.most_common()
+
+    def report(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                'rate': self.current_rate(),
+                'interval': self.interval,
+                'since': self.since,
+                'requests': self.requests,
+                'samples': self.samples,
+                'stacks': len(self._stacks),
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stacks.clear()
+            self.requests = 0
+            self.samples = 0
+            self.since = time.time()
+
+
+_active: ContextVar[Optional[tuple[Profiler, str]]] = ContextVar('jbot_profile', default=None)
+
+
+def follow(fn: Callable[..., T]) -> Callable[..., T]:
+    """`fn`, profiled with the request it is called for when run in another
+    thread with a copy of the request's context. `fn` itself if the request
+    isn't profiled."""
+    active = _active.get()
+    if active is None:
+        return fn
+    profiler, root = active
+
+    def run(*args: Any, **kwargs: Any) -> T:
+        profiler._attach(root)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profiler._detach()
+
+    return run
+
+
+def _label(frame: FrameType) -> str:
+    code = frame.f_code
+    path = code.co_filename
+    i = path.rfind('site-packages' + os.sep)
+    if i >= 0:
+        path = path[i + len('site-packages') + 1:]
+    elif path.startswith(os.getcwd() + os.sep):
+        path = path[len(os.getcwd()) + 1:]
+    else:
+        path = os.path.basename(path)
+    return f'{code.co_name} ({path}:{code.co_firstlineno})'.replace(';', ',')
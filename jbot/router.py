@@ -0,0 +1,370 @@
+"""Routes each question to the tool that answers it, without asking a model
+when it can be helped.
+
+Keyword rules settle most questions. The rest go to a character n-gram
+classifier trained on the tools' examples and on logged routing decisions,
+and only when it isn't confident either, to a model. Tools share one
+interface, `Tool`, with their own timeout and cache.
+"""
+from __future__ import annotations
+
+import contextvars
+import html
+import json
+import re
+import threading
+import time
+import urllib.request
+import xml.etree.ElementTree as ElementTree
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import TYPE_CHECKING, Any, Iterable, Optional
+
+from pydantic import BaseModel
+
+from . import deadline as request_deadline
+from . import logfile, profiling
+from .cache import MISSING, LocalCache
+from .similarity import char_ngrams, cosine, normalize
+
+if TYPE_CHECKING:
+    from langchain.schema.language_model import BaseLanguageModel
+
+    from .sql.chain import SQLChain
+
+ROUTER_PROMPT = """Escolha a ferramenta que responde à pergunta do usuário. Ferramentas:
+{tools}
+Responda apenas com o nome da ferramenta."""
+
+_executor = ThreadPoolExecutor(max_workers=64, thread_name_prefix='jbot-tool')
+_tag_re = re.compile(r'<[^>]+>')
+_DEADLINE_GRACE = 1.0
+
+
+class ToolTimeout(Exception):
+    pass
+
+
+class ToolResult(BaseModel):
+    response: str
+    sql_query: Optional[str] = None
+    cursor: Optional[str] = None
+    partial: bool = False
+    approximate: bool = False
+    tool: str = ''
+
+
+class Tool:
+    """A source of answers. Subclasses set the class attributes and `run`.
+
+    `keywords` matches normalized questions the tool surely answers, and
+    `examples` seed the classifier. Results are cached for `cache_ttl`
+    seconds (0 disables) under `cache_token()`.
+    """
+
+    name = ''
+    description = ''
+    keywords: Optional[re.Pattern] = None
+    examples: list[str] = []
+    timeout = 30.0
+    cache_ttl = 0.0
+
+    def __init__(self, timeout: Optional[float] = None, cache_ttl: Optional[float] = None):
+        if timeout is not None:
+            self.timeout = timeout
+        if cache_ttl is not None:
+            self.cache_ttl = cache_ttl
+        self.cache = LocalCache(max_entries=1000)
+
+    def run(self, question: str, context: str, chat: Optional[str]) -> ToolResult:
+        raise NotImplementedError
+
+    def cache_token(self) -> str:
+        return ''
+
+    def call(self, question: str, context: str = '', chat: Optional[str] = None) -> ToolResult:
+        """`run` with the cache and the timeout, or the request's deadline if
+        sooner. When the deadline passes, the run is cancelled through it;
+        when the tool's own timeout does, the run keeps going in the
+        background, but its result is dropped."""
+        key = (normalize(question), context)
+        if self.cache_ttl:
+            result = self.cache.get(self.name, key, self.cache_token())
+            if result is not MISSING:
+                return result
+        # the run sees the request's deadline
+        future = _executor.submit(contextvars.copy_context().run, profiling.follow(self.run), question, context, chat)
+        deadline = request_deadline.current()
+        timeout = self.timeout
+        if deadline is not None:
+            # past its deadline, a run returns what it has (see
+            # SQLChain._try_to_answer); give it a moment to
+            timeout = min(timeout, deadline.remaining() + _DEADLINE_GRACE)
+        try:
+            result = future.result(timeout=timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            if deadline is not None and deadline.expired:
+                deadline.cancel()
+                raise request_deadline.DeadlineExceeded('deadline exceeded') from None
+            raise ToolTimeout(f'{self.name} took more than {self.timeout}s') from None
+        result.tool = self.name
+        if self.cache_ttl and result.cursor is None and not result.partial:
+            self.cache.set(self.name, key, self.cache_token(), result, self.cache_ttl)
+        return result
+
+
+def with_context(question: str, context: str) -> str:
+    if not context:
+        return f'Prompt: """{question}"""'
+    return (
+        f'Context (ignore if not relevant to the prompt): """{context}"""\n'
+        f'Prompt: """{question}"""'
+    )
+
+
+class CoursesTool(Tool):
+    """Courses, disciplines, professors and classes, from the database. Cached
+    by the chain's own answer cache, per database snapshot."""
+
+    name = 'cursos'
+    description = 'cursos, disciplinas, professores, turmas, horários de aula, vagas e ementas'
+    keywords = re.compile(
+        r'\b(disciplinas?|materias?|cursos?|professor(es|a|as)?|prof|vagas?|turmas?|aulas?|'
+        r'ementas?|creditos?|matriz|periodos?|codigo|semestre|ofertas?|pre requisitos?|coordenador)\b'
+    )
+    examples = [
+        'quais disciplinas o professor joao ministra',
+        'quantas vagas tem a turma de calculo',
+        'qual o horario de estruturas de dados',
+        'quais materias tem no quinto periodo de computacao',
+        'quem da aula de redes',
+        'qual a ementa de algoritmos',
+    ]
+    timeout = 120.0
+
+    def __init__(self, chain: SQLChain, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.chain = chain
+
+    def run(self, question: str, context: str, chat: Optional[str]) -> ToolResult:
+        outputs = self.chain({
+            'prompt': with_context(question, context), 'chat': chat, 'question': question, 'context': context,
+        })
+        return ToolResult(
+            response=outputs['response'], sql_query=outputs['sql_query'],
+            cursor=outputs['cursor'], partial=outputs['partial'],
+            approximate=outputs.get('approximate', False),
+        )
+
+
+def _fetch(url: str, timeout: float) -> str:
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return response.read().decode(response.headers.get_content_charset() or 'utf-8', 'replace')
+
+
+class MenuTool(Tool):
+    """The university restaurant's menu, read from a file or URL (plain text
+    or HTML)."""
+
+    name = 'cardapio'
+    description = 'cardápio do restaurante universitário (RU): almoço e jantar'
+    keywords = re.compile(r'\b(cardapio|ru|restaurante|bandejao|almoco|almocar|jantar|janta|refeic(ao|oes)|comida)\b')
+    examples = [
+        'o que tem no ru hoje',
+        'qual o cardapio do almoco',
+        'tem carne no jantar',
+        'o que vai ter de comida no restaurante',
+    ]
+    timeout = 10.0
+    cache_ttl = 600.0
+
+    def __init__(self, source: str, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.source = source
+
+    def run(self, question: str, context: str, chat: Optional[str]) -> ToolResult:
+        if re.match(r'https?://', self.source):
+            text = _fetch(self.source, self.timeout)
+        else:
+            with open(self.source, encoding='utf-8') as f:
+                text = f.read()
+        text = html.unescape(_tag_re.sub('\n', text))
+        lines = [line.strip() for line in text.splitlines() if line.strip()]
+        return ToolResult(response='Cardápio do RU:\n' + '\n'.join(lines))
+
+
+class NewsTool(Tool):
+    """News from the university site's RSS feed: the items closest to the
+    question, or the latest ones."""
+
+    name = 'noticias'
+    description = 'notícias, eventos, editais e comunicados da universidade'
+    keywords = re.compile(r'\b(noticias?|novidades?|aconteceu|eventos?|editais|edital|reitor(ia)?|comunicados?)\b')
+    examples = [
+        'quais as ultimas noticias da ufla',
+        'quem e o novo reitor',
+        'saiu algum edital novo',
+        'que eventos vao ter essa semana',
+    ]
+    timeout = 10.0
+    cache_ttl = 900.0
+
+    def __init__(self, feed_url: str, max_items: int = 3, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.feed_url = feed_url
+        self.max_items = max_items
+
+    def run(self, question: str, context: str, chat: Optional[str]) -> ToolResult:
+        root = ElementTree.fromstring(_fetch(self.feed_url, self.timeout))
+        items = [
+            (item.findtext('title', '').strip(), item.findtext('link', '').strip())
+            for item in root.iter('item')
+        ]
+        grams = char_ngrams(question)
+        scored = [(cosine(grams, char_ngrams(title)), i) for i, (title, _) in enumerate(items)]
+        relevant = sorted((s for s in scored if s[0] >= 0.2), reverse=True)
+        chosen = [i for _, i in relevant[:self.max_items]] or list(range(min(self.max_items, len(items))))
+        if not chosen:
+            return ToolResult(response='Não encontrei notícias.')
+        return ToolResult(response='\n'.join(f'- {items[i][0]}: {items[i][1]}' for i in chosen))
+
+
+class NgramClassifier:
+    """Nearest centroid classifier over character n-grams."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._centroids: dict[str, Counter] = {}
+        self._counts: Counter = Counter()
+
+    def __len__(self) -> int:
+        return sum(self._counts.values())
+
+    def add(self, text: str, label: str) -> None:
+        grams = char_ngrams(text)
+        norm = sum(v * v for v in grams.values()) ** 0.5 or 1.0
+        with self._lock:
+            centroid = self._centroids.setdefault(label, Counter())
+            for gram, count in grams.items():
+                centroid[gram] += count / norm
+            self._counts[label] += 1
+
+    def scores(self, text: str) -> list[tuple[str, float]]:
+        """(label, cosine similarity to its centroid), best first."""
+        grams = char_ngrams(text)
+        with self._lock:
+            scored = [(label, cosine(grams, centroid)) for label, centroid in self._centroids.items()]
+        return sorted(scored, key=lambda s: s[1], reverse=True)
+
+
+class Route(BaseModel):
+    tool: str
+    method: str
+    """'only', 'rules', 'classifier', 'llm' or 'default'."""
+    confidence: float
+
+
+class Router:
+    """Picks a tool for each question and calls it.
+
+    Questions matching the keywords of a single tool go to it. Otherwise the
+    classifier picks among the matching tools (or all of them) when its best
+    score is at least `threshold` and `margin` above the next; failing that,
+    `llm` picks, and failing that the classifier's best guess stands. Decisions are appended
+    to `log_path`, if given, rotated past `log_max_bytes` (see
+    `jbot.logfile`), and the ones made by rules or the model train the
+    classifier of the next start.
+    """
+
+    def __init__(
+        self,
+        tools: list[Tool],
+        llm: Optional[BaseLanguageModel] = None,
+        log_path: Optional[str] = None,
+        threshold: float = 0.25,
+        margin: float = 0.05,
+        log_max_bytes: int = logfile.DEFAULT_MAX_BYTES,
+    ):
+        self.tools = {tool.name: tool for tool in tools}
+        self.default = tools[0].name
+        self.llm = llm
+        self.log_path = log_path
+        self.log_max_bytes = log_max_bytes
+        self.threshold = threshold
+        self.margin = margin
+        self.classifier = NgramClassifier()
+        self._log_lock = threading.Lock()
+        for tool in tools:
+            for example in tool.examples:
+                self.classifier.add(example, tool.name)
+        if log_path is not None:
+            for path in logfile.files(log_path):
+                self.train(self.read_log(path))
+
+    @staticmethod
+    def read_log(path: str) -> Iterable[tuple[str, str]]:
+        """(question, tool) pairs worth learning from: decisions made by rules
+        or the model, and any entry with a hand-set `label`."""
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                label = entry.get('label') or (entry['tool'] if entry.get('method') in ('rules', 'llm') else None)
+                if label:
+                    yield entry['question'], label
+
+    def train(self, examples: Iterable[tuple[str, str]]) -> None:
+        for question, label in examples:
+            if label in self.tools:
+                self.classifier.add(question, label)
+
+    def _log(self, question: str, route: Route) -> None:
+        if self.log_path is None:
+            return
+        entry = {'question': question, **route.dict(), 'at': time.time()}
+        with self._log_lock:
+            logfile.append(self.log_path, json.dumps(entry, ensure_ascii=False) + '\n', self.log_max_bytes)
+
+    def _ask_llm(self, question: str, candidates: list[str]) -> Optional[str]:
+        from langchain.schema import HumanMessage, SystemMessage
+
+        tools = '\n'.join(f'- {name}: {self.tools[name].description}' for name in candidates)
+        try:
+            reply = self.llm.predict_messages([
+                SystemMessage(content=ROUTER_PROMPT.format(tools=tools)),
+                HumanMessage(content=question),
+            ]).content
+        except Exception:
+            return None
+        reply = normalize(reply)
+        return next((name for name in candidates if name in reply), None)
+
+    def route(self, question: str) -> Route:
+        if len(self.tools) == 1:
+            return Route(tool=self.default, method='only', confidence=1.0)
+        text = normalize(question)
+        matches = [name for name, tool in self.tools.items() if tool.keywords is not None and tool.keywords.search(text)]
+        if len(matches) == 1:
+            route = Route(tool=matches[0], method='rules', confidence=1.0)
+        else:
+            candidates = matches or list(self.tools)
+            scores = [s for s in self.classifier.scores(question) if s[0] in candidates]
+            best, score = scores[0] if scores else (self.default, 0.0)
+            runner_up = scores[1][1] if len(scores) > 1 else 0.0
+            if score >= self.threshold and score - runner_up >= self.margin:
+                route = Route(tool=best, method='classifier', confidence=score)
+            else:
+                picked = self._ask_llm(question, candidates) if self.llm is not None else None
+                if picked is not None:
+                    route = Route(tool=picked, method='llm', confidence=score)
+                else:
+                    route = Route(tool=best if scores else self.default, method='default', confidence=score)
+        self._log(question, route)
+        return route
+
+    def answer(self, question: str, context: str = '', chat: Optional[str] = None) -> ToolResult:
+        return self.tools[self.route(question).tool].call(question, context, chat)
@@ -0,0 +1,135 @@
+"""Prefork server for the HTTP API.
+
+The master binds the listening socket and forks `--workers` processes that
+accept on it, each running `api.app` with a threaded werkzeug server and its
+own chain. Workers share one cache file (see `jbot.cache.SharedCache`), so an
+answer, SQL result or schema description computed by one is reused by all,
+until the database snapshot changes. Chat histories (`jbot.session`) and
+the cursors of truncated results are shared too, so a "show more" can land
+on any worker:
+
+    python -m jbot.serve --workers 4 --port 5000
+
+Crashed workers are replaced; SIGTERM or SIGINT stops them all.
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import signal
+import socket
+import sys
+import time
+from typing import Optional
+
+
+def _worker(sock: socket.socket, host: str, port: int) -> None:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    # imported after the fork: api starts its init thread on import
+    import api
+    from werkzeug.serving import make_server
+
+    server = make_server(host, port, api.app, threaded=True, fd=sock.fileno())
+    server.serve_forever()
+
+
+def _spawn(sock: socket.socket, host: str, port: int) -> int:
+    pid = os.fork()
+    if pid:
+        return pid
+    code = 0
+    try:
+        _worker(sock, host, port)
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 0
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+        code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m jbot.serve', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--cache', help='shared cache file (default: $JBOT_CACHE or cache.sqlite3)')
+    parser.add_argument('--sessions', help='shared chat history file (default: $JBOT_SESSIONS or sessions.sqlite3)')
+    parser.add_argument('--no-preload', dest='preload', action='store_false',
+                        help='do not import the chain modules before forking')
+    args = parser.parse_args(argv)
+
+    os.environ['JBOT_CACHE'] = args.cache or os.environ.get('JBOT_CACHE') or 'cache.sqlite3'
+    if os.environ['JBOT_CACHE'] != 'off':
+        from .cache import SharedCache
+        # creates the tables once, rather than in every worker at the same time
+        SharedCache(os.environ['JBOT_CACHE'])
+    # a chat's messages may reach any worker, so its history must be shared
+    os.environ['JBOT_SESSIONS'] = args.sessions or os.environ.get('JBOT_SESSIONS') or 'sessions.sqlite3'
+    from .session import SessionStore
+    SessionStore(os.environ['JBOT_SESSIONS'])
+    if os.environ.get('JBOT_WATCHES', 'watches.sqlite3') != 'off':
+        from .watch import WatchStore
+        WatchStore(os.environ.get('JBOT_WATCHES', 'watches.sqlite3'))
+    if args.preload:
+        # modules only, shared copy-on-write; connections, threads and the
+        # chain itself must be created after the fork
+        import jbot.llm  # noqa: F401
+        import jbot.sql.chain  # noqa: F401
+
+    sock = socket.create_server((args.host, args.port), backlog=1024)
+    workers: dict[int, float] = {}
+    stopping = False
+
+    def terminate() -> None:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def stop(signum, frame):
+        # waitpid resumes after signals, so the workers are told here and
+        # their exits end the loop
+        nonlocal stopping
+        stopping = True
+        terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    workers.update({_spawn(sock, args.host, args.port): time.monotonic() for _ in range(args.workers)})
+    print(f'jbot.serve: {args.workers} workers on http://{args.host}:{args.port}', file=sys.stderr)
+    while not stopping:
+        try:
+            pid, status = os.waitpid(-1, 0)
+        except ChildProcessError:
+            break
+        started = workers.pop(pid, None)
+        if started is None or stopping:
+            continue
+        print(f'jbot.serve: worker {pid} exited ({os.waitstatus_to_exitcode(status)}), restarting',
+              file=sys.stderr)
+        if time.monotonic() - started < 1.0:
+            # don't spin on a worker that crashes on startup
+            time.sleep(1.0)
+        workers[_spawn(sock, args.host, args.port)] = time.monotonic()
+
+    terminate()
+    for pid in workers:
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass
+    sock.close()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,282 @@
+"""Per-chat conversation history, kept short enough to go in every prompt.
+
+Each chat keeps its last few turns verbatim. Older turns are folded into a
+running summary one at a time, so the context handed to the chain stays under
+a fixed token budget however long the conversation gets. Questions that look
+self-contained get no context at all.
+"""
+from __future__ import annotations
+
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Callable, Optional
+
+from pydantic import BaseModel
+
+from .similarity import char_ngrams, cosine, normalize
+from .sql.tokens import count_tokens
+
+if TYPE_CHECKING:
+    from langchain.schema.language_model import BaseLanguageModel
+
+_follow_up_re = re.compile(
+    r'^(e|mas|entao|so)\b|\b('
+    r'ele|ela|eles|elas|dele|dela|deles|delas|nele|nela|neles|nelas|'
+    r'isso|isto|esse|essa|esses|essas|desse|dessa|desses|dessas|nesse|nessa|nesses|nessas|'
+    r'deste|desta|neste|nesta|aquele|aquela|daquele|daquela|'
+    r'mesmo|mesma|mesmos|mesmas|anterior|acima|tambem|outro|outra|outros|outras|'
+    r'resto|disso|nisso'
+    r')\b'
+)
+
+SUMMARY_PROMPT = """Resuma a conversa abaixo entre um usuário e um bot que responde sobre cursos, \
+disciplinas e professores. Mantenha só o que pode ser necessário para entender perguntas \
+seguintes: nomes de cursos, disciplinas, professores, códigos, semestres e números citados. \
+Responda apenas com o resumo, em no máximo {max_tokens} tokens."""
+
+
+class Turn(BaseModel):
+    role: str
+    """'user' or 'bot'."""
+    text: str
+
+
+class Session(BaseModel):
+    chat: str
+    summary: str = ''
+    """Folded turns, oldest first."""
+    turns: list[Turn] = []
+    """Recent turns, verbatim."""
+    last_used: float
+
+
+Summarizer = Callable[[str, list[Turn], int], str]
+"""(summary so far, turns to fold in, token budget) -> new summary."""
+
+
+def shorten(text: str, max_tokens: int) -> str:
+    """`text` cut to about `max_tokens` tokens, at a word boundary."""
+    text = ' '.join(text.split())
+    if count_tokens(text) <= max_tokens:
+        return text
+    words = text.split(' ')
+    lo, hi = 0, len(words)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if count_tokens(' '.join(words[:mid])) + 1 <= max_tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    return ' '.join(words[:lo]) + '…'
+
+
+def _label(turn: Turn) -> str:
+    return 'Usuário' if turn.role == 'user' else 'Bot'
+
+
+def extractive_summarizer(line_tokens: int = 40) -> Summarizer:
+    """Summarizes without a model: each folded turn becomes one shortened
+    line, and the oldest lines are dropped to fit the budget."""
+    def summarize(summary: str, turns: list[Turn], max_tokens: int) -> str:
+        lines = summary.splitlines() if summary else []
+        lines += [f'{_label(t)}: {shorten(t.text, line_tokens)}' for t in turns]
+        while len(lines) > 1 and count_tokens('\n'.join(lines)) > max_tokens:
+            lines.pop(0)
+            # whole exchanges, not answers without their question
+            if len(lines) > 1 and lines[0].startswith('Bot: '):
+                lines.pop(0)
+        if len(lines) == 1:
+            lines[0] = shorten(lines[0], max_tokens)
+        return '\n'.join(lines)
+    return summarize
+
+
+def llm_summarizer(llm: BaseLanguageModel, fallback: Optional[Summarizer] = None) -> Summarizer:
+    """Summarizes with `llm`, and with `fallback` (extractive by default)
+    when the call fails."""
+    from langchain.schema import HumanMessage, SystemMessage
+
+    fallback = fallback or extractive_summarizer()
+
+    def summarize(summary: str, turns: list[Turn], max_tokens: int) -> str:
+        conversation = '\n'.join(f'{_label(t)}: {t.text}' for t in turns)
+        if summary:
+            conversation = f'Resumo até aqui:\n{summary}\n\nContinuação:\n{conversation}'
+        try:
+            reply = llm.predict_messages([
+                SystemMessage(content=SUMMARY_PROMPT.format(max_tokens=max_tokens)),
+                HumanMessage(content=conversation),
+            ]).content
+        except Exception:
+            return fallback(summary, turns, max_tokens)
+        return shorten(reply.strip(), max_tokens)
+    return summarize
+
+
+def needs_context(question: str, recent: list[str], threshold: float = 0.3, short_words: int = 4) -> bool:
+    """Whether `question` seems to depend on the `recent` messages.
+
+    Follow-up words ("e", "dele", "essa", "também"...) and very short
+    questions do; otherwise only questions close to a recent message, by
+    character n-gram similarity, do.
+    """
+    if not recent:
+        return False
+    text = normalize(question)
+    if _follow_up_re.search(text) or len(text.split()) <= short_words:
+        return True
+    grams = char_ngrams(question)
+    return any(cosine(grams, char_ngrams(r)) >= threshold for r in recent)
+
+
+class SessionStore:
+    """Conversation history of each chat.
+
+    Sessions keep at most `max_turns` verbatim turns, and no more than
+    `token_budget` tokens of turns and summary, of which the summary takes up
+    to `summary_tokens`. Turns pushed out are folded into the summary with
+    `summarizer`. At most `max_sessions` sessions are kept, least recently
+    used first out, and sessions idle for `idle_timeout` seconds are dropped.
+
+    With `path`, sessions live in a SQLite file instead of memory, so they
+    survive restarts and are shared by the workers of `jbot.serve`.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        max_sessions: int = 1000,
+        idle_timeout: float = 6 * 3600.0,
+        max_turns: int = 6,
+        token_budget: int = 400,
+        summary_tokens: int = 120,
+        quote_tokens: int = 150,
+        summarizer: Optional[Summarizer] = None,
+    ):
+        self.path = path
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.max_turns = max_turns
+        self.token_budget = token_budget
+        self.summary_tokens = summary_tokens
+        self.quote_tokens = quote_tokens
+        self.summarizer = summarizer or extractive_summarizer()
+        self._lock = threading.Lock()
+        self._sessions: OrderedDict[str, Session] = OrderedDict()
+        self._local = threading.local()
+        if path is not None:
+            self._conn().execute(
+                'CREATE TABLE IF NOT EXISTS sessions '
+                '(chat TEXT PRIMARY KEY, data TEXT NOT NULL, last_used REAL NOT NULL)'
+            )
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode = WAL')
+            self._local.conn = conn
+        return conn
+
+    def __len__(self) -> int:
+        if self.path is not None:
+            return self._conn().execute('SELECT count(*) FROM sessions').fetchone()[0]
+        return len(self._sessions)
+
+    def _load(self, chat: str) -> Optional[Session]:
+        if self.path is not None:
+            row = self._conn().execute('SELECT data FROM sessions WHERE chat = ?', (chat,)).fetchone()
+            session = Session.parse_raw(row[0]) if row is not None else None
+        else:
+            session = self._sessions.get(chat)
+        if session is not None and session.last_used < time.time() - self.idle_timeout:
+            return None
+        return session
+
+    def _save(self, session: Session) -> None:
+        if self.path is not None:
+            conn = self._conn()
+            conn.execute(
+                'INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)',
+                (session.chat, session.json(), session.last_used),
+            )
+            conn.execute('DELETE FROM sessions WHERE last_used < ?', (time.time() - self.idle_timeout,))
+            conn.execute(
+                'DELETE FROM sessions WHERE chat IN (SELECT chat FROM sessions '
+                'ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                (self.max_sessions,),
+            )
+            return
+        self._sessions[session.chat] = session
+        self._sessions.move_to_end(session.chat)
+        idle = time.time() - self.idle_timeout
+        while self._sessions and (
+            len(self._sessions) > self.max_sessions
+            or next(iter(self._sessions.values())).last_used < idle
+        ):
+            self._sessions.popitem(last=False)
+
+    def get(self, chat: str) -> Optional[Session]:
+        with self._lock:
+            return self._load(chat)
+
+    def add(self, chat: str, question: str, answer: str) -> None:
+        """Record an exchange, folding the oldest turns into the summary once
+        the session is over budget."""
+        with self._lock:
+            session = self._load(chat) or Session(chat=chat, last_used=time.time())
+        turns = session.turns + [Turn(role='user', text=question), Turn(role='bot', text=answer)]
+        fold = []
+        while len(turns) > 2 and (
+            len(turns) > self.max_turns
+            or sum(count_tokens(t.text) for t in turns) > self.token_budget - self.summary_tokens
+        ):
+            fold.append(turns.pop(0))
+        summary = session.summary
+        if fold:
+            # done outside the lock, as it may call a model
+            summary = self.summarizer(summary, fold, self.summary_tokens)
+        with self._lock:
+            self._save(Session(chat=chat, summary=summary, turns=turns, last_used=time.time()))
+
+    def clear(self, chat: str) -> None:
+        with self._lock:
+            if self.path is not None:
+                self._conn().execute('DELETE FROM sessions WHERE chat = ?', (chat,))
+            else:
+                self._sessions.pop(chat, None)
+
+    def context(self, chat: Optional[str], question: str, quoted: Optional[str] = None) -> str:
+        """Context for `question`, in at most `token_budget` tokens.
+
+        A `quoted` message is always included. The history is included when
+        the question seems to depend on it (see `needs_context`): as many of
+        the latest turns as fit, and the summary if there is room left.
+        """
+        parts = []
+        budget = self.token_budget
+        if quoted:
+            quote = shorten(quoted, self.quote_tokens)
+            parts.append(f'Mensagem citada: {quote}')
+            budget -= count_tokens(parts[0])
+        session = self.get(chat) if chat is not None else None
+        if session is None or not needs_context(question, [t.text for t in session.turns[-2:]]):
+            return '\n'.join(parts)
+
+        lines = []
+        for turn in reversed(session.turns):
+            line = f'{_label(turn)}: {turn.text}'
+            tokens = count_tokens(line)
+            if tokens > budget:
+                line = shorten(line, budget)
+                tokens = count_tokens(line)
+                if tokens > budget or budget < 10:
+                    break
+            lines.insert(0, line)
+            budget -= tokens
+        if session.summary and count_tokens(session.summary) <= budget:
+            lines.insert(0, f'Resumo da conversa:\n{session.summary}\nÚltimas mensagens:')
+        return '\n'.join(lines + parts)
@@ -0,0 +1,97 @@
+"""Local text similarity over character n-grams, no external services."""
+from __future__ import annotations
+
+import math
+import re
+import threading
+import unicodedata
+from collections import Counter
+from typing import Generic, Hashable, Iterable, Optional, TypeVar
+
+K = TypeVar('K', bound=Hashable)
+
+_space_re = re.compile(r'[^\w]+')
+
+
+def normalize(text: str) -> str:
+    """Lowercase, strip accents and collapse punctuation into single spaces."""
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return _space_re.sub(' ', text).strip()
+
+
+def char_ngrams(text: str, sizes: Iterable[int] = (3, 4)) -> Counter:
+    """Character n-grams of the normalized text, words padded with spaces."""
+    padded = f' {normalize(text)} '
+    grams: Counter = Counter()
+    for n in sizes:
+        for i in range(len(padded) - n + 1):
+            grams[padded[i:i + n]] += 1
+    return grams
+
+
+def cosine(a: dict[str, float], b: dict[str, float]) -> float:
+    if len(a) > len(b):
+        a, b = b, a
+    dot = sum(v * b.get(k, 0.0) for k, v in a.items())
+    if not dot:
+        return 0.0
+    norm = math.sqrt(sum(v * v for v in a.values())) * math.sqrt(sum(v * v for v in b.values()))
+    return dot / norm
+
+
+class NgramIndex(Generic[K]):
+    """Brute-force TF-IDF index of short texts for nearest neighbour lookups.
+
+    Document frequencies are updated as texts are added, and document vectors
+    are weighted lazily at query time, so adding is cheap.
+    """
+
+    def __init__(self, sizes: Iterable[int] = (3, 4)):
+        self.sizes = tuple(sizes)
+        self._lock = threading.Lock()
+        self._docs: dict[K, Counter] = {}
+        self._df: Counter = Counter()
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._docs
+
+    def add(self, key: K, text: str) -> None:
+        grams = char_ngrams(text, self.sizes)
+        with self._lock:
+            if key in self._docs:
+                self._df.subtract(self._docs[key].keys())
+            self._docs[key] = grams
+            self._df.update(grams.keys())
+
+    def remove(self, key: K) -> None:
+        with self._lock:
+            grams = self._docs.pop(key, None)
+            if grams is not None:
+                self._df.subtract(grams.keys())
+
+    def _weights(self, grams: Counter, n_docs: int) -> dict[str, float]:
+        return {
+            g: (1 + math.log(tf)) * math.log((1 + n_docs) / (1 + self._df.get(g, 0)))
+            for g, tf in grams.items()
+        }
+
+    def search(self, text: str, k: int = 5, min_score: float = 0.0, keys: Optional[Iterable[K]] = None) -> list[tuple[K, float]]:
+        """Return up to `k` (key, cosine similarity) pairs, best first."""
+        query_grams = char_ngrams(text, self.sizes)
+        with self._lock:
+            n_docs = len(self._docs)
+            query = self._weights(query_grams, n_docs)
+            candidates = self._docs.items() if keys is None else (
+                (key, self._docs[key]) for key in keys if key in self._docs
+            )
+            scored = [
+                (key, cosine(query, self._weights(grams, n_docs)))
+                for key, grams in candidates
+            ]
+        scored = [s for s in scored if s[1] >= min_score]
+        scored.sort(key=lambda s: s[1], reverse=True)
+        return scored[:k]
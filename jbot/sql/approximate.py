@@ -0,0 +1,401 @@
+"""Approximate answers to expensive aggregate queries.
+
+`plan_cost` estimates how many rows a SQLite query visits from its `EXPLAIN
+QUERY PLAN` and the table statistics: the rows of each loop of a join
+multiply, and an index lookup visits the average number of rows per key
+that `ANALYZE` recorded in `sqlite_stat1`.
+
+Queries that would visit too many rows and only count, sum or average can
+instead run over a sample of their largest table. `SampleStore` keeps, per
+data snapshot, a stratified sample of each table in a SQLite file of its
+own, with the table's schema and indexes; queries read it through an
+ATTACHed alias. Counts and sums are scaled by the sampling fraction and
+labeled with the margin of error of their first row.
+"""
+from __future__ import annotations
+
+import math
+import os
+import re
+import tempfile
+import threading
+from typing import Any, Optional
+
+from pydantic import BaseModel
+
+SAMPLE_ALIAS = 'jbot_amostra'
+SAMPLED_COUNT = 'jbot_amostra_linhas'
+# z for a 95% confidence interval
+_Z = 1.96
+# rows an index lookup is assumed to visit without statistics
+_DEFAULT_LOOKUP_ROWS = 10
+
+_plan_re = re.compile(r'^(SCAN|SEARCH)\s+(?:TABLE\s+)?(\S+)(?:\s+AS\s+(\S+))?(.*)$')
+_index_re = re.compile(r'USING (?:COVERING )?INDEX (\S+) \((.*)\)')
+_source_re = re.compile(
+    r'\b(?:FROM|JOIN)\s+["`\[]?(\w+)["`\]]?(?:\s+(?:AS\s+)?["`\[]?(\w+)["`\]]?)?',
+    re.IGNORECASE,
+)
+_keywords = {
+    'where', 'join', 'inner', 'left', 'right', 'full', 'outer', 'cross', 'natural', 'on', 'using',
+    'group', 'order', 'limit', 'having', 'union', 'except', 'intersect', 'window', 'as',
+}
+_create_table_re = re.compile(r'^\s*CREATE\s+TABLE\s+(?:"[^"]+"|`[^`]+`|\[[^\]]+\]|\S+)', re.IGNORECASE)
+_create_index_re = re.compile(
+    r'^\s*CREATE\s+(UNIQUE\s+)?INDEX\s+(?:"([^"]+)"|`([^`]+)`|\[([^\]]+)\]|(\S+))', re.IGNORECASE
+)
+_select_re = re.compile(r'\bSELECT\b', re.IGNORECASE)
+_unsupported_re = re.compile(r'\b(?:HAVING|OVER|WINDOW|UNION|EXCEPT|INTERSECT)\b', re.IGNORECASE)
+_distinct_re = re.compile(r'^\s*(?:DISTINCT|ALL)\b', re.IGNORECASE)
+_aggregate_re = re.compile(r'\b(count|sum|total|avg|min|max|group_concat|string_agg)\s*\(', re.IGNORECASE)
+_scaled_re = re.compile(r'^(count|sum|total)\s*\((?!\s*DISTINCT\b)(.*)\)$', re.IGNORECASE | re.DOTALL)
+_alias_re = re.compile(r'^(.*?)(?:\s+AS)?\s+["`\[]?\w+["`\]]?$', re.IGNORECASE | re.DOTALL)
+
+
+class QueryCost(BaseModel):
+    rows: float
+    """Rows the query is estimated to visit."""
+    tables: dict[str, int]
+    """Rows of each table the plan reads, by name."""
+    references: dict[str, int]
+    """How many times the plan reads each table."""
+
+
+class Approximation(BaseModel):
+    table: str
+    rows: int
+    """Rows of `table`."""
+    sampled: int
+    """Rows of its sample."""
+    cost: float
+    margin: float
+    """Relative margin of error of the first row, at 95% confidence."""
+
+    @property
+    def fraction(self) -> float:
+        return self.sampled / self.rows if self.rows else 1.0
+
+    def describe(self) -> str:
+        return (
+            f'NOTE: approximate result, computed on a {self.fraction:.0%} sample of {self.table}; '
+            f'counts and sums are estimates (±{self.margin:.0%} at 95% confidence).'
+        )
+
+
+class Sample(BaseModel):
+    table: str
+    path: str
+    rows: int
+    sampled: int
+
+
+def sources(command: str) -> dict[str, str]:
+    """Tables read in the FROM and JOIN clauses of `command`, by the name
+    (alias or table) the query plan shows."""
+    names = {}
+    for table, alias in _source_re.findall(command):
+        if alias and alias.lower() not in _keywords:
+            names[alias] = table
+        names.setdefault(table, table)
+    return names
+
+
+def tables_read(command: str) -> list[str]:
+    """Tables in the FROM and JOIN clauses of `command`, once per mention."""
+    return [table for table, _ in _source_re.findall(command)]
+
+
+def _lookup_rows(detail: str, table_rows: int, index_stats: dict[str, list[int]]) -> float:
+    if 'PRIMARY KEY' in detail or 'rowid=' in detail:
+        return 1.0
+    m = _index_re.search(detail)
+    if m is None:
+        return min(table_rows, _DEFAULT_LOOKUP_ROWS)
+    stats = index_stats.get(m.group(1))
+    equalities = m.group(2).count('=?')
+    if stats and 0 < equalities < len(stats):
+        rows = float(stats[equalities])
+    else:
+        rows = min(table_rows, _DEFAULT_LOOKUP_ROWS)
+    # ranges and IS NULL narrow down less than equalities
+    if '>' in m.group(2) or '<' in m.group(2):
+        rows = max(rows, table_rows / 4)
+    return rows
+
+
+def plan_cost(
+    plan: list[tuple], command: str, table_rows: dict[str, int], index_stats: dict[str, list[int]]
+) -> QueryCost:
+    """Cost of the `EXPLAIN QUERY PLAN` rows `plan` of `command`.
+
+    `table_rows` has the rows of each table and `index_stats` the
+    `sqlite_stat1` numbers of each index. Names the plan shows that aren't
+    tables (subqueries, CTEs) are taken to hold as many rows as the
+    subquery run last produced.
+    """
+    names = sources(command)
+    children: dict[int, list[tuple]] = {}
+    for node_id, parent, _, detail in plan:
+        children.setdefault(parent, []).append((node_id, detail))
+    tables: dict[str, int] = {}
+    references: dict[str, int] = {}
+    largest = max(table_rows.values(), default=0)
+    last_output = [1.0]
+
+    def cost(parent: int) -> tuple[float, float]:
+        loops, total = 1.0, 0.0
+        for node_id, detail in children.get(parent, []):
+            m = _plan_re.match(detail)
+            if m is not None:
+                name = m.group(3) or m.group(2)
+                table = names.get(name, m.group(2))
+                if table in table_rows:
+                    rows = table_rows[table]
+                    tables[table] = rows
+                    references[table] = references.get(table, 0) + 1
+                elif name.startswith('(') or name in names:
+                    rows = last_output[0]
+                else:
+                    rows = largest
+                if m.group(1) == 'SEARCH':
+                    rows = _lookup_rows(m.group(4), rows, index_stats)
+                loops *= max(rows, 1.0)
+                total += loops
+            elif node_id in children:
+                sub_total, sub_output = cost(node_id)
+                last_output[0] = sub_output
+                total += loops * sub_total if detail.startswith('CORRELATED') else sub_total
+            elif detail.startswith('USE TEMP B-TREE'):
+                total += loops
+        return total, loops
+
+    rows, _ = cost(0)
+    return QueryCost(rows=rows, tables=tables, references=references)
+
+
+def _split_top_level(text: str) -> list[str]:
+    parts, depth, start, quote = [], 0, 0, None
+    for i, c in enumerate(text):
+        if quote is not None:
+            if c == quote:
+                quote = None
+        elif c in '\'"`':
+            quote = c
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            parts.append(text[start:i])
+            start = i + 1
+    parts.append(text[start:])
+    return [p.strip() for p in parts]
+
+
+def _select_list(command: str) -> Optional[tuple[int, int]]:
+    """Start and end of the select list of a single SELECT."""
+    m = _select_re.search(command)
+    if m is None:
+        return None
+    depth, quote = 0, None
+    for i in range(m.end(), len(command)):
+        c = command[i]
+        if quote is not None:
+            if c == quote:
+                quote = None
+        elif c in '\'"`':
+            quote = c
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif depth == 0 and re.match(r'FROM\b', command[i:i + 5], re.IGNORECASE) and not (command[i - 1].isalnum() or command[i - 1] == '_'):
+            return m.end(), i
+    return None
+
+
+def approximable(command: str) -> Optional[list[bool]]:
+    """Which columns of `command` are scaled by the sampling fraction, or
+    None if it can't be answered from a sample.
+
+    Only a single SELECT of group keys and plain counts, sums and averages
+    qualifies: distinct counts, minimums, maximums and HAVING filters of a
+    sample say little about the whole table.
+    """
+    if len(_select_re.findall(command)) != 1 or _unsupported_re.search(command):
+        return None
+    span = _select_list(command)
+    if span is None:
+        return None
+    items = command[span[0]:span[1]]
+    if _distinct_re.match(items):
+        return None
+    scaled = []
+    for item in _split_top_level(items):
+        if item == '*' or item.endswith('.*'):
+            return None
+        aggregates = [a.lower() for a in _aggregate_re.findall(item)]
+        if not aggregates or set(aggregates) == {'avg'}:
+            scaled.append(False)
+            continue
+        expression = item
+        if _scaled_re.match(expression) is None:
+            m = _alias_re.match(item)
+            expression = m.group(1).strip() if m is not None else item
+        m = _scaled_re.match(expression)
+        if m is None or _aggregate_re.search(m.group(2)):
+            return None
+        scaled.append(True)
+    if not any(scaled):
+        return None
+    return scaled
+
+
+def with_sampled_count(command: str) -> str:
+    """`command` also selecting how many sampled rows went into each row."""
+    _, end = _select_list(command)
+    return f'{command[:end].rstrip()}, count(*) AS {SAMPLED_COUNT} {command[end:]}'
+
+
+def on_sample(command: str, table: str) -> str:
+    """`command` reading `table` from its attached sample."""
+    pattern = re.compile(rf'\b(FROM|JOIN)\s+["`\[]?{re.escape(table)}["`\]]?(?=\W|$)', re.IGNORECASE)
+    return pattern.sub(lambda m: f'{m.group(1)} {SAMPLE_ALIAS}."{table}"', command)
+
+
+def scale(rows: list[tuple], scaled: list[bool], factor: float) -> list[tuple]:
+    """Counts and sums of `rows` scaled by `factor`, integers kept integers."""
+    def value(v: Any, is_scaled: bool) -> Any:
+        if not is_scaled or v is None:
+            return v
+        if isinstance(v, int):
+            return int(round(v * factor))
+        return v * factor
+
+    return [tuple(value(v, s) for v, s in zip(row, scaled)) for row in rows]
+
+
+def margin(sampled: int, fraction: float) -> float:
+    """Relative margin of error, at 95%, of a count of `sampled` rows drawn
+    from a sample of `fraction` of the table."""
+    if sampled <= 0:
+        return math.inf
+    return _Z * math.sqrt(max(0.0, 1.0 - fraction) / sampled)
+
+
+class SampleStore:
+    """Stratified samples of the tables, one SQLite file per table and data
+    snapshot.
+
+    Each sample keeps `fraction` of the rows of every group of equal values
+    of the table's `strata` column (at least one row per group), picked at
+    random, so small groups (a course, a weekday) are still represented.
+    Tables with fewer than `min_rows` rows are never sampled, and results
+    whose first row comes from fewer than `min_group` sampled rows are
+    computed exactly instead. Samples are built when first needed and shared
+    by the processes using the same `directory`.
+    """
+
+    def __init__(
+        self,
+        directory: Optional[str] = None,
+        fraction: float = 0.1,
+        strata: Optional[dict[str, str]] = None,
+        min_rows: int = 10000,
+        min_group: int = 10,
+    ):
+        if not 0.0 < fraction < 1.0:
+            raise ValueError('fraction must be between 0 and 1')
+        self.directory = directory or os.path.join(tempfile.gettempdir(), 'jbot-samples')
+        self.fraction = fraction
+        self.strata = dict(strata or {})
+        self.min_rows = min_rows
+        self.min_group = min_group
+        self._samples: dict[tuple[str, str], Sample] = {}
+        self._lock = threading.Lock()
+
+    def path(self, table: str, token: str) -> str:
+        return os.path.join(self.directory, f'{token[:16]}-{table}-{self.fraction:g}.sqlite3')
+
+    def sample(self, engine: Any, table: str, token: str) -> Sample:
+        """The sample of `table` for the snapshot `token`, built if needed
+        from the database of `engine`."""
+        key = (table, token)
+        with self._lock:
+            sample = self._samples.get(key)
+            if sample is None:
+                sample = self._load(engine, table, token) or self._build(engine, table, token)
+                for stale in [k for k in self._samples if k[0] == table]:
+                    del self._samples[stale]
+                self._samples[key] = sample
+        return sample
+
+    def _load(self, engine: Any, table: str, token: str) -> Optional[Sample]:
+        path = self.path(table, token)
+        if not os.path.exists(path):
+            return None
+        with engine.connect() as connection:
+            connection.exec_driver_sql(f'ATTACH DATABASE ? AS "{SAMPLE_ALIAS}"', (path,))
+            try:
+                rows, sampled = connection.exec_driver_sql(
+                    f'SELECT linhas, amostra FROM "{SAMPLE_ALIAS}".jbot_amostra_info'
+                ).one()
+            finally:
+                connection.exec_driver_sql(f'DETACH DATABASE "{SAMPLE_ALIAS}"')
+        return Sample(table=table, path=path, rows=rows, sampled=sampled)
+
+    def _build(self, engine: Any, table: str, token: str) -> Sample:
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(table, token)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        alias = f'{SAMPLE_ALIAS}_nova'
+        stratum = f'"{self.strata[table]}"' if table in self.strata else 'NULL'
+        with engine.connect() as connection:
+            connection.exec_driver_sql(f'ATTACH DATABASE ? AS "{alias}"', (tmp,))
+            try:
+                ddl, = connection.exec_driver_sql(
+                    "SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = ?", (table,)
+                ).one()
+                connection.exec_driver_sql(_create_table_re.sub(f'CREATE TABLE "{alias}"."{table}"', ddl, count=1))
+                connection.exec_driver_sql(
+                    f'INSERT INTO "{alias}"."{table}" SELECT * FROM main."{table}" WHERE rowid IN ('
+                    f'SELECT rowid FROM (SELECT rowid, '
+                    f'ROW_NUMBER() OVER (PARTITION BY {stratum} ORDER BY random()) AS i, '
+                    f'COUNT(*) OVER (PARTITION BY {stratum}) AS n FROM main."{table}") '
+                    f'WHERE i <= max(1, round(n * ?)))',
+                    (self.fraction,),
+                )
+                indexes = connection.exec_driver_sql(
+                    "SELECT sql FROM main.sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+                    (table,),
+                ).all()
+                for index_sql, in indexes:
+                    connection.exec_driver_sql(_create_index_re.sub(
+                        lambda m: f'CREATE {m.group(1) or ""}INDEX "{alias}"."{next(g for g in m.groups()[1:] if g)}"',
+                        index_sql, count=1,
+                    ))
+                connection.exec_driver_sql(f'ANALYZE "{alias}"')
+                rows, = connection.exec_driver_sql(f'SELECT count(*) FROM main."{table}"').one()
+                sampled, = connection.exec_driver_sql(f'SELECT count(*) FROM "{alias}"."{table}"').one()
+                connection.exec_driver_sql(f'CREATE TABLE "{alias}".jbot_amostra_info (linhas INT, amostra INT)')
+                connection.exec_driver_sql(f'INSERT INTO "{alias}".jbot_amostra_info VALUES (?, ?)', (rows, sampled))
+                connection.commit()
+            except BaseException:
+                connection.rollback()
+                raise
+            finally:
+                connection.exec_driver_sql(f'DETACH DATABASE "{alias}"')
+        os.replace(tmp, path)
+        for name in os.listdir(self.directory):
+            if name.endswith(f'-{table}-{self.fraction:g}.sqlite3') and os.path.join(self.directory, name) != path:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+        return Sample(table=table, path=path, rows=rows, sampled=sampled)
+
+    def attach(self, connection: Any, sample: Sample) -> None:
+        connection.exec_driver_sql(f'ATTACH DATABASE ? AS "{SAMPLE_ALIAS}"', (sample.path,))
+
+    def detach(self, connection: Any) -> None:
+        connection.exec_driver_sql(f'DETACH DATABASE "{SAMPLE_ALIAS}"')
@@ -0,0 +1,104 @@
+"""Escalation rules and statistics for cascading query generation models."""
+from __future__ import annotations
+
+import re
+import threading
+from collections import Counter, defaultdict
+from typing import Any, Iterable, Optional
+
+_statement_re = re.compile(r'^\s*(SELECT|WITH)\b', re.IGNORECASE)
+_table_ref_re = re.compile(r'\b(?:FROM|JOIN)\s+["`\[]?(\w+)', re.IGNORECASE)
+_cte_re = re.compile(r'(?:\bWITH|,)\s*(\w+)\s+AS\s*\(', re.IGNORECASE)
+# names are free text: `nome_disc = 'redes'` misses "Redes de Computadores",
+# while codes and weekdays (`id_disc = 'GCC125'`) are meant to match exactly
+_name_equality_re = re.compile(
+    r"""(?:\w+\.)?["`\[]?nome_\w*["`\]]?\s*(?:==|=)\s*'[^']*'""", re.IGNORECASE
+)
+# queries no model gets to run, not even on the last attempt
+BLOCKING = frozenset({'not a SELECT query', 'more than one statement'})
+
+_existence_re = re.compile(
+    r'\b(existe|existem|tem\s+algu\w*|h[aá]\s+algu\w*|alguma?|algum|ainda\s+tem|is\s+there|are\s+there|any)\b',
+    re.IGNORECASE,
+)
+_hedging_re = re.compile(
+    r'\b(not\s+sure|unclear|assum\w*|i\s+guess|n[aã]o\s+tenho\s+certeza|suponho|talvez)\b',
+    re.IGNORECASE,
+)
+
+
+def validate_sql(query: str, tables: Iterable[str]) -> Optional[str]:
+    """Check a generated query locally, before running it.
+
+    Returns why the query is invalid, or None if it looks fine. Reasons in
+    `BLOCKING` mean it must not run at all.
+    """
+    if not _statement_re.match(query):
+        return 'not a SELECT query'
+    if ';' in query.strip().rstrip(';'):
+        return 'more than one statement'
+    known = {t.lower() for t in tables} | {c.lower() for c in _cte_re.findall(query)}
+    unknown = {t for t in _table_ref_re.findall(query) if t.lower() not in known}
+    # FROM also appears in functions like SUBSTR(x FROM 1), only flag identifiers
+    # that look like table names
+    unknown = {t for t in unknown if not t.isdigit()}
+    if unknown:
+        return f'unknown tables {sorted(unknown)}'
+    return None
+
+
+def low_confidence(step_by_step: Optional[str], query: Optional[str], answer: Optional[str]) -> Optional[str]:
+    """Heuristics on the model output that suggest a stronger model would do better."""
+    if query is None and not answer:
+        return 'malformed response'
+    if query is not None and _name_equality_re.search(query):
+        return 'compares a name with ='
+    if step_by_step and _hedging_re.search(step_by_step):
+        return 'hedged reasoning'
+    return None
+
+
+def expects_rows(question: str) -> bool:
+    """Whether an empty result is suspicious for this question.
+
+    Existence questions ("ainda tem vaga em ...?") can legitimately be empty.
+    """
+    return not _existence_re.search(question)
+
+
+def model_name(llm: Any) -> str:
+    return getattr(llm, 'model_name', None) or getattr(llm, 'model', None) or llm.__class__.__name__
+
+
+class CascadeStats:
+    """Per-tier counters: how often each model's output was accepted and how
+    long generation took."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._attempts: Counter = Counter()
+        self._accepted: Counter = Counter()
+        self._latency: Counter = Counter()
+        self._reasons: dict[str, Counter] = defaultdict(Counter)
+
+    def record(self, tier: str, latency: float, escalation: Optional[str]) -> None:
+        with self._lock:
+            self._attempts[tier] += 1
+            self._latency[tier] += latency
+            if escalation is None:
+                self._accepted[tier] += 1
+            else:
+                self._reasons[tier][escalation.split(' [')[0]] += 1
+
+    def report(self) -> dict[str, dict[str, Any]]:
+        with self._lock:
+            return {
+                tier: {
+                    'attempts': attempts,
+                    'accepted': self._accepted[tier],
+                    'hit_rate': self._accepted[tier] / attempts,
+                    'avg_latency': self._latency[tier] / attempts,
+                    'escalations': dict(self._reasons[tier]),
+                }
+                for tier, attempts in self._attempts.items()
+            }
@@ -2,11 +2,20 @@ from langchain.chains.base import Chain
 from langchain.schema.language_model import BaseLanguageModel
 from langchain.callbacks.manager import CallbackManagerForChainRun
 from langchain.schema import SystemMessage, AIMessage, HumanMessage, BaseMessage
-from typing import Any, Optional
+from typing import Any, Callable, Optional
 from . import prompt_gpt4 as prompt
+from .. import deadline as request_deadline
+from .approximate import Approximation
+from ..cache import MISSING
+from .cascade import BLOCKING, CascadeStats, expects_rows, low_confidence, model_name, validate_sql
+from .cursors import ResultCursorStore
 from .db import SQLDatabase
+from .examples import ExampleStore
+from .semantic import SemanticCache
+from .structured import StructuredResult
 import re
-from pydantic import BaseModel
+import time
+from pydantic import BaseModel, Field
 from sqlalchemy.exc import OperationalError
 
 SYSTEM_COLOR = "blue"
@@ -14,6 +23,12 @@ USER_COLOR = "yellow"
 AI_COLOR = "green"
 SQL_COLOR = "red"
 
+PARTIAL_ANSWER = 'Não deu tempo de formular a resposta, mas este é o resultado da consulta:'
+APPROXIMATE_ANSWER = (
+    '(Resposta aproximada: calculada sobre uma amostra de {fraction:.0%} de {table}, '
+    'com margem de erro de ±{margin:.0%}.)'
+)
+
 class AIAttempt(BaseModel):
     sql_query: Optional[str] = None
     answer: Optional[str] = None
@@ -25,10 +40,24 @@ class AIAttempt(BaseModel):
 class SQLResult(BaseModel):
     sql_result: str
     sql_error: bool
+    cursor_id: Optional[str] = None
+    approximation: Optional[Approximation] = None
+    """How the result was estimated from a sample, if it was."""
+
+class ChainAnswer(BaseModel):
+    answer: str
+    sql_query: Optional[str] = None
+    cursor_id: Optional[str] = None
+    partial: bool = False
+    """The deadline hit before the answer was phrased; `answer` is the raw
+    SQL result."""
+    approximate: bool = False
+    """The answer comes from a sample of the data and says so."""
 
 class FailedAttempt(BaseModel):
     attempt: AIAttempt
     result: SQLResult
+    reason: str
 
 def parse_action(action: Optional[str]) -> str:
     if action is None or 'information' in action.lower():
@@ -42,6 +71,24 @@ def parse_action(action: Optional[str]) -> str:
 
 _steps_re = re.compile(r'(\w+):\s+(.*?)(?=\n\w+:|$)', re.DOTALL)
 _query_re = re.compile(r'^(```(sql(ite)?)?)?(?P<query>.*?)(```)?$', re.DOTALL | re.IGNORECASE)
+SELECT_ONLY = 'Sorry, I can only answer SELECT queries.'
+RESULTS_EXPIRED = 'These results expired: the data changed since the query ran. Ask again.'
+_restricted = ('delete', 'update', 'insert', 'create', 'alter', 'drop', 'pragma', 'attach', 'detach')
+_more_re = re.compile(
+    r'^(jota\W*)?(e\s+)?(me\s+)?((mostr|mand)[ae]r?|quero\s+ver|ver|show|continu[ae]r?)?\s*'
+    r'(o\s+|os\s+|the\s+)?(resto|restantes?|mais|more|rest)?\s*(por\s+favor|pfv|pls|please)?\W*$',
+    re.IGNORECASE,
+)
+def wants_more(message: str) -> bool:
+    """Whether a message only asks for the rest of the previous results."""
+    message = message.strip()
+    m = _more_re.match(message)
+    return m is not None and bool(m.group(4) or m.group(7))
+
+def _is_restricted(sql_query: str) -> bool:
+    l = sql_query.lower()
+    return any(r in l for r in _restricted)
+
 def separate_steps(message: str) -> dict[str, str]:
     parts = {}
     steps = _steps_re.findall(message)
@@ -51,8 +98,49 @@ def separate_steps(message: str) -> dict[str, str]:
 
 class SQLChain(Chain):
     llm: BaseLanguageModel
+    query_llms: list[BaseLanguageModel] = []
+    """Models that write the SQL, cheapest first. A model's query is only
+    handed to the next one when it fails validation, errors, comes back
+    empty or looks unreliable. Defaults to `[llm]`."""
+    answer_llms: list[BaseLanguageModel] = []
+    """Models that phrase the answer from the SQL result, tried in order
+    until one replies. Defaults to `[llm]`."""
+    cascade_stats: CascadeStats = Field(default_factory=CascadeStats)
     db: SQLDatabase
-    database_description: str
+    database_description: Optional[str] = None
+    """Hand-written description of the database. When unset, one is generated
+    from the reflected schema with `SQLDatabase.get_database_description`."""
+    database_preamble: str = ""
+    column_comments: dict[str, dict[str, str]] = {}
+    """Hand-written column comments for the generated description, by table
+    and column name."""
+    description_style: str = "ddl"
+    hard_limit: int = 10
+    sql_token_budget: int = 0
+    """Cut results once they take this many tokens to render (0 disables)."""
+    cursors: Optional[ResultCursorStore] = None
+    """Where truncated results are kept for "show more" follow-ups."""
+    example_store: Optional[ExampleStore] = None
+    """Picks the few-shot examples most similar to each question. When unset,
+    the fixed examples of the prompt are used."""
+    examples_k: int = 3
+    examples_token_budget: int = 600
+    answer_cache: Optional[Any] = None
+    """`LocalCache` or `SharedCache` of the answers to prompts, kept per
+    database snapshot for `answer_cache_ttl` seconds. Answers whose rows were
+    truncated are not cached, since their cursor is local to the process."""
+    answer_cache_ttl: float = 3600.0
+    approximate_cost: float = 0
+    """Aggregate queries estimated to visit more rows than this are run on
+    a sample of their largest table, if `db` keeps samples, and answered as
+    approximate (0 disables)."""
+    semantic_cache: Optional[SemanticCache] = None
+    """Maps questions to the SQL that answered them, to run it again for
+    questions that mean the same instead of asking a model to write it. Only
+    used for questions asked without `context`."""
+    on_stage: Optional[Callable[[str, float, dict[str, Any]], None]] = None
+    """Called with the name, duration in seconds and details of each stage
+    (reuse, describe, examples, generate, validate, execute, answer)."""
     output_key: str = "response"
 
     @property
@@ -91,19 +179,64 @@ class SQLChain(Chain):
         for m in msg:
             self.print_msg(m, run_manager)
 
-    def _generate_query(self, user_prompt: str, previous_attempts: list[FailedAttempt], run_manager: Optional[CallbackManagerForChainRun] = None) -> AIAttempt:
+    def _stage(self, name: str, start: float, **info: Any) -> None:
+        if self.on_stage is not None:
+            self.on_stage(name, time.perf_counter() - start, info)
+
+    def get_database_description(self) -> str:
+        if self.database_description is not None:
+            return self.database_description
+        start = time.perf_counter()
+        description = self.db.get_database_description(
+            self.description_style, self.database_preamble, comments=self.column_comments
+        )
+        self._stage('describe', start)
+        return description
+
+    @property
+    def query_tiers(self) -> list[BaseLanguageModel]:
+        return self.query_llms or [self.llm]
+
+    @property
+    def answer_tiers(self) -> list[BaseLanguageModel]:
+        return self.answer_llms or [self.llm]
+
+    def cascade_report(self) -> dict[str, dict[str, Any]]:
+        """Attempts, hit rate, average latency and escalation reasons of each
+        model, keyed by `stage:model`."""
+        return self.cascade_stats.report()
+
+    def _generate_query(self, user_prompt: str, previous_attempts: list[FailedAttempt], run_manager: Optional[CallbackManagerForChainRun] = None, question: Optional[str] = None, llm: Optional[BaseLanguageModel] = None) -> AIAttempt:
+        examples = {}
+        if self.example_store is not None:
+            start = time.perf_counter()
+            examples['examples'] = self.example_store.format(
+                question or user_prompt, self.examples_k, self.examples_token_budget
+            )
+            self._stage('examples', start)
         p = prompt.GEN_QUERY_PROMPT.format(
-            database_description=self.database_description
+            database_description=self.get_database_description(),
+            **examples
         )
         gen_query_prompt = SystemMessage(content=p)
 
         u_prompt = HumanMessage(content=f'{user_prompt.strip()}\n')
-        self.print_msgs([gen_query_prompt, u_prompt], run_manager)
+        # the queries rejected so far and why, to not repeat their mistakes
+        retries: list[BaseMessage] = []
+        for failed in previous_attempts:
+            retries.append(AIMessage(content=failed.attempt.full_content))
+            retries.append(HumanMessage(content=prompt.RETRY_PROMPT.format(
+                sql_result=failed.result.sql_result, reason=failed.reason,
+            )))
+        self.print_msgs([gen_query_prompt, u_prompt, *retries], run_manager)
 
-        ai_response = self.llm.predict_messages(
-            messages=[gen_query_prompt, u_prompt],
+        llm = llm or self.query_tiers[0]
+        start = time.perf_counter()
+        ai_response = llm.predict_messages(
+            messages=[gen_query_prompt, u_prompt, *retries],
             stop=["\nSQLResult:"]
         )
+        self._stage('generate', start, model=model_name(llm))
 
         self.print_msg(ai_response, run_manager)
 
@@ -113,20 +246,79 @@ class SQLChain(Chain):
         answer = steps.get('Answer')
         return AIAttempt(sql_query=sql_query, answer=answer, step_by_step=step_by_step, full_content=ai_response.content, human_message=u_prompt)
 
-    def _run_query(self, query: str, run_manager: Optional[CallbackManagerForChainRun] = None) -> SQLResult:
+    def _run_query(self, query: str, run_manager: Optional[CallbackManagerForChainRun] = None, chat: Optional[str] = None, approximate: bool = False) -> SQLResult:
+        """With `approximate`, expensive aggregates may be estimated from a
+        sample, see `SQLDatabase.run_approximate`."""
         m = _query_re.match(query.strip())
         query = m.group('query')
 
+        cursor_id = None
+        start = time.perf_counter()
+        shown, omitted = 0, []
+        approximation = None
         try:
-            sql_result = self.db.run(query, hard_limit=10)
+            estimated = None
+            if approximate and self.approximate_cost > 0:
+                estimated = self.db.run_approximate(
+                    query, self.approximate_cost, hard_limit=self.hard_limit, token_budget=self.sql_token_budget
+                )
+            if estimated is not None:
+                sql_result, shown, omitted, approximation = estimated
+            else:
+                sql_result, shown, omitted = self.db.run_truncated(
+                    query, hard_limit=self.hard_limit, token_budget=self.sql_token_budget
+                )
             error = False
+            if omitted and self.cursors is not None:
+                cursor_id = self.cursors.create(query, shown, omitted, chat, self.db.cache_token())
         except OperationalError as e:
             sql_result = e._message()
             error = True
+        self._stage(
+            'execute', start, rows=shown, omitted=len(omitted), chars=len(sql_result), error=error,
+            approximate=approximation.cost if approximation is not None else None,
+        )
         sql_result = sql_result or 'No results.'
         sql_result = f'```{sql_result}```'
         self.print_msgs([f'SQLResult: {sql_result}'], run_manager)
-        return SQLResult(sql_result=sql_result, sql_error=error)
+        return SQLResult(sql_result=sql_result, sql_error=error, cursor_id=cursor_id, approximation=approximation)
+
+    def page(self, cursor_id: Optional[str] = None, chat: Optional[str] = None, limit: Optional[int] = None) -> Optional[SQLResult]:
+        """Show the next rows of a truncated result, without calling the LLM.
+
+        Uses the cursor `cursor_id`, or else the latest cursor of `chat`; without
+        either there is none. Returns None when there is no such cursor (or it
+        expired). Rows that weren't kept are read again from the database, as
+        long as its data is still what the query first ran on. Pages have
+        `limit` rows, at most `hard_limit` (the default).
+        """
+        if self.cursors is None:
+            return None
+        cursor = self.cursors.get(cursor_id) if cursor_id else self.cursors.latest(chat)
+        if cursor is None:
+            return None
+        limit = min(limit, self.hard_limit) if limit is not None and limit > 0 else self.hard_limit
+
+        columns = None
+        if cursor.rows is not None:
+            rows = cursor.rows[:limit]
+            columns = cursor.columns
+            left = len(cursor.rows) - len(rows)
+        elif cursor.token != self.db.cache_token():
+            self.cursors.advance(cursor.id, 0, 0)
+            return SQLResult(sql_result=f'```{RESULTS_EXPIRED}```', sql_error=True)
+        else:
+            rows, columns = self.db.run_page(cursor.command, cursor.offset, limit)
+            left = max(0, cursor.total - cursor.offset - len(rows))
+        text = self.db._format_rows(rows, columns)
+        cursor = self.cursors.advance(cursor.id, len(rows), left)
+        if left:
+            text += f'\nOther {left} rows were omitted.'
+        return SQLResult(
+            sql_result=f'```{text or "No results."}```',
+            sql_error=False,
+            cursor_id=cursor.id if cursor is not None else None,
+        )
 
     def _get_answer(self, attempt: AIAttempt, result: SQLResult, run_manager: Optional[CallbackManagerForChainRun] = None) -> str:
         answer_prompt = SystemMessage(content=prompt.ANSWER_PROMPT.format())
@@ -138,9 +330,24 @@ class SQLChain(Chain):
                 f'Answer: '
             )
         )
-        ai_response = self.llm.predict_messages(
-            messages=[answer_prompt, attempt.human_message, ai_msg]
-        )
+        tiers = self.answer_tiers
+        for i, llm in enumerate(tiers):
+            start = time.perf_counter()
+            try:
+                ai_response = llm.predict_messages(
+                    messages=[answer_prompt, attempt.human_message, ai_msg]
+                )
+                escalation = None if ai_response.content.strip() else 'empty answer'
+            except request_deadline.DeadlineExceeded:
+                raise
+            except Exception as e:
+                if i == len(tiers) - 1:
+                    raise
+                escalation = f'error [{e.__class__.__name__}]'
+            self.cascade_stats.record(f'answer:{model_name(llm)}', time.perf_counter() - start, escalation)
+            self._stage('answer', start, model=model_name(llm))
+            if escalation is None or i == len(tiers) - 1:
+                break
 
         self.print_msgs([ai_response], run_manager)
 
@@ -149,32 +356,175 @@ class SQLChain(Chain):
 
         return answer
 
-    def _try_to_answer(self, user_prompt: str, max_attempts: int = 3, run_manager: Optional[CallbackManagerForChainRun] = None) -> Optional[str]:
+    def _remember_example(self, question: str, attempt: AIAttempt, result: SQLResult, answer: str) -> None:
+        # estimated rows would teach the model estimates as facts
+        if self.example_store is None or result.sql_error or result.approximation is not None:
+            return
+        sql_result = result.sql_result.strip('`')
+        if sql_result == 'No results.':
+            return
+        m = _query_re.match(attempt.sql_query.strip())
+        self.example_store.add(question, m.group('query').strip(), sql_result, answer)
+
+    def _answer(self, attempt: AIAttempt, result: SQLResult, run_manager: Optional[CallbackManagerForChainRun] = None) -> ChainAnswer:
+        approximation = result.approximation
+        try:
+            answer = self._get_answer(attempt, result, run_manager)
+            partial = False
+        except request_deadline.DeadlineExceeded:
+            deadline = request_deadline.current()
+            if deadline is None or deadline.cancelled:
+                raise
+            # out of time, but the rows are in: better than nothing
+            answer = f'{PARTIAL_ANSWER}\n{result.sql_result.strip("`")}'
+            partial = True
+        if approximation is not None:
+            note = APPROXIMATE_ANSWER.format(
+                fraction=approximation.fraction, table=approximation.table, margin=approximation.margin
+            )
+            answer = f'{answer}\n\n{note}'
+        return ChainAnswer(
+            answer=answer, sql_query=attempt.sql_query, cursor_id=result.cursor_id,
+            partial=partial, approximate=approximation is not None,
+        )
+
+    def _remember_query(self, question: str, attempt: AIAttempt, result: SQLResult) -> None:
+        if result.sql_error or (result.sql_result == '```No results.```' and expects_rows(question)):
+            return
+        query = _query_re.match(attempt.sql_query.strip()).group('query').strip()
+        self.semantic_cache.add(question, query)
+
+    def _reuse_query(self, user_prompt: str, question: str, run_manager: Optional[CallbackManagerForChainRun] = None, chat: Optional[str] = None) -> Optional[ChainAnswer]:
+        """Answer with the SQL of an earlier question meaning the same as
+        `question`, run again on the current data. None if there is no such
+        question or its SQL no longer works, which then forgets it."""
+        start = time.perf_counter()
+        hit = self.semantic_cache.lookup(question)
+        self._stage('reuse', start, hit=hit.question if hit is not None else None, score=hit.score if hit is not None else None)
+        if hit is None:
+            return None
+        if validate_sql(hit.sql_query, self.db.get_queryable_names()) is not None:
+            self.semantic_cache.remove(hit.question)
+            return None
+        self.print_msg(f'Reusing the query of: {hit.question}', run_manager)
+        attempt = AIAttempt(
+            sql_query=hit.sql_query,
+            full_content='',
+            human_message=HumanMessage(content=f'{user_prompt.strip()}\n'),
+        )
+        result = self._run_query(hit.sql_query, run_manager, chat, approximate=True)
+        if result.sql_error or (result.sql_result == '```No results.```' and expects_rows(question)):
+            self.semantic_cache.remove(hit.question)
+            return None
+        return self._answer(attempt, result, run_manager)
+
+    def _escalation(self, attempt: AIAttempt) -> Optional[str]:
+        """Why the query of `attempt` should not be run, judged locally."""
+        invalid = None
+        if attempt.sql_query is not None:
+            query = _query_re.match(attempt.sql_query.strip()).group('query')
+            invalid = validate_sql(query, self.db.get_queryable_names())
+        if invalid in BLOCKING:
+            return invalid
+        return low_confidence(attempt.step_by_step, attempt.sql_query, attempt.answer) or invalid
+
+    def _try_to_answer(self, user_prompt: str, max_attempts: int = 3, run_manager: Optional[CallbackManagerForChainRun] = None, chat: Optional[str] = None, question: Optional[str] = None, reusable: bool = False) -> Optional[ChainAnswer]:
+        """Attempt `i` uses the `i`-th query model, the last one being reused
+        if there are more attempts than models. The last attempt is accepted
+        unless its query is not a single SELECT (see `cascade.BLOCKING`), in
+        which case there is no answer. When `reusable`, the SQL depends on `question` alone
+        and may come from `semantic_cache`."""
+        reusable = reusable and question is not None and self.semantic_cache is not None
+        if reusable:
+            answer = self._reuse_query(user_prompt, question, run_manager, chat)
+            if answer is not None:
+                return answer
         previous_attempts: list[FailedAttempt] = []
+        tiers = self.query_tiers
         for i in range(max_attempts):
-            query_attempt = self._generate_query(user_prompt, previous_attempts, run_manager)
-            if query_attempt.sql_query is None: return query_attempt.answer or query_attempt.full_content
-            result = self._run_query(query_attempt.sql_query, run_manager)
-            if i < max_attempts - 1 and result.sql_error:
-                previous_attempts.append(FailedAttempt(attempt=query_attempt, result=result))
+            request_deadline.check()
+            llm = tiers[min(i, len(tiers) - 1)]
+            tier = f'query:{model_name(llm)}'
+            last = i == max_attempts - 1
+            start = time.perf_counter()
+            query_attempt = self._generate_query(user_prompt, previous_attempts, run_manager, question, llm)
+            latency = time.perf_counter() - start
+            start = time.perf_counter()
+            escalation = self._escalation(query_attempt)
+            self._stage('validate', start, escalation=escalation)
+            if escalation is not None and not last:
+                self.cascade_stats.record(tier, latency, escalation)
+                self.print_msg(f'Escalating: {escalation}', run_manager)
+                if query_attempt.sql_query is not None:
+                    previous_attempts.append(FailedAttempt(
+                        attempt=query_attempt,
+                        result=SQLResult(sql_result='```Not run.```', sql_error=True),
+                        reason=escalation,
+                    ))
+                continue
+            if escalation in BLOCKING:
+                self.cascade_stats.record(tier, latency, escalation)
+                self.print_msg(f'Not running: {escalation}', run_manager)
+                return None
+            if query_attempt.sql_query is None:
+                self.cascade_stats.record(tier, latency, None)
+                return ChainAnswer(answer=query_attempt.answer or query_attempt.full_content)
+            result = self._run_query(query_attempt.sql_query, run_manager, chat, approximate=True)
+            if result.sql_error:
+                escalation = 'execution error'
+            elif result.sql_result == '```No results.```' and expects_rows(question or user_prompt):
+                escalation = 'empty result'
+            self.cascade_stats.record(tier, latency, None if last else escalation)
+            if not last and escalation is not None:
+                self.print_msg(f'Escalating: {escalation}', run_manager)
+                previous_attempts.append(FailedAttempt(attempt=query_attempt, result=result, reason=escalation))
                 continue
             else:
-                return self._get_answer(query_attempt, result, run_manager)
+                answer = self._answer(query_attempt, result, run_manager)
+                if not answer.partial and escalation is None:
+                    self._remember_example(question or user_prompt, query_attempt, result, answer.answer)
+                    if reusable:
+                        self._remember_query(question, query_attempt, result)
+                return answer
+
+    def run_sql(self, sql_query: str, chat: Optional[str] = None) -> SQLResult:
+        if _is_restricted(sql_query):
+            return SQLResult(sql_result=SELECT_ONLY, sql_error=True)
+        return self._run_query(sql_query, chat=chat)
 
-    def run_sql(self, sql_query: str) -> str:
-        l = sql_query.lower()
-        restricted = ['delete', 'update', 'insert', 'create', 'alter', 'drop', 'pragma']
-        if any(r in l for r in restricted):
-            return 'Sorry, I can only answer SELECT queries.'
-        result = self._run_query(sql_query)
-        return result.sql_result
+    def run_structured(self, sql_query: str, offset: int = 0, limit: Optional[int] = None) -> StructuredResult:
+        """Rows of `sql_query` as typed columns, streamed in batches, for
+        programs rather than people: nothing is truncated or rendered. Raises
+        `ValueError` for anything but a query."""
+        if _is_restricted(sql_query):
+            raise ValueError(SELECT_ONLY)
+        query = _query_re.match(sql_query.strip()).group('query')
+        return self.db.run_structured(query, offset=offset, limit=limit)
 
     def _call(self,
               inputs: dict[str, Any],
               run_manager: Optional[CallbackManagerForChainRun] = None):
+        """Optional inputs are the `chat` id, the bare `question`, when
+        `prompt` wraps it, and the `context` (earlier messages) `prompt` adds
+        to it, if any. Besides `response`, the outputs carry the `sql_query`
+        that produced the answer and the `cursor` of its truncated rows, if
+        any, and whether it is `approximate`."""
         user_prompt = inputs['prompt']
-        answer = self._try_to_answer(user_prompt, 1, run_manager)
+        if self.answer_cache is not None:
+            key = (user_prompt, inputs.get('question'))
+            token = self.db.cache_token()
+            outputs = self.answer_cache.get('answer', key, token)
+            if outputs is not MISSING:
+                return dict(outputs)
+        answer = self._try_to_answer(
+            user_prompt, len(self.query_tiers), run_manager, inputs.get('chat'), inputs.get('question'),
+            reusable=not inputs.get('context'),
+        )
         if answer is None:
-            return {'response': 'Sorry, I failed to get an answer.'}
-        else:
-            return {'response': answer}
+            return {'response': 'Sorry, I failed to get an answer.', 'sql_query': None, 'cursor': None, 'partial': False,
+                    'approximate': False}
+        outputs = {'response': answer.answer, 'sql_query': answer.sql_query, 'cursor': answer.cursor_id, 'partial': answer.partial,
+                   'approximate': answer.approximate}
+        if self.answer_cache is not None and answer.cursor_id is None and not answer.partial:
+            self.answer_cache.set('answer', key, token, outputs, self.answer_cache_ttl)
+        return outputs
@@ -0,0 +1,286 @@
+"""Resumable cursors over truncated query results."""
+from __future__ import annotations
+
+import pickle
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+from pydantic import BaseModel
+
+
+class ResultCursor(BaseModel):
+    id: str
+    chat: Optional[str] = None
+    command: str
+    offset: int
+    """Number of (deduplicated) rows already shown."""
+    rows: Optional[list[Any]] = None
+    """Remaining rows, when small enough to keep. Otherwise pages re-run `command`."""
+    columns: Optional[list[str]] = None
+    """Names of the columns of `rows`."""
+    total: Optional[int] = None
+    token: Optional[str] = None
+    """`SQLDatabase.cache_token` of the data `command` ran on."""
+    expires_at: float
+
+
+class ResultCursorStore:
+    """Keeps the rest of truncated results around so they can be paged through.
+
+    Cursors expire after `ttl` seconds. Each chat keeps at most
+    `max_cursors_per_chat` cursors and `max_rows_per_chat` buffered rows; results
+    that don't fit are kept as the SQL command plus the position to resume from.
+    At most `max_chats` chats are tracked, least recently used first out.
+
+    Cursors created without a chat belong to no one: they can only be read
+    by their id, never as the `latest` of a chat, and at most `max_chats` of
+    them are kept, each buffering up to `max_rows_per_chat` rows.
+
+    With `path`, cursors live in a SQLite file instead of memory, so a
+    follow-up landing on another worker of `jbot.serve` finds them.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        ttl: float = 600.0,
+        max_cursors_per_chat: int = 3,
+        max_rows_per_chat: int = 200,
+        max_chats: int = 1000,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.max_cursors_per_chat = max_cursors_per_chat
+        self.max_rows_per_chat = max_rows_per_chat
+        self.max_chats = max_chats
+        self._lock = threading.Lock()
+        self._cursors: dict[str, ResultCursor] = {}
+        self._chats: OrderedDict[str, list[str]] = OrderedDict()
+        self._unowned: OrderedDict[str, None] = OrderedDict()
+        self._local = threading.local()
+        if path is not None:
+            self._conn().executescript(
+                'CREATE TABLE IF NOT EXISTS result_cursors '
+                '(id TEXT PRIMARY KEY, chat TEXT, token TEXT, buffered INT NOT NULL, data BLOB NOT NULL, '
+                'created REAL NOT NULL, expires_at REAL NOT NULL);'
+                'CREATE INDEX IF NOT EXISTS result_cursors_chat ON result_cursors (chat, created);'
+            )
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode = WAL')
+            self._local.conn = conn
+        return conn
+
+    def _buffered_rows(self, chat: Optional[str]) -> int:
+        return sum(len(self._cursors[c].rows or ()) for c in self._chats.get(chat, ()))
+
+    def _drop(self, cursor_id: str) -> None:
+        cursor = self._cursors.pop(cursor_id, None)
+        if cursor is None:
+            return
+        if cursor.chat is None:
+            self._unowned.pop(cursor_id, None)
+            return
+        ids = self._chats.get(cursor.chat)
+        if ids is not None:
+            ids.remove(cursor_id)
+            if not ids:
+                del self._chats[cursor.chat]
+
+    def _expire(self) -> None:
+        now = time.time()
+        for cursor_id in [c.id for c in self._cursors.values() if c.expires_at <= now]:
+            self._drop(cursor_id)
+
+    def create(
+        self, command: str, offset: int, rows: list[Any], chat: Optional[str] = None,
+        token: Optional[str] = None,
+    ) -> str:
+        """Store the rows left after the first `offset` ones of `command`, run
+        on the data of `token`. Returns the cursor id."""
+        columns = list(rows[0]._fields) if rows and hasattr(rows[0], '_fields') else None
+        if self.path is not None:
+            return self._create_shared(command, offset, [tuple(r) for r in rows], columns, chat, token)
+        with self._lock:
+            self._expire()
+            if chat is None:
+                while len(self._unowned) >= self.max_chats:
+                    self._drop(next(iter(self._unowned)))
+                keep_rows = len(rows) <= self.max_rows_per_chat
+            else:
+                ids = self._chats.setdefault(chat, [])
+                self._chats.move_to_end(chat)
+                while len(ids) >= self.max_cursors_per_chat:
+                    self._drop(ids[0])
+                    ids = self._chats.setdefault(chat, [])
+                while len(self._chats) > self.max_chats:
+                    oldest = next(iter(self._chats))
+                    for cursor_id in list(self._chats[oldest]):
+                        self._drop(cursor_id)
+                keep_rows = self._buffered_rows(chat) + len(rows) <= self.max_rows_per_chat
+
+            cursor = ResultCursor(
+                id=secrets.token_urlsafe(8),
+                chat=chat,
+                command=command,
+                offset=offset,
+                rows=list(rows) if keep_rows else None,
+                columns=columns,
+                total=offset + len(rows),
+                token=token,
+                expires_at=time.time() + self.ttl,
+            )
+            self._cursors[cursor.id] = cursor
+            if chat is None:
+                self._unowned[cursor.id] = None
+            else:
+                ids.append(cursor.id)
+            return cursor.id
+
+    def _create_shared(
+        self, command: str, offset: int, rows: list[tuple], columns: Optional[list[str]],
+        chat: Optional[str], token: Optional[str],
+    ) -> str:
+        now = time.time()
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM result_cursors WHERE expires_at <= ?', (now,))
+            if chat is None:
+                conn.execute(
+                    'DELETE FROM result_cursors WHERE id IN (SELECT id FROM result_cursors WHERE chat IS NULL '
+                    'ORDER BY created DESC LIMIT -1 OFFSET ?)',
+                    (self.max_chats - 1,),
+                )
+                keep_rows = len(rows) <= self.max_rows_per_chat
+            else:
+                conn.execute(
+                    'DELETE FROM result_cursors WHERE id IN (SELECT id FROM result_cursors WHERE chat = ? '
+                    'ORDER BY created DESC LIMIT -1 OFFSET ?)',
+                    (chat, self.max_cursors_per_chat - 1),
+                )
+                conn.execute(
+                    'DELETE FROM result_cursors WHERE chat IN (SELECT chat FROM result_cursors '
+                    'WHERE chat IS NOT NULL AND chat != ? GROUP BY chat ORDER BY max(created) DESC '
+                    'LIMIT -1 OFFSET ?)',
+                    (chat, self.max_chats - 1),
+                )
+                buffered, = conn.execute(
+                    'SELECT coalesce(sum(buffered), 0) FROM result_cursors WHERE chat = ?', (chat,)
+                ).fetchone()
+                keep_rows = buffered + len(rows) <= self.max_rows_per_chat
+            cursor = ResultCursor(
+                id=secrets.token_urlsafe(8),
+                chat=chat,
+                command=command,
+                offset=offset,
+                rows=rows if keep_rows else None,
+                columns=columns,
+                total=offset + len(rows),
+                token=token,
+                expires_at=now + self.ttl,
+            )
+            conn.execute(
+                'INSERT INTO result_cursors VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (cursor.id, chat, token, len(cursor.rows or ()), pickle.dumps(cursor), now, cursor.expires_at),
+            )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return cursor.id
+
+    def _load_shared(self, where: str, args: tuple) -> Optional[ResultCursor]:
+        row = self._conn().execute(
+            f'SELECT data FROM result_cursors WHERE {where} AND expires_at > ? ORDER BY created DESC LIMIT 1',
+            (*args, time.time()),
+        ).fetchone()
+        return pickle.loads(row[0]) if row is not None else None
+
+    def get(self, cursor_id: str) -> Optional[ResultCursor]:
+        if self.path is not None:
+            return self._load_shared('id = ?', (cursor_id,))
+        with self._lock:
+            self._expire()
+            return self._cursors.get(cursor_id)
+
+    def latest(self, chat: Optional[str]) -> Optional[ResultCursor]:
+        """Most recent live cursor of a chat. None without a chat."""
+        if chat is None:
+            return None
+        if self.path is not None:
+            return self._load_shared('chat = ?', (chat,))
+        with self._lock:
+            self._expire()
+            ids = self._chats.get(chat)
+            return self._cursors[ids[-1]] if ids else None
+
+    def advance(self, cursor_id: str, shown: int, left: int) -> Optional[ResultCursor]:
+        """Mark `shown` more rows as read, with `left` rows still unread.
+
+        Drops the cursor once exhausted.
+        """
+        if self.path is not None:
+            return self._advance_shared(cursor_id, shown, left)
+        with self._lock:
+            cursor = self._cursors.get(cursor_id)
+            if cursor is None:
+                return None
+            if left <= 0:
+                self._drop(cursor_id)
+                return None
+            cursor.offset += shown
+            if cursor.rows is not None:
+                cursor.rows = cursor.rows[shown:]
+            cursor.expires_at = time.time() + self.ttl
+            return cursor
+
+    def _advance_shared(self, cursor_id: str, shown: int, left: int) -> Optional[ResultCursor]:
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT data FROM result_cursors WHERE id = ?', (cursor_id,)).fetchone()
+            cursor = pickle.loads(row[0]) if row is not None else None
+            if cursor is not None and left <= 0:
+                conn.execute('DELETE FROM result_cursors WHERE id = ?', (cursor_id,))
+                cursor = None
+            elif cursor is not None:
+                cursor.offset += shown
+                if cursor.rows is not None:
+                    cursor.rows = cursor.rows[shown:]
+                cursor.expires_at = time.time() + self.ttl
+                conn.execute(
+                    'UPDATE result_cursors SET buffered = ?, data = ?, expires_at = ? WHERE id = ?',
+                    (len(cursor.rows or ()), pickle.dumps(cursor), cursor.expires_at, cursor_id),
+                )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return cursor
+
+    def clear(self, token: Optional[str] = None) -> None:
+        """Drop every cursor, or with `token`, those of other data snapshots.
+        Workers sharing `path` swap snapshots at different times, so they
+        pass the token of the one they now serve."""
+        if self.path is not None:
+            if token is None:
+                self._conn().execute('DELETE FROM result_cursors')
+            else:
+                self._conn().execute('DELETE FROM result_cursors WHERE token IS NOT ?', (token,))
+            return
+        with self._lock:
+            if token is not None:
+                for cursor_id in [c.id for c in self._cursors.values() if c.token != token]:
+                    self._drop(cursor_id)
+                return
+            self._cursors.clear()
+            self._chats.clear()
+            self._unowned.clear()
@@ -1,17 +1,40 @@
 """SQLAlchemy wrapper around a database."""
 from __future__ import annotations
 
+import hashlib
+import re
+import threading
 import warnings
-from typing import Any, Iterable, List, Optional, Sequence
+from collections import Counter
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Sequence
 
 import sqlalchemy
 from sqlalchemy import MetaData, Table, create_engine, inspect, select, text
 from sqlalchemy.engine import Engine
-from sqlalchemy.exc import ProgrammingError, SQLAlchemyError
+from sqlalchemy.exc import OperationalError, ProgrammingError, SQLAlchemyError
 from sqlalchemy.schema import CreateTable
 
 from langchain.utils import get_from_env
 
+from .. import deadline as request_deadline
+from ..cache import LocalCache, cached
+from . import approximate
+from .approximate import Approximation, QueryCost, Sample, SampleStore
+from .partitions import SemesterPartitions
+from .profile import ColumnProfiler
+from .render import RenderedResult, render_rows
+from .replica import SQLiteReplica, _file_signature
+from .structured import StructuredResult, infer_columns
+from .tokens import count_tokens
+
+DESCRIPTION_STYLES = ("tsv", "ddl")
+
+_sqlite_comment_re = re.compile(
+    r'^\s*["`\[]?(\w+)["`\]]?\s[^\n]*?--\s*(.+?)\s*$', re.MULTILINE
+)
+
 
 def _format_index(index: sqlalchemy.engine.interfaces.ReflectedIndex) -> str:
     return (
@@ -35,6 +58,12 @@ def truncate_word(content: Any, *, length: int, suffix: str = "...") -> str:
     return content[: length - len(suffix)].rsplit(" ", 1)[0] + suffix
 
 
+def _format_value(value: Any, max_length: int = 40) -> str:
+    if isinstance(value, str):
+        return truncate_word(value, length=max_length)
+    return str(value)
+
+
 class SQLDatabase:
     """SQLAlchemy wrapper around a database."""
 
@@ -50,10 +79,35 @@ class SQLDatabase:
         custom_table_info: Optional[dict] = None,
         view_support: bool = False,
         max_string_length: int = 300,
+        max_string_lengths: Optional[dict[str, int]] = None,
+        replica: Optional[SQLiteReplica] = None,
+        profile_catalog: Optional[str] = None,
+        partitions: Optional[SemesterPartitions] = None,
+        cache: Optional[Any] = None,
+        samples: Optional[SampleStore] = None,
     ):
         """Create engine from database URI."""
         self._engine = engine
         self._schema = schema
+        self._replica = replica
+        self._partitions = partitions
+        self._result_cache = cache
+        if getattr(cache, 'shared', False) and not self.shares_cache_token():
+            # other processes would take this process's versions for theirs
+            warnings.warn("cache_token is local to the process for this database, caching per process instead")
+            self._result_cache = LocalCache()
+        self._samples = samples
+        self._view_support = view_support
+        self._local_version = 0
+        self._cache: dict[tuple, Any] = {}
+        self._cache_lock = threading.Lock()
+        self._running: dict[tuple, Future] = {}
+        self._running_lock = threading.Lock()
+        self._invalidation_callbacks: list[Callable[[], None]] = []
+        self._description_cache: dict[tuple, tuple[tuple[int, int], str, str]] = {}
+        self._version_lock = threading.Lock()
+        self._version_connection: Any = None
+        self._version_connection_snapshot = -1
         if include_tables and ignore_tables:
             raise ValueError("Cannot specify both include_tables and ignore_tables")
 
@@ -105,11 +159,26 @@ class SQLDatabase:
             )
 
         self._max_string_length = max_string_length
+        self._max_string_lengths = max_string_lengths or {}
+        self._render_stats: Counter = Counter()
 
         self._metadata = metadata or MetaData()
+        self._reflect()
+
+        if self._replica is not None:
+            self._replica.on_swap(self.invalidate)
+        if self._result_cache is not None:
+            self._result_cache.retain(self.cache_token())
+
+        # column statistics replace the sample rows in the table info
+        self._profiler = (
+            ColumnProfiler(self, profile_catalog) if profile_catalog is not None else None
+        )
+
+    def _reflect(self) -> None:
         # including view support if view_support = true
         self._metadata.reflect(
-            views=view_support,
+            views=self._view_support,
             bind=self._engine,
             only=list(self._usable_tables),
             schema=self._schema,
@@ -123,6 +192,19 @@ class SQLDatabase:
         _engine_args = engine_args or {}
         return cls(create_engine(database_uri, **_engine_args), **kwargs)
 
+    @classmethod
+    def from_sqlite_replica(
+        cls, path: str, watch_interval: float = 2.0, **kwargs: Any
+    ) -> SQLDatabase:
+        """Load a SQLite file into a shared in-memory replica.
+
+        The source file is polled every `watch_interval` seconds (0 disables
+        watching) and, when it changes, a fresh snapshot is swapped in and every
+        cache depending on the data is invalidated.
+        """
+        replica = SQLiteReplica(path, watch_interval=watch_interval)
+        return cls(replica.engine, replica=replica, **kwargs)
+
     @classmethod
     def from_databricks(
         cls,
@@ -266,12 +348,123 @@ class SQLDatabase:
         """Return string representation of dialect to use."""
         return self._engine.dialect.name
 
+    @property
+    def snapshot_version(self) -> int:
+        """Version of the data being queried, bumped on every invalidation."""
+        if self._replica is not None:
+            return self._replica.version + self._local_version
+        return self._local_version
+
+    def data_version(self) -> tuple[int, int]:
+        """Token that changes whenever the data may have changed.
+
+        Combines `snapshot_version` with SQLite's `PRAGMA data_version`, read on
+        a dedicated connection so commits made by other connections or processes
+        are noticed. Other dialects only track `snapshot_version`.
+        """
+        snapshot = self.snapshot_version
+        if self.dialect != "sqlite":
+            return (snapshot, 0)
+        with self._version_lock:
+            if self._version_connection_snapshot != snapshot:
+                if self._version_connection is not None:
+                    self._version_connection.close()
+                connection = self._engine.raw_connection()
+                connection.detach()
+                self._version_connection = connection
+                self._version_connection_snapshot = snapshot
+            cursor = self._version_connection.cursor()
+            try:
+                cursor.execute("PRAGMA data_version")
+                return (snapshot, cursor.fetchone()[0])
+            finally:
+                cursor.close()
+
+    def cache_token(self) -> str:
+        """Token of the data snapshot, the same in every process serving it.
+
+        Tags the entries of `cache`, which may be shared by several workers:
+        the signature of the replicated snapshot or of the SQLite file, or
+        `data_version` for other databases.
+        """
+        if self._replica is not None:
+            signature = self._replica.signature
+        elif self.dialect == "sqlite" and self._engine.url.database not in (None, "", ":memory:"):
+            signature = _file_signature(self._engine.url.database)
+        else:
+            signature = self.data_version()
+        semesters = self._partitions.semesters if self._partitions is not None else []
+        return hashlib.sha1(repr((signature, semesters)).encode()).hexdigest()
+
+    def shares_cache_token(self) -> bool:
+        """Whether `cache_token` is the same in every process, as a cache
+        shared by processes needs. Only SQLite files and replicas have a
+        snapshot signature; other databases fall back to `data_version`."""
+        return self._replica is not None or (
+            self.dialect == "sqlite" and self._engine.url.database not in (None, "", ":memory:")
+        )
+
+    @property
+    def result_cache(self) -> Optional[Any]:
+        """The cache of results, schema info and answers of this database."""
+        return self._result_cache
+
+    def _shared(self, namespace: str, key: tuple, compute: Callable[[], Any]) -> Any:
+        return cached(self._result_cache, namespace, key, self.cache_token(), compute)
+
+    def on_invalidate(self, callback: Callable[[], None]) -> None:
+        """Register a callback to drop caches that depend on this database."""
+        self._invalidation_callbacks.append(callback)
+
+    def invalidate(self) -> None:
+        """Drop schema info and every dependent cache.
+
+        Called automatically when an in-memory replica swaps in a new snapshot.
+        Cached values are tagged with `snapshot_version`, so lookups already miss
+        from the moment the snapshot is swapped, before this runs.
+        """
+        self._local_version += 1
+        if self._result_cache is not None:
+            self._result_cache.retain(self.cache_token())
+        with self._cache_lock:
+            self._cache.clear()
+            self._description_cache.clear()
+            self._inspector = inspect(self._engine)
+            self._metadata.clear()
+            self._reflect()
+        for callback in self._invalidation_callbacks:
+            callback()
+
+    def _cached(self, key: tuple, compute: Callable[[], Any]) -> Any:
+        if self._result_cache is not None:
+            return self._shared('schema', key, compute)
+        version = self.data_version()
+        full_key = (version, *key)
+        with self._cache_lock:
+            if full_key in self._cache:
+                return self._cache[full_key]
+            # entries of older versions can never be hit again
+            for stale in [k for k in self._cache if k[0] != version]:
+                del self._cache[stale]
+        value = compute()
+        with self._cache_lock:
+            if version == self.data_version():
+                self._cache[full_key] = value
+        return value
+
     def get_usable_table_names(self) -> Iterable[str]:
         """Get names of tables available."""
         if self._include_tables:
             return sorted(self._include_tables)
         return sorted(self._all_tables - self._ignore_tables)
 
+    def get_queryable_names(self) -> Iterable[str]:
+        """Names of the tables and views queries may use."""
+        names = list(self.get_usable_table_names())
+        if self._partitions is not None:
+            names.extend(self._partitions.views)
+        return names
+
     def get_table_names(self) -> Iterable[str]:
         """Get names of tables available."""
         warnings.warn(
@@ -294,6 +487,10 @@ class SQLDatabase:
         appended to each table description. This can increase performance as
         demonstrated in the paper.
         """
+        key = ('table_info', tuple(table_names) if table_names is not None else None)
+        return self._cached(key, lambda: self._get_table_info(table_names))
+
+    def _get_table_info(self, table_names: Optional[List[str]] = None) -> str:
         all_table_names = self.get_usable_table_names()
         if table_names is not None:
             missing_tables = set(table_names).difference(all_table_names)
@@ -308,6 +505,9 @@ class SQLDatabase:
             and not (self.dialect == "sqlite" and tbl.name.startswith("sqlite_"))
         ]
 
+        if self._profiler is not None:
+            self._profiler.refresh()
+
         tables = []
         for table in meta_tables:
             if self._custom_table_info and table.name in self._custom_table_info:
@@ -318,13 +518,17 @@ class SQLDatabase:
             create_table = str(CreateTable(table).compile(self._engine))
             table_info = f"{create_table.rstrip()}"
             has_extra_info = (
-                self._indexes_in_table_info or self._sample_rows_in_table_info
+                self._indexes_in_table_info
+                or self._sample_rows_in_table_info
+                or self._profiler is not None
             )
             if has_extra_info:
                 table_info += "\n\n/*"
             if self._indexes_in_table_info:
                 table_info += f"\n{self._get_table_indexes(table)}\n"
-            if self._sample_rows_in_table_info:
+            if self._profiler is not None:
+                table_info += f"\n{self._profiler.format_table(table.name)}\n"
+            elif self._sample_rows_in_table_info:
                 table_info += f"\n{self._get_sample_rows(table)}\n"
             if has_extra_info:
                 table_info += "*/"
@@ -368,24 +572,269 @@ class SQLDatabase:
             f"{sample_rows_str}"
         )
 
-    def _execute(self, command: str, fetch: Optional[str] = "all") -> Sequence:
+    def schema_fingerprint(self) -> str:
+        """Hash of the schema, the row counts and the snapshot version.
+
+        Changes whenever the tables are altered or rows are added or removed, so
+        anything derived from the schema and sampled data can be keyed by it.
+        """
+        tables = [
+            tbl
+            for tbl in self._metadata.sorted_tables
+            if tbl.name in self._usable_tables
+        ]
+        if self.dialect == "sqlite":
+            ddl = self._execute(
+                "SELECT group_concat(sql, ';') FROM "
+                "(SELECT sql FROM sqlite_master WHERE sql IS NOT NULL ORDER BY name)",
+                fetch="one",
+            )[0]
+        else:
+            ddl = ";".join(str(CreateTable(tbl).compile(self._engine)) for tbl in tables)
+        counts = []
+        if tables:
+            command = select(
+                *(select(sqlalchemy.func.count()).select_from(tbl).scalar_subquery() for tbl in tables)
+            )
+            with self._engine.connect() as connection:
+                counts = list(connection.execute(command).one())
+        semesters = self._partitions.semesters if self._partitions is not None else []
+        h = hashlib.sha1(f"{self.snapshot_version}|{ddl}|{counts}|{semesters}".encode())
+        return h.hexdigest()
+
+    def get_database_description(
+        self,
+        style: str = "ddl",
+        preamble: str = "",
+        sample_values: int = 3,
+        comments: Optional[dict[str, dict[str, str]]] = None,
+    ) -> str:
+        """Render a compact description of the usable tables for prompts.
+
+        `style` is either "tsv", the column list plus example rows used by
+        `prompt.py`, or "ddl", the CREATE TABLE statements used by
+        `prompt_gpt4.py`. Column comments come from `comments`, a map of table
+        name to column name to comment, from the reflected metadata or, on
+        SQLite, from the `--` comments in the original CREATE TABLE, and are
+        complemented by up to `sample_values` sampled values.
+
+        The result is cached until `data_version` changes. The description is
+        then only rendered again if its fingerprint, `schema_fingerprint` plus
+        the sampled values, changed too, so updates that keep the row counts
+        but change the values shown still refresh it.
+        """
+        if style not in DESCRIPTION_STYLES:
+            raise ValueError(f"style must be one of {DESCRIPTION_STYLES}")
+        comments = comments or {}
+        key = (
+            style, preamble, sample_values,
+            tuple(sorted((table, tuple(sorted(cols.items()))) for table, cols in comments.items())),
+        )
+        if self._result_cache is not None:
+            return self._shared(
+                'description', key,
+                lambda: self._get_database_description(
+                    style, preamble, comments, self._description_samples(sample_values)
+                ),
+            )
+        version = self.data_version()
+        with self._cache_lock:
+            cached = self._description_cache.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[2]
+        samples = self._description_samples(sample_values)
+        fingerprint = hashlib.sha1(f"{self.schema_fingerprint()}|{samples!r}".encode()).hexdigest()
+        if cached is not None and cached[1] == fingerprint:
+            description = cached[2]
+        else:
+            description = self._get_database_description(style, preamble, comments, samples)
+        with self._cache_lock:
+            self._description_cache[key] = (version, fingerprint, description)
+        return description
+
+    def _description_samples(self, sample_values: int) -> dict[str, tuple[list[tuple], dict[str, list]]]:
+        """Sampled rows and example values of each usable table."""
+        if self._profiler is not None:
+            self._profiler.refresh()
+        samples = {}
+        for table in self._metadata.sorted_tables:
+            if table.name not in self._usable_tables:
+                continue
+            # the catalog has the most common values already, no need to read rows
+            if self._profiler is not None:
+                rows = []
+                examples = self._profiler.common_values(table.name, sample_values)
+            else:
+                rows = self._sample_distinct_rows(table, sample_values)
+                examples = {
+                    col.name: list(dict.fromkeys(r[i] for r in rows if r[i] is not None))
+                    for i, col in enumerate(table.columns)
+                }
+            # only text values say something a type doesn't
+            examples = {
+                name: [v for v in values if isinstance(v, str)] for name, values in examples.items()
+            }
+            samples[table.name] = (rows, examples)
+        return samples
+
+    def _get_database_description(
+        self,
+        style: str,
+        preamble: str,
+        comments: dict[str, dict[str, str]],
+        samples: dict[str, tuple[list[tuple], dict[str, list]]],
+    ) -> str:
+        reflected = self._column_comments()
+        tables = []
+        for table in self._metadata.sorted_tables:
+            if table.name not in samples:
+                continue
+            rows, examples = samples[table.name]
+            # hand-written comments win over the reflected ones
+            table_comments = {**reflected.get(table.name, {}), **comments.get(table.name, {})}
+            if style == "ddl":
+                tables.append(self._describe_table_ddl(table, table_comments, examples))
+            else:
+                tables.append(self._describe_table_tsv(table, table_comments, rows, examples))
+        description = "\n\n".join(tables) + "\n"
+        if self._partitions is not None:
+            description += f"\n{self._partitions.describe()}\n"
+        if preamble:
+            description = f"{preamble.rstrip()}\n\n{description}"
+        return description
+
+    def get_description_token_counts(
+        self, preamble: str = "", sample_values: int = 3, model: str = "gpt-4"
+    ) -> dict[str, int]:
+        """Number of tokens the description takes in each style."""
+        return {
+            style: count_tokens(
+                self.get_database_description(style, preamble, sample_values), model
+            )
+            for style in DESCRIPTION_STYLES
+        }
+
+    def _column_comments(self) -> dict[str, dict[str, str]]:
+        comments: dict[str, dict[str, str]] = {}
+        if self.dialect == "sqlite":
+            for name, sql in self._execute(
+                "SELECT name, sql FROM sqlite_master WHERE type IN ('table', 'view')"
+            ):
+                if sql:
+                    comments[name] = dict(_sqlite_comment_re.findall(sql))
+        for table in self._metadata.sorted_tables:
+            for column in table.columns:
+                if column.comment:
+                    comments.setdefault(table.name, {})[column.name] = column.comment
+        return comments
+
+    def _sample_distinct_rows(self, table: Table, n: int) -> list[tuple]:
+        if n <= 0:
+            return []
+        command = select(table).limit(n * 10)
+        try:
+            with self._engine.connect() as connection:
+                rows = [tuple(r) for r in connection.execute(command)]
+        except ProgrammingError:
+            return []
+        # prefer rows that show different values over the first N rows, which
+        # often only differ by their primary key
+        picked: list[tuple] = []
+        seen: list[set] = [set() for _ in table.columns]
+        for row in rows:
+            new = sum(1 for v, s in zip(row, seen) if v not in s)
+            if new > len(row) // 2 or not picked:
+                picked.append(row)
+                for v, s in zip(row, seen):
+                    s.add(v)
+            if len(picked) >= n:
+                break
+        return picked
+
+    def _describe_table_ddl(
+        self, table: Table, comments: dict[str, str], examples: dict[str, list]
+    ) -> str:
+        pk = [col.name for col in table.primary_key.columns]
+        lines = []
+        for i, col in enumerate(table.columns):
+            line = f"{col.name} {col.type.compile(self._engine.dialect)}"
+            if pk == [col.name]:
+                line += " PK"
+            for fk in col.foreign_keys:
+                line += f" REFERENCES {fk.column.table.name}({fk.column.name})"
+            notes = []
+            if col.name in comments:
+                notes.append(comments[col.name])
+            elif examples.get(col.name):
+                notes.append("ex: " + ", ".join(_format_value(v) for v in examples[col.name]))
+            lines.append((line, notes))
+        if len(pk) > 1:
+            lines.append((f"PRIMARY KEY ({', '.join(pk)})", []))
+        body = []
+        for j, (line, notes) in enumerate(lines):
+            sep = "," if j < len(lines) - 1 else ""
+            comment = f" -- {'; '.join(notes)}" if notes else ""
+            body.append(f"\t{line}{sep}{comment}")
+        return f"CREATE TABLE {table.name} (\n" + "\n".join(body) + "\n);"
+
+    def _describe_table_tsv(
+        self, table: Table, comments: dict[str, str], rows: list[tuple], examples: dict[str, list]
+    ) -> str:
+        lines = [f"Columns for table {table.name}:"]
+        for col in table.columns:
+            line = f"\t{col.name} {col.type.compile(self._engine.dialect)}"
+            if col.primary_key:
+                line += " PK"
+            if col.name in comments:
+                line += f" ({comments[col.name]})"
+            elif not rows and examples.get(col.name):
+                line += " (ex: " + ", ".join(_format_value(v) for v in examples[col.name]) + ")"
+            lines.append(line)
+        if rows:
+            lines.append(f"Example data for table {table.name}:")
+            lines.append("\t".join(col.name for col in table.columns))
+            lines.extend(
+                "\t".join("NULL" if v is None else _format_value(v) for v in row)
+                for row in rows
+            )
+            lines.append("...")
+        return "\n".join(lines)
+
+    def _execute(
+        self, command: str, fetch: Optional[str] = "all", sample: Optional[Sample] = None
+    ) -> Sequence:
         """
         Executes SQL command through underlying engine.
 
-        If the statement returns no rows, an empty list is returned.
+        If the statement returns no rows, an empty list is returned. SQLite
+        statements are interrupted when the request's deadline (see
+        `jbot.deadline`) passes or is cancelled, raising `DeadlineExceeded`.
+        With a `sample`, it is attached for the statement to read.
         """
+        deadline = request_deadline.current()
+        if deadline is not None:
+            deadline.check()
         with self._engine.begin() as connection:
-            if self._schema is not None:
-                if self.dialect == "snowflake":
-                    connection.exec_driver_sql(
-                        f"ALTER SESSION SET search_path='{self._schema}'"
-                    )
-                elif self.dialect == "bigquery":
-                    connection.exec_driver_sql(f"SET @@dataset_id='{self._schema}'")
-                elif self.dialect == "mssql":
-                    pass
-                else:  # postgresql and compatible dialects
-                    connection.exec_driver_sql(f"SET search_path TO {self._schema}")
+            if deadline is not None and self.dialect == "sqlite":
+                raw = connection.connection.driver_connection
+                raw.set_progress_handler(lambda: deadline.expired, 1000)
+                try:
+                    return self._execute_in(connection, command, fetch, sample)
+                except OperationalError as e:
+                    if deadline.expired:
+                        raise request_deadline.DeadlineExceeded(str(e.orig)) from e
+                    raise
+                finally:
+                    raw.set_progress_handler(None, 0)
+            return self._execute_in(connection, command, fetch, sample)
+
+    def _execute_in(
+        self, connection: Any, command: str, fetch: Optional[str], sample: Optional[Sample] = None
+    ) -> Sequence:
+        self._prepare_connection(connection, command)
+        if sample is not None:
+            self._samples.attach(connection, sample)
+        try:
             cursor = connection.execute(text(command))
             if cursor.returns_rows:
                 if fetch == "all":
@@ -395,7 +844,98 @@ class SQLDatabase:
                 else:
                     raise ValueError("Fetch parameter must be either 'one' or 'all'")
                 return result
-        return []
+            return []
+        finally:
+            if sample is not None:
+                self._samples.detach(connection)
+
+    def _prepare_connection(self, connection: Any, command: str) -> None:
+        if self._schema is not None:
+            if self.dialect == "snowflake":
+                connection.exec_driver_sql(
+                    f"ALTER SESSION SET search_path='{self._schema}'"
+                )
+            elif self.dialect == "bigquery":
+                connection.exec_driver_sql(f"SET @@dataset_id='{self._schema}'")
+            elif self.dialect == "mssql":
+                pass
+            else:  # postgresql and compatible dialects
+                connection.exec_driver_sql(f"SET search_path TO {self._schema}")
+        if self._partitions is not None:
+            self._partitions.prepare(connection, command)
+
+    def run_structured(
+        self, command: str, offset: int = 0, limit: Optional[int] = None, batch_size: int = 1000
+    ) -> StructuredResult:
+        """Run a query and stream its rows after the first `offset` ones, at
+        most `limit` of them, in batches of `batch_size`.
+
+        Unlike `run`, rows are neither deduplicated, truncated nor cached, and
+        are never all in memory. Column types are inferred from the first
+        batch. The connection is held until the result is exhausted or closed;
+        SQLite statements are interrupted by the request's deadline, as in
+        `_execute`, for as long as rows are streamed.
+        """
+        deadline = request_deadline.current()
+        if deadline is not None:
+            deadline.check()
+        next_offset: Optional[int] = None
+
+        def batches() -> Iterator[Any]:
+            nonlocal next_offset
+            with self._engine.begin() as connection:
+                raw = None
+                if deadline is not None and self.dialect == "sqlite":
+                    raw = connection.connection.driver_connection
+                    raw.set_progress_handler(lambda: deadline.expired, 1000)
+                try:
+                    self._prepare_connection(connection, command)
+                    cursor = connection.execution_options(stream_results=True).execute(text(command))
+                    if not cursor.returns_rows:
+                        yield [], []
+                        return
+                    skip = offset
+                    while skip > 0:
+                        skipped = cursor.fetchmany(min(skip, batch_size))
+                        if not skipped:
+                            break
+                        skip -= len(skipped)
+                    sent = 0
+
+                    def take() -> list[tuple]:
+                        nonlocal sent, next_offset
+                        if limit is None:
+                            rows = cursor.fetchmany(batch_size)
+                        else:
+                            want = min(batch_size, limit - sent)
+                            if want <= 0:
+                                return []
+                            # one row past the limit tells whether there are more
+                            rows = cursor.fetchmany(want + 1 if sent + want == limit else want)
+                            if len(rows) > want:
+                                rows = rows[:want]
+                                next_offset = offset + limit
+                        sent += len(rows)
+                        return [tuple(row) for row in rows]
+
+                    batch = take()
+                    yield list(cursor.keys()), batch
+                    while batch:
+                        yield batch
+                        batch = take()
+                except OperationalError as e:
+                    if deadline is not None and deadline.expired:
+                        raise request_deadline.DeadlineExceeded(str(e.orig)) from e
+                    raise
+                finally:
+                    if raw is not None:
+                        raw.set_progress_handler(None, 0)
+            result.next_offset = next_offset
+
+        stream = batches()
+        names, first = next(stream)
+        result = StructuredResult(infer_columns(names, first), stream, offset)
+        return result
 
     def run(self, command: str, fetch: str = "all", hard_limit: int = 0) -> str:
         """Execute a SQL command and return a string representing the results.
@@ -403,26 +943,224 @@ class SQLDatabase:
         If the statement returns rows, a string of the results is returned.
         If the statement returns no rows, an empty string is returned.
         """
+        res, _, _ = self.run_truncated(command, fetch, hard_limit)
+        return res
+
+    def run_truncated(
+        self, command: str, fetch: str = "all", hard_limit: int = 0, token_budget: int = 0
+    ) -> tuple[str, int, list]:
+        """Like `run`, but also return how many rows were shown and the omitted ones.
+
+        Rows beyond `hard_limit`, or beyond what fits in `token_budget` tokens
+        once rendered, are omitted. With a `cache`, results are cached per
+        snapshot. Identical commands running at the same time share a single
+        execution.
+        """
+        key = (command, fetch, hard_limit, token_budget)
+        while True:
+            with self._running_lock:
+                running = self._running.get(key)
+                if running is None:
+                    self._running[key] = future = Future()
+                    break
+            deadline = request_deadline.current()
+            try:
+                return running.result(timeout=deadline.remaining() if deadline is not None else None)
+            except FutureTimeoutError:
+                raise request_deadline.DeadlineExceeded('deadline exceeded') from None
+            except request_deadline.DeadlineExceeded:
+                # the deadline of the request running it, not ours
+                if deadline is not None:
+                    deadline.check()
+        try:
+            if self._result_cache is not None:
+                result = self._shared(
+                    'sql', key, lambda: self._run_truncated(command, fetch, hard_limit, token_budget)
+                )
+            else:
+                result = self._run_truncated(command, fetch, hard_limit, token_budget)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._running_lock:
+                del self._running[key]
+
+    def _run_truncated(
+        self, command: str, fetch: str, hard_limit: int, token_budget: int
+    ) -> tuple[str, int, list]:
         result = self._execute(command, fetch)
-        truncated = ''
         # Convert columns values to string to avoid issues with sqlalchemy
         # truncating text
         if not result:
-            return ""
+            return "", 0, []
         elif isinstance(result, list):
-            result = list(dict.fromkeys(result))
-            if hard_limit > 0 and len(result) > hard_limit:
-                old_len = len(result)
-                result = result[:hard_limit]
-                truncated = f'\nIMPORTANT: There were too many results! Other {old_len-hard_limit} rows were omitted!'
-            res = [
-                '- ' + '\t'.join(str(truncate_word(c, length=self._max_string_length)) for c in r)
-                for r in result
-            ]
-            res = '\n'.join(res)
-        else:
-            res = '- ' + '\t'.join(truncate_word(c, length=self._max_string_length) for c in result)
-        return f'{res}{truncated}'
+            return self._truncate(list(dict.fromkeys(result)), hard_limit, token_budget)
+        res = '- ' + '\t'.join(str(truncate_word(c, length=self._max_string_length)) for c in result)
+        return res, 1, []
+
+    def _truncate(
+        self, result: list, hard_limit: int, token_budget: int, columns: Optional[list[str]] = None
+    ) -> tuple[str, int, list]:
+        truncated = ''
+        omitted: list = []
+        if hard_limit > 0 and len(result) > hard_limit:
+            omitted = result[hard_limit:]
+            result = result[:hard_limit]
+        rendered = self.render_result(result, token_budget, columns)
+        omitted = result[rendered.rows:] + omitted
+        result = result[:rendered.rows]
+        if omitted:
+            truncated = f'\nIMPORTANT: There were too many results! Other {len(omitted)} rows were omitted!'
+        return f'{rendered.text}{truncated}', len(result), omitted
+
+    def _statistics(self) -> tuple[dict[str, int], dict[str, list[int]]]:
+        """Rows of each table and `sqlite_stat1` numbers of each index."""
+        table_rows: dict[str, int] = {}
+        index_stats: dict[str, list[int]] = {}
+        has_stats = self._execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'"
+        )
+        if has_stats:
+            for table, index, stat in self._execute("SELECT tbl, idx, stat FROM sqlite_stat1"):
+                numbers = [int(n) for n in stat.split() if n.isdigit()]
+                if not numbers:
+                    continue
+                table_rows[table] = numbers[0]
+                if index is not None:
+                    index_stats[index] = numbers
+        for table in self._usable_tables:
+            if table not in table_rows:
+                table_rows[table] = self._execute(f'SELECT count(*) FROM "{table}"', fetch="one")[0]
+        return table_rows, index_stats
+
+    def estimate_cost(self, command: str) -> Optional[QueryCost]:
+        """Rows `command` is estimated to visit, from SQLite's query plan and
+        the table statistics (see `approximate.plan_cost`). None for other
+        dialects or if the query can't be planned."""
+        if self.dialect != "sqlite":
+            return None
+        try:
+            plan = self._execute(f"EXPLAIN QUERY PLAN {command}")
+        except SQLAlchemyError:
+            return None
+        table_rows, index_stats = self._cached(('statistics',), self._statistics)
+        return approximate.plan_cost([tuple(row) for row in plan], command, table_rows, index_stats)
+
+    def run_approximate(
+        self, command: str, min_cost: float, hard_limit: int = 0, token_budget: int = 0
+    ) -> Optional[tuple[str, int, list, Approximation]]:
+        """Like `run_truncated`, but over a sample of the largest table when
+        `command` is estimated to visit more than `min_cost` rows and only
+        counts, sums and averages (see `approximate.approximable`). Also
+        returns how the result was approximated.
+
+        None, and nothing is run, when the query is cheap enough, can't be
+        approximated or there is no `samples` store; also when the first
+        row of the result comes from too few sampled rows. The sampled
+        table must be read once in the query and have at least
+        `samples.min_rows` rows.
+        """
+        if self._samples is None or self.dialect != "sqlite":
+            return None
+        scaled = approximate.approximable(command)
+        if scaled is None:
+            return None
+        cost = self.estimate_cost(command)
+        if cost is None or cost.rows <= min_cost:
+            return None
+        candidates = [
+            table for table, rows in cost.tables.items()
+            if rows >= self._samples.min_rows and cost.references[table] == 1
+            and approximate.tables_read(command).count(table) == 1
+        ]
+        if not candidates:
+            return None
+        table = max(candidates, key=lambda t: cost.tables[t])
+        key = (command, table, hard_limit, token_budget)
+        compute = lambda: self._run_approximate(command, table, scaled, cost, hard_limit, token_budget)
+        if self._result_cache is not None:
+            return self._shared('approximate', key, compute)
+        return compute()
+
+    def _run_approximate(
+        self, command: str, table: str, scaled: list[bool], cost: QueryCost, hard_limit: int, token_budget: int
+    ) -> Optional[tuple[str, int, list, Approximation]]:
+        sample = self._samples.sample(self._engine, table, self.cache_token())
+        sampled_command = approximate.on_sample(approximate.with_sampled_count(command), table)
+        result = self._execute(sampled_command, sample=sample)
+        if not result or result[0][-1] < self._samples.min_group:
+            return None
+        columns = list(result[0]._fields[:-1])
+        fraction = sample.sampled / sample.rows
+        rows = approximate.scale([tuple(row)[:-1] for row in result], scaled, 1.0 / fraction)
+        approximation = Approximation(
+            table=table, rows=sample.rows, sampled=sample.sampled, cost=cost.rows,
+            margin=approximate.margin(result[0][-1], fraction),
+        )
+        res, shown, omitted = self._truncate(list(dict.fromkeys(rows)), hard_limit, token_budget, columns)
+        return f'{res}\n{approximation.describe()}', shown, omitted, approximation
+
+    def run_page(self, command: str, offset: int, limit: int) -> tuple[list, list[str]]:
+        """Run a query again and return `limit` rows after the first `offset`
+        ones, and the names of their columns.
+
+        Rows are deduplicated like in `run`. They are streamed and the query
+        stops at the end of the page, so only the rows up to it are read.
+        """
+        seen: set = set()
+        page: list = []
+        with self.run_structured(command) as result:
+            columns = [c.name for c in result.columns]
+            for batch in result:
+                for row in batch:
+                    if row in seen:
+                        continue
+                    seen.add(row)
+                    if len(seen) > offset:
+                        page.append(row)
+                        if len(page) >= limit:
+                            return page, columns
+        return page, columns
+
+    def render_result(
+        self, rows: Sequence, token_budget: int = 0, columns: Optional[list[str]] = None
+    ) -> RenderedResult:
+        """Render rows with the most compact encoding, see `render_rows`.
+
+        Long strings are cut with `truncate_word` to `max_string_lengths` of
+        their column, or `max_string_length` by default. `columns` default to
+        the fields of the rows.
+        """
+        if columns is None:
+            columns = list(rows[0]._fields) if rows and hasattr(rows[0], "_fields") else []
+        lengths = [
+            self._max_string_lengths.get(c, self._max_string_length) for c in columns
+        ]
+
+        def truncate(i: int, value: Any) -> str:
+            length = lengths[i] if i < len(lengths) else self._max_string_length
+            return str(truncate_word(value, length=length))
+
+        rendered = render_rows(columns, rows, truncate, token_budget)
+        with self._cache_lock:
+            self._render_stats["results"] += 1
+            self._render_stats["rows"] += rendered.rows
+            self._render_stats["tokens"] += rendered.tokens
+            self._render_stats["baseline_tokens"] += rendered.baseline_tokens
+        return rendered
+
+    def render_stats(self) -> dict[str, int]:
+        """Totals over every rendered result, including the tokens saved."""
+        with self._cache_lock:
+            stats = dict(self._render_stats)
+        stats["tokens_saved"] = stats.get("baseline_tokens", 0) - stats.get("tokens", 0)
+        return stats
+
+    def _format_rows(self, rows: Sequence, columns: Optional[list[str]] = None) -> str:
+        return self.render_result(rows, columns=columns).text if rows else ""
 
     def get_table_info_no_throw(self, table_names: Optional[List[str]] = None) -> str:
         """Get information about specified tables.
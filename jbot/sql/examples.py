@@ -0,0 +1,137 @@
+"""Store of question -> SQL -> answer examples for few-shot prompting."""
+from __future__ import annotations
+
+import json
+import os
+import threading
+from typing import Optional
+
+from pydantic import BaseModel
+
+from ..similarity import NgramIndex, normalize
+from . import prompt_gpt4 as prompt
+from .tokens import count_tokens
+
+
+class Example(BaseModel):
+    question: str
+    sql_query: Optional[str] = None
+    sql_result: Optional[str] = None
+    answer: str
+    pinned: bool = False
+    """Pinned examples are part of every prompt."""
+    source: str = "seed"
+
+
+class ExampleStore:
+    """Examples seeded from `prompt.SEED_EXAMPLES` and grown from production runs.
+
+    Examples are also loaded from the JSON lines of `path`, if given. At most
+    `max_examples` production examples are kept, oldest dropped first.
+    Production examples are unverified, so they are only appended to `path`
+    with `persist`; the file is then compacted to its latest `max_examples`
+    production examples once it holds twice as many lines. Lines other
+    processes append during a compaction may be lost.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_examples: int = 500, persist: bool = False):
+        self.path = path
+        self.max_examples = max_examples
+        self.persist = persist
+        self._lock = threading.Lock()
+        self._examples: dict[str, Example] = {}
+        self._index: NgramIndex[str] = NgramIndex()
+        self._lines = 0
+        for seed in prompt.SEED_EXAMPLES:
+            self._put(Example(**seed))
+        if path is not None and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        self._lines += 1
+                        self._put(Example(**json.loads(line)))
+
+    def __len__(self) -> int:
+        return len(self._examples)
+
+    def _put(self, example: Example) -> bool:
+        key = normalize(example.question)
+        with self._lock:
+            if key in self._examples:
+                return False
+            self._examples[key] = example
+            if not example.pinned:
+                self._index.add(key, example.question)
+            production = [k for k, e in self._examples.items() if e.source != "seed"]
+            for old in production[:max(0, len(production) - self.max_examples)]:
+                del self._examples[old]
+                self._index.remove(old)
+        return True
+
+    def add(self, question: str, sql_query: Optional[str], sql_result: Optional[str], answer: str) -> bool:
+        """Record a successful run. Returns False if the question is already known."""
+        example = Example(
+            question=question.strip(),
+            sql_query=sql_query,
+            sql_result=sql_result,
+            answer=answer.strip(),
+            source="production",
+        )
+        if not self._put(example):
+            return False
+        if self.path is not None and self.persist:
+            with self._lock:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(example.json(ensure_ascii=False) + '\n')
+                self._lines += 1
+                if self._lines >= 2 * self.max_examples:
+                    self._compact()
+        return True
+
+    def _compact(self) -> None:
+        """Rewrite `path` with its hand-written examples and the latest
+        `max_examples` production ones, each question once."""
+        examples: dict[str, Example] = {}
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    example = Example(**json.loads(line))
+                    key = normalize(example.question)
+                    examples.pop(key, None)
+                    examples[key] = example
+        production = [k for k, e in examples.items() if e.source == "production"]
+        for old in production[:max(0, len(production) - self.max_examples)]:
+            del examples[old]
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.writelines(e.json(ensure_ascii=False) + '\n' for e in examples.values())
+        os.replace(tmp, self.path)
+        self._lines = len(examples)
+
+    def queries(self) -> list[tuple[str, str]]:
+        """(question, SQL) of the examples answered with a query, oldest first."""
+        with self._lock:
+            return [(e.question, e.sql_query) for e in self._examples.values() if e.sql_query]
+
+    def select(self, question: str, k: int = 3, token_budget: int = 600) -> list[Example]:
+        """Pinned examples plus up to `k` of the examples most similar to
+        `question`, as long as they fit in `token_budget` tokens."""
+        with self._lock:
+            pinned = [e for e in self._examples.values() if e.pinned]
+        used = sum(count_tokens(prompt.format_example(e.dict())) for e in pinned)
+        selected = []
+        for key, _ in self._index.search(question, k):
+            example = self._examples.get(key)
+            if example is None:
+                continue
+            tokens = count_tokens(prompt.format_example(example.dict()))
+            if used + tokens > token_budget:
+                continue
+            used += tokens
+            selected.append(example)
+        # most similar last, closest to the user prompt
+        return list(reversed(selected)) + pinned
+
+    def format(self, question: str, k: int = 3, token_budget: int = 600) -> str:
+        """The examples block for the query generation prompt."""
+        return prompt.format_examples([e.dict() for e in self.select(question, k, token_budget)])
@@ -0,0 +1,274 @@
+"""Bulk loader for the semester courses database.
+
+Usage:
+    python -m jbot.sql.loader load exports/ --db db.sqlite3
+    python -m jbot.sql.loader vagas vagas.csv --db db.sqlite3
+
+`load` rebuilds every table from `<Table>.csv`, `.jsonl` or `.json` files found in
+the export directory. `vagas` applies vacancy updates to OfertasDisciplina,
+touching only rows whose counts actually changed.
+"""
+from __future__ import annotations
+
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import sys
+import time
+from itertools import islice
+from typing import Any, Iterable, Iterator, Optional
+
+BATCH_SIZE = 5000
+
+# Table name -> (column definitions, table constraints). Mirrors
+# DATABASE_DESCRIPTION_COURSES in prompt.py.
+TABLES: dict[str, tuple[list[tuple[str, str]], list[str]]] = {
+    'Cursos': (
+        [('id_curso', 'TEXT NOT NULL'), ('nome_curso', 'TEXT NOT NULL')],
+        ['PRIMARY KEY (id_curso)'],
+    ),
+    'Disciplinas': (
+        [('id_disc', 'TEXT NOT NULL'), ('nome_disc', 'TEXT NOT NULL')],
+        ['PRIMARY KEY (id_disc)'],
+    ),
+    'DisciplinasMatriz': (
+        [
+            ('id_disc', 'TEXT NOT NULL'),
+            ('id_curso', 'TEXT NOT NULL'),
+            ('periodo', 'INT'),
+            ('is_eletiva', 'INT NOT NULL'),
+        ],
+        ['PRIMARY KEY (id_disc, id_curso)'],
+    ),
+    'Professores': (
+        [('id_prof', 'INT NOT NULL'), ('nome_prof', 'TEXT NOT NULL')],
+        ['PRIMARY KEY (id_prof)'],
+    ),
+    'OfertasDisciplina': (
+        [
+            ('id_oferta', 'INT NOT NULL'),
+            ('id_disc', 'TEXT NOT NULL'),
+            ('id_curso', 'TEXT NOT NULL'),
+            ('id_prof', 'INT'),
+            ('turma', 'TEXT NOT NULL'),
+            ('vagas_restantes', 'INT NOT NULL'),
+            ('vagas_ocupadas', 'INT NOT NULL'),
+        ],
+        ['PRIMARY KEY (id_oferta)'],
+    ),
+    'AulasOferta': (
+        [
+            ('id_oferta', 'INT NOT NULL'),
+            ('id_disc', 'TEXT NOT NULL'),
+            ('nome_local', 'TEXT'),
+            ('dia_semana', 'TEXT NOT NULL'),
+            ('hora_inicio', 'INT NOT NULL'),
+            ('hora_fim', 'INT NOT NULL'),
+        ],
+        [],
+    ),
+}
+
+# Secondary indexes, created only after the bulk insert finished.
+INDEXES: dict[str, list[str]] = {
+    'DisciplinasMatriz': ['id_curso'],
+    'OfertasDisciplina': ['id_disc', 'id_curso', 'id_prof'],
+    'AulasOferta': ['id_oferta', 'id_disc'],
+}
+
+
+def _index_name(table: str, column: str) -> str:
+    return f'idx_{table}_{column}'
+
+
+def create_table_sql(table: str) -> str:
+    columns, constraints = TABLES[table]
+    body = [f'{name} {decl}' for name, decl in columns] + constraints
+    return f'CREATE TABLE IF NOT EXISTS {table} (\n\t' + ',\n\t'.join(body) + '\n);'
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """Open the database with pragmas tuned for bulk writes."""
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute('PRAGMA cache_size = -65536')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    return conn
+
+
+def _coerce(value: Any, decl: str) -> Any:
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = value.strip()
+        if value == '' or value.upper() == 'NULL':
+            return None
+    if decl.startswith('INT'):
+        return int(value)
+    return str(value)
+
+
+def read_records(path: str) -> Iterator[dict[str, Any]]:
+    """Stream records from a CSV (with header) or JSON/JSON lines export."""
+    if path.endswith('.csv'):
+        with open(path, newline='', encoding='utf-8') as f:
+            yield from csv.DictReader(f)
+    elif path.endswith('.jsonl'):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    elif path.endswith('.json'):
+        with open(path, encoding='utf-8') as f:
+            yield from json.load(f)
+    else:
+        raise ValueError(f'Unsupported export format: {path}')
+
+
+def _rows(table: str, records: Iterable[dict[str, Any]]) -> Iterator[tuple]:
+    columns, _ = TABLES[table]
+    for record in records:
+        yield tuple(_coerce(record.get(name), decl) for name, decl in columns)
+
+
+def _batches(rows: Iterable[tuple], size: int = BATCH_SIZE) -> Iterator[list[tuple]]:
+    it = iter(rows)
+    while batch := list(islice(it, size)):
+        yield batch
+
+
+def find_export(directory: str, table: str) -> Optional[str]:
+    for ext in ('.csv', '.jsonl', '.json'):
+        path = os.path.join(directory, f'{table}{ext}')
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def load(conn: sqlite3.Connection, sources: dict[str, Iterable[dict[str, Any]]]) -> dict[str, int]:
+    """Replace the contents of the given tables in a single transaction.
+
+    Secondary indexes are dropped before inserting and rebuilt afterwards, then
+    ANALYZE refreshes the planner statistics. Durable writes are turned off
+    while loading and restored to the connection's setting afterwards. Returns
+    the row count per table.
+    """
+    counts = {}
+    synchronous = conn.execute('PRAGMA synchronous').fetchone()[0]
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        for table in TABLES:
+            conn.execute(create_table_sql(table))
+        for table, columns in INDEXES.items():
+            for column in columns:
+                conn.execute(f'DROP INDEX IF EXISTS {_index_name(table, column)}')
+
+        for table, records in sources.items():
+            columns, _ = TABLES[table]
+            placeholders = ', '.join('?' * len(columns))
+            insert = f'INSERT INTO {table} VALUES ({placeholders})'
+            conn.execute(f'DELETE FROM {table}')
+            counts[table] = 0
+            for batch in _batches(_rows(table, records)):
+                conn.executemany(insert, batch)
+                counts[table] += len(batch)
+
+        for table, columns in INDEXES.items():
+            for column in columns:
+                conn.execute(
+                    f'CREATE INDEX IF NOT EXISTS {_index_name(table, column)} ON {table} ({column})'
+                )
+        conn.execute('ANALYZE')
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.execute(f'PRAGMA synchronous = {int(synchronous)}')
+    # fold the WAL back into the main file so file watchers see the new data
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    return counts
+
+
+def update_vacancies(conn: sqlite3.Connection, records: Iterable[dict[str, Any]]) -> int:
+    """Apply vacancy counts keyed by id_oferta. Returns the number of changed rows.
+
+    Rows whose counts are unchanged are skipped by the WHERE clause, so they are
+    neither rewritten nor bump the modification time of the file. A missing count
+    leaves the current value untouched.
+    """
+    update = (
+        'UPDATE OfertasDisciplina '
+        'SET vagas_restantes = COALESCE(?1, vagas_restantes), vagas_ocupadas = COALESCE(?2, vagas_ocupadas) '
+        'WHERE id_oferta = ?3 '
+        'AND ((?1 IS NOT NULL AND vagas_restantes IS NOT ?1) OR (?2 IS NOT NULL AND vagas_ocupadas IS NOT ?2))'
+    )
+
+    def params():
+        for record in records:
+            restantes = _coerce(record.get('vagas_restantes'), 'INT')
+            ocupadas = _coerce(record.get('vagas_ocupadas'), 'INT')
+            id_oferta = _coerce(record['id_oferta'], 'INT')
+            yield (restantes, ocupadas, id_oferta)
+
+    changed = 0
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        for batch in _batches(params()):
+            before = conn.total_changes
+            conn.executemany(update, batch)
+            changed += conn.total_changes - before
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    if changed:
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    return changed
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m jbot.sql.loader', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default='db.sqlite3', help='database file to write')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    load_cmd = commands.add_parser('load', help='rebuild tables from a directory of exports')
+    load_cmd.add_argument('directory')
+    load_cmd.add_argument('--tables', nargs='*', choices=list(TABLES),
+                          help='only reload these tables (default: every export found)')
+
+    vagas_cmd = commands.add_parser('vagas', help='apply vacancy updates to OfertasDisciplina')
+    vagas_cmd.add_argument('file', help='CSV/JSON with id_oferta, vagas_restantes, vagas_ocupadas')
+
+    args = parser.parse_args(argv)
+    conn = connect(args.db)
+    start = time.perf_counter()
+    try:
+        if args.command == 'load':
+            sources = {}
+            for table in args.tables or TABLES:
+                path = find_export(args.directory, table)
+                if path is None:
+                    if args.tables:
+                        parser.error(f'no export found for table {table}')
+                    continue
+                sources[table] = read_records(path)
+            counts = load(conn, sources)
+            for table, count in counts.items():
+                print(f'{table}: {count} rows')
+        else:
+            changed = update_vacancies(conn, read_records(args.file))
+            print(f'OfertasDisciplina: {changed} rows changed')
+    finally:
+        conn.close()
+    print(f'Done in {time.perf_counter() - start:.2f}s', file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,236 @@
+"""Historical semesters stored as one SQLite file per semester.
+
+Archived semesters are ATTACHed on demand to the connection running a query and
+exposed through temporary `<Table>Historico` views, which are the UNION ALL of
+the current tables and the matching tables of every needed semester, plus a
+`semestre` column. Queries that don't use those views run untouched.
+"""
+from __future__ import annotations
+
+import os
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, Iterable, Optional
+
+from sqlalchemy.exc import OperationalError
+
+# SQLite refuses more than 10 attached databases unless recompiled
+SQLITE_MAX_ATTACHED = 10
+VIEW_SUFFIX = 'Historico'
+
+_literal = r"'(?:[^']|'')*'"
+_column = r'(?:[\w"`\[\]]+\.)?["`\[]?semestre["`\]]?'
+_predicate_re = re.compile(
+    rf'(?P<not>\bNOT\s+)?{_column}\s*(?:'
+    rf'(?P<cmp>==|=|>=|<=|>|<)\s*(?P<value>{_literal})'
+    rf'|(?P<in>IN)\s*\((?P<values>\s*{_literal}(?:\s*,\s*{_literal})*\s*)\)'
+    rf'|(?P<like>LIKE)\s*(?P<pattern>{_literal})'
+    rf'|(?P<between>BETWEEN)\s*(?P<low>{_literal})\s+AND\s+(?P<high>{_literal})'
+    rf')',
+    re.IGNORECASE,
+)
+_join_re = re.compile(rf'{_column}\s*=\s*{_column}', re.IGNORECASE)
+_other_comparison_re = re.compile(
+    rf'{_column}\s*(?:==|=|!=|<>|>=|<=|>|<|\bNOT\b|\bIN\b|\bLIKE\b|\bGLOB\b|\bBETWEEN\b|\bIS\b)',
+    re.IGNORECASE,
+)
+_or_re = re.compile(r'\bOR\b', re.IGNORECASE)
+_placeholder = '__semestre_predicate__'
+_or_between_predicates_re = re.compile(rf'{_placeholder}\s+OR\s+{_placeholder}', re.IGNORECASE)
+
+
+def _unquote(literal: str) -> str:
+    return literal[1:-1].replace("''", "'")
+
+
+def _like_to_regex(pattern: str) -> re.Pattern:
+    parts = ('.*' if c == '%' else '.' if c == '_' else re.escape(c) for c in pattern)
+    return re.compile(''.join(parts), re.IGNORECASE | re.DOTALL)
+
+
+class SemesterPartitions:
+    """Attaches archived semester databases on demand.
+
+    Every `<label>.sqlite3` file in `archive_dir` is a partition holding the
+    same tables as the current database for semester `<label>` (e.g. `2023-1`,
+    labels must sort chronologically). Each connection keeps at most
+    `max_attached` partitions attached, evicting the least recently used ones.
+    """
+
+    def __init__(
+        self,
+        archive_dir: str,
+        current_semester: str,
+        tables: Iterable[str],
+        max_attached: int = 8,
+    ):
+        if not 0 < max_attached <= SQLITE_MAX_ATTACHED:
+            raise ValueError(f'max_attached must be between 1 and {SQLITE_MAX_ATTACHED}')
+        self.archive_dir = archive_dir
+        self.current_semester = current_semester
+        self.tables = list(tables)
+        self.max_attached = max_attached
+        self._columns: dict[tuple[str, str], list[str]] = {}
+        self._lock = threading.Lock()
+        self._view_re = re.compile(
+            r'\b(?:FROM|JOIN)\s+["`\[]?('
+            + '|'.join(re.escape(f'{t}{VIEW_SUFFIX}') for t in self.tables)
+            + r')\b',
+            re.IGNORECASE,
+        )
+        self.rescan()
+
+    def rescan(self) -> None:
+        """Look for new partition files in the archive directory."""
+        paths = {}
+        for name in os.listdir(self.archive_dir):
+            label, ext = os.path.splitext(name)
+            if ext == '.sqlite3' and label != self.current_semester:
+                paths[label] = os.path.join(self.archive_dir, name)
+        with self._lock:
+            self._paths = paths
+            self._columns.clear()
+
+    @property
+    def semesters(self) -> list[str]:
+        return sorted([*self._paths, self.current_semester])
+
+    @property
+    def views(self) -> list[str]:
+        return [f'{t}{VIEW_SUFFIX}' for t in self.tables]
+
+    def describe(self) -> str:
+        """Text for the database description telling the model about the views."""
+        views = ', '.join(self.views)
+        return (
+            f'The tables above only contain the current semester ({self.current_semester}). '
+            f'For other semesters use the views {views}: they have the same columns plus '
+            f'"semestre TEXT" ({", ".join(self.semesters)}). '
+            f'Always filter them by semestre.'
+        )
+
+    def _match(self, predicate: re.Match, semesters: list[str]) -> set[str]:
+        if predicate['cmp']:
+            value = _unquote(predicate['value'])
+            op = predicate['cmp']
+            return {
+                s for s in semesters
+                if (op in ('=', '==') and s == value)
+                or (op == '>' and s > value) or (op == '>=' and s >= value)
+                or (op == '<' and s < value) or (op == '<=' and s <= value)
+            }
+        if predicate['in']:
+            values = {_unquote(v) for v in re.findall(_literal, predicate['values'])}
+            return set(semesters) & values
+        if predicate['like']:
+            regex = _like_to_regex(_unquote(predicate['pattern']))
+            return {s for s in semesters if regex.fullmatch(s)}
+        low, high = _unquote(predicate['low']), _unquote(predicate['high'])
+        return {s for s in semesters if low <= s <= high}
+
+    def prune(self, command: str) -> Optional[list[str]]:
+        """Semesters a query needs, or None if it doesn't use the historical views.
+
+        Pruning is conservative and falls back to every semester whenever the
+        semestre filters can't be proven to restrict every view reference: a
+        negated or non-literal comparison, an OR mixing other conditions, or
+        more view references than filters and `a.semestre = b.semestre` joins.
+        """
+        references = len(self._view_re.findall(command))
+        if not references:
+            return None
+        semesters = self.semesters
+
+        predicates = list(_predicate_re.finditer(command))
+        rest = _predicate_re.sub(_placeholder, command)
+        joins = len(_join_re.findall(rest))
+        rest = _join_re.sub('', rest)
+        rest_without_ors = _or_between_predicates_re.sub(_placeholder, rest)
+        prunable = (
+            predicates
+            and not any(p['not'] for p in predicates)
+            and not _other_comparison_re.search(rest)
+            and not _or_re.search(rest_without_ors)
+            and len(predicates) + joins >= references
+        )
+        if not prunable:
+            return semesters
+
+        needed: set[str] = set()
+        for predicate in predicates:
+            needed |= self._match(predicate, semesters)
+        return sorted(needed)
+
+    def prepare(self, connection: Any, command: str) -> None:
+        """Attach the partitions `command` needs and point the views at them.
+
+        `connection` is a SQLAlchemy connection; the attached partitions and the
+        current view definitions are remembered in its `info` dictionary, which
+        lives as long as the underlying DBAPI connection.
+        """
+        needed = self.prune(command)
+        if needed is None:
+            return
+        archived = [s for s in needed if s != self.current_semester]
+        if len(archived) > self.max_attached:
+            message = (
+                f'The query spans {len(archived)} archived semesters but at most '
+                f'{self.max_attached} can be queried at once. Narrow the semestre filter.'
+            )
+            raise OperationalError(command, None, sqlite3.OperationalError(message))
+
+        attached: OrderedDict[str, str] = connection.info.setdefault('jbot_partitions', OrderedDict())
+        for label in archived:
+            if label in attached:
+                attached.move_to_end(label)
+                continue
+            while len(attached) >= self.max_attached:
+                old_label, old_alias = next(
+                    (l, a) for l, a in attached.items() if l not in archived
+                )
+                connection.exec_driver_sql(f'DETACH DATABASE "{old_alias}"')
+                del attached[old_label]
+            alias = 'semestre_' + re.sub(r'\W', '_', label)
+            connection.exec_driver_sql('ATTACH DATABASE ? AS "' + alias + '"', (self._paths[label],))
+            attached[label] = alias
+
+        views_key = tuple(needed)
+        if connection.info.get('jbot_partition_views') == views_key:
+            return
+        for table in self.tables:
+            current_columns = self._table_columns(connection, 'main', table)
+            selects = []
+            for label in needed:
+                schema = 'main' if label == self.current_semester else attached[label]
+                columns = set(self._table_columns(connection, schema, table, label))
+                if not columns:
+                    continue
+                exprs = ', '.join(
+                    f'"{c}"' if c in columns else f'NULL AS "{c}"' for c in current_columns
+                )
+                selects.append(f"SELECT '{label}' AS semestre, {exprs} FROM \"{schema}\".\"{table}\"")
+            if not selects:
+                # no semester matches: the query runs and finds nothing
+                columns = ', '.join(f'"{c}"' for c in current_columns)
+                selects.append(f'SELECT CAST(NULL AS TEXT) AS semestre, {columns} FROM main."{table}" WHERE 0')
+            view = f'{table}{VIEW_SUFFIX}'
+            connection.exec_driver_sql(f'DROP VIEW IF EXISTS temp."{view}"')
+            connection.exec_driver_sql(
+                f'CREATE TEMP VIEW "{view}" AS ' + ' UNION ALL '.join(selects)
+            )
+        connection.info['jbot_partition_views'] = views_key
+
+    def _table_columns(self, connection: Any, schema: str, table: str, label: Optional[str] = None) -> list[str]:
+        key = (label or self.current_semester, table)
+        if label is not None and label != self.current_semester:
+            with self._lock:
+                if key in self._columns:
+                    return self._columns[key]
+        rows = connection.exec_driver_sql(f'PRAGMA "{schema}".table_info("{table}")').fetchall()
+        columns = [row[1] for row in rows]
+        if label is not None and label != self.current_semester:
+            with self._lock:
+                self._columns[key] = columns
+        return columns
@@ -7,9 +7,34 @@ When asked, inform the user that all information in this database is non authori
 {database_description}
 """
 
-DATABASE_DESCRIPTION_COURSES = """This database manages academic information for the university, covering courses, subjects, professors, class schedules, and classroom details, all interconnected to provide a comprehensive overview of the educational offerings.
+DATABASE_PREAMBLE_COURSES = """This database manages academic information for the university, covering courses, subjects, professors, class schedules, and classroom details, all interconnected to provide a comprehensive overview of the educational offerings.
 This database only contains information about the current academic semester.
+"""
 
+# the hand-written notes of DATABASE_DESCRIPTION_COURSES, for the generated description
+COLUMN_COMMENTS_COURSES = {
+  "Cursos": {
+    "id_curso": "valores como G010, G014 ...",
+    "nome_curso": 'valores como "Ciência da Computação", "Sistemas de Informação", ...',
+  },
+  "Disciplinas": {
+    "id_disc": "valores como GCC116, GAC112, GFI312, GMM114 ...",
+  },
+  "DisciplinasMatriz": {
+    "periodo": "NULL se a disciplina não for obrigatória",
+    "cat_eletiva": "not NULL se a disciplina for eletiva",
+  },
+  "Aulas": {
+    "nome_local": "valores como PV1-102, DCC01, ...",
+    "dia_semana": "valores como terça, sábado ...",
+  },
+  "AulasOferta": {
+    "nome_local": "valores como PV1-102, DCC01, ...",
+    "dia_semana": "valores como terça, sábado ...",
+  },
+}
+
+DATABASE_DESCRIPTION_COURSES = DATABASE_PREAMBLE_COURSES + """
 CREATE TABLE IF NOT EXISTS Cursos (
 \tid_curso TEXT PRIMARY KEY, -- valores como G010, G014 ...
 \tnome_curso TEXT NOT NULL -- valores como "Ciência da Computação", "Sistemas de Informação", ...
@@ -87,35 +112,52 @@ SQLResult: [the result of the sqlite query]
 Answer: [Respond to the user's prompt directly, in the user's language]
 """
 
-_examples = """
-Some interaction examples:
----
-User: qual é o nome completo do hermes?
-
-StepByStep: [... snip for brevity ...]
-SQLQuery: ```SELECT nome_prof
-FROM Professores
-WHERE nome_prof LIKE '%Hermes%';
-```
-
-SQLResult: ```- HERMES PIMENTA DE MORAES JUNIOR 
-```
-
-Answer: O nome completo do Hermes é Hermes Pimenta de Moraes Junior.
----
-User: qual é o professor favorito?
-
-Answer: Não há informações diretas sobre preferências ou avaliações que possam indicar qual é o "professor favorito".
----
-End of examples
-"""
+SEED_EXAMPLES = [
+  {
+    "question": "qual é o nome completo do hermes?",
+    "sql_query": "SELECT nome_prof\nFROM Professores\nWHERE nome_prof LIKE '%Hermes%';",
+    "sql_result": "- HERMES PIMENTA DE MORAES JUNIOR ",
+    "answer": "O nome completo do Hermes é Hermes Pimenta de Moraes Junior.",
+  },
+  {
+    "question": "qual é o professor favorito?",
+    "answer": 'Não há informações diretas sobre preferências ou avaliações que possam indicar qual é o "professor favorito".',
+    "pinned": True,
+  },
+]
+
+def format_example(example: dict) -> str:
+  if not example.get("sql_query"):
+    return f'User: {example["question"]}\n\nAnswer: {example["answer"]}\n'
+  return (
+    f'User: {example["question"]}\n\n'
+    f'StepByStep: [... snip for brevity ...]\n'
+    f'SQLQuery: ```{example["sql_query"]}\n```\n\n'
+    f'SQLResult: ```{example.get("sql_result") or "No results."}\n```\n\n'
+    f'Answer: {example["answer"]}\n'
+  )
+
+def format_examples(examples: list[dict]) -> str:
+  body = ''.join(f'---\n{format_example(e)}' for e in examples)
+  return f'\nSome interaction examples:\n{body}---\nEnd of examples\n'
+
+_examples = format_examples(SEED_EXAMPLES)
 
 GEN_QUERY_PROMPT = PromptTemplate(
   input_variables=["database_description"],
+  partial_variables={"examples": _examples},
   template=
     _admin_prefix +
     _process_prefix +
-    _examples
+    "{examples}"
+)
+
+# follows a rejected query in the conversation, so the next model sees it
+RETRY_PROMPT = PromptTemplate(
+  input_variables=["sql_result", "reason"],
+  template=
+    "SQLResult: {sql_result}\n\n"
+    "That query was rejected ({reason}). Write a corrected SQLQuery, in the same format."
 )
 
 ANSWER_PROMPT = PromptTemplate(
@@ -0,0 +1,130 @@
+"""Compact text encodings of query results for prompts."""
+from __future__ import annotations
+
+from collections import Counter
+from typing import Any, Callable, Optional, Sequence
+
+from pydantic import BaseModel
+
+from .tokens import count_tokens
+
+# values shorter than this are cheaper inline than as a dictionary reference
+_MIN_DICT_VALUE_LENGTH = 8
+
+
+class RenderedResult(BaseModel):
+    text: str
+    encoding: str
+    rows: int
+    """Number of rows rendered."""
+    tokens: int
+    baseline_tokens: int
+    """Tokens the plain one-row-per-line encoding would have used."""
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.baseline_tokens - self.tokens
+
+
+def _cells(rows: Sequence[Sequence[Any]], truncate: Callable[[int, Any], str]) -> list[list[str]]:
+    return [[truncate(i, c) for i, c in enumerate(r)] for r in rows]
+
+
+def _encode_rows(cells: list[list[str]]) -> str:
+    return '\n'.join('- ' + '\t'.join(r) for r in cells)
+
+
+def _encode_grouped(cells: list[list[str]], k: int) -> str:
+    """Group contiguous runs sharing the first `k` values, keeping row order."""
+    lines = []
+    previous = None
+    for r in cells:
+        key = r[:k]
+        if key != previous:
+            lines.append('- ' + '\t'.join(key) + ':')
+            previous = key
+        lines.append('  - ' + '\t'.join(r[k:]))
+    return '\n'.join(lines)
+
+
+def _dictionary(cells: list[list[str]]) -> dict[str, str]:
+    counts = Counter(v for r in cells for v in r if len(v) >= _MIN_DICT_VALUE_LENGTH)
+    repeated = [v for v, n in counts.most_common() if n > 1]
+    return {v: f'${i}' for i, v in enumerate(repeated, 1)}
+
+
+def _apply_dictionary(cells: list[list[str]], refs: dict[str, str]) -> tuple[list[list[str]], str]:
+    legend = 'Values: ' + '; '.join(f'{ref}={v}' for v, ref in refs.items())
+    return [[refs.get(v, v) for v in r] for r in cells], legend
+
+
+def _candidates(columns: Sequence[str], cells: list[list[str]]) -> list[tuple[str, str]]:
+    candidates = [('rows', _encode_rows(cells))]
+    if len(cells) < 2:
+        return candidates
+    header = 'Columns: ' + '\t'.join(columns)
+
+    def grouped(cells: list[list[str]]) -> list[tuple[int, str]]:
+        out = []
+        for k in range(1, len(columns)):
+            runs = sum(1 for a, b in zip(cells, cells[1:]) if a[:k] == b[:k])
+            if runs:
+                out.append((k, _encode_grouped(cells, k)))
+        return out
+
+    for k, text in grouped(cells):
+        candidates.append((f'grouped({k})', f'{header}\n{text}'))
+
+    refs = _dictionary(cells)
+    if refs:
+        encoded, legend = _apply_dictionary(cells, refs)
+        candidates.append(('dictionary', f'{header}\n{legend}\n{_encode_rows(encoded)}'))
+        for k, text in grouped(encoded):
+            candidates.append((f'dictionary+grouped({k})', f'{header}\n{legend}\n{text}'))
+    return candidates
+
+
+def render_rows(
+    columns: Sequence[str],
+    rows: Sequence[Sequence[Any]],
+    truncate: Callable[[int, Any], str],
+    token_budget: int = 0,
+    model: str = 'gpt-4',
+) -> RenderedResult:
+    """Render rows with the most compact encoding that keeps every value.
+
+    Candidates are the plain `- v1\\tv2` lines, contiguous runs grouped by their
+    leading columns, and repeated long values replaced by `$n` references. All
+    but the plain encoding emit the column names once.
+
+    With `token_budget`, only the longest prefix of `rows` that fits in the
+    budget is rendered (at least one row); `rows` of the result tells how many.
+    `truncate(column_index, value)` formats each value.
+    """
+    cells = _cells(rows, truncate)
+
+    def best(n: int) -> tuple[str, str, int, int]:
+        scored = [
+            (count_tokens(text, model), name, text)
+            for name, text in _candidates(columns, cells[:n])
+        ]
+        baseline = scored[0][0]
+        tokens, name, text = min(scored, key=lambda s: s[0])
+        return name, text, tokens, baseline
+
+    n = len(cells)
+    name, text, tokens, baseline = best(n)
+    if token_budget > 0 and tokens > token_budget and n > 1:
+        # binary search the longest prefix that fits
+        lo, hi = 1, n - 1
+        fit: Optional[tuple[int, tuple[str, str, int, int]]] = None
+        while lo <= hi:
+            mid = (lo + hi) // 2
+            candidate = best(mid)
+            if candidate[2] <= token_budget:
+                fit = (mid, candidate)
+                lo = mid + 1
+            else:
+                hi = mid - 1
+        n, (name, text, tokens, baseline) = fit or (1, best(1))
+    return RenderedResult(text=text, encoding=name, rows=n, tokens=tokens, baseline_tokens=baseline)
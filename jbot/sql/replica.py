@@ -0,0 +1,134 @@
+"""In-memory replica of a SQLite database file with hot swapping."""
+from __future__ import annotations
+
+import itertools
+import os
+import sqlite3
+import threading
+from typing import Callable, Optional
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+_replica_ids = itertools.count()
+
+
+def _file_signature(path: str) -> tuple:
+    """Cheap change detector for a SQLite file and its WAL companion.
+
+    An empty WAL holds no changes; it comes and goes as readers open and
+    close the file, so it counts as no WAL at all.
+    """
+    signature = []
+    for p in (path, f'{path}-wal'):
+        try:
+            st = os.stat(p)
+        except FileNotFoundError:
+            signature.append(None)
+            continue
+        signature.append((st.st_mtime_ns, st.st_size) if st.st_size or p == path else None)
+    return tuple(signature)
+
+
+class SQLiteReplica:
+    """Keeps a copy of a SQLite file in a shared-cache in-memory database.
+
+    The file is copied with the SQLite backup API. Each snapshot lives in its own
+    named in-memory database, kept alive by a "keeper" connection. Swapping only
+    repoints new connections to the new snapshot: connections checked out by
+    in-flight queries keep reading the old snapshot, which SQLite frees once its
+    last connection is closed.
+    """
+
+    def __init__(self, path: str, watch_interval: float = 0.0):
+        self.path = path
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._uri: Optional[str] = None
+        self._keeper: Optional[sqlite3.Connection] = None
+        self._signature: Optional[tuple] = None
+        self._listeners: list[Callable[[], None]] = []
+        self._stop = threading.Event()
+        self._watcher: Optional[threading.Thread] = None
+        self.version = 0
+
+        self._load()
+        # not the SingletonThreadPool used for sqlite:// by default, which closes
+        # connections of other threads once more than pool_size threads use it
+        self.engine: Engine = create_engine(
+            'sqlite://', creator=self._connect, poolclass=QueuePool, pool_size=8, max_overflow=-1
+        )
+        if watch_interval > 0:
+            self.watch(watch_interval)
+
+    @property
+    def signature(self) -> Optional[tuple]:
+        """File signature of the snapshot currently served."""
+        with self._lock:
+            return self._signature
+
+    def _connect(self) -> sqlite3.Connection:
+        with self._lock:
+            uri = self._uri
+        return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+    def _load(self) -> None:
+        signature = _file_signature(self.path)
+        uri = f'file:jbot_replica_{next(_replica_ids)}?mode=memory&cache=shared'
+        keeper = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        source = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True)
+        try:
+            source.backup(keeper)
+        finally:
+            source.close()
+
+        with self._lock:
+            old_keeper = self._keeper
+            self._uri = uri
+            self._keeper = keeper
+            self._signature = signature
+            self.version += 1
+        if old_keeper is not None:
+            old_keeper.close()
+
+    def on_swap(self, callback: Callable[[], None]) -> None:
+        """Register a callback to run right after a new snapshot is swapped in."""
+        self._listeners.append(callback)
+
+    def refresh(self, force: bool = False) -> bool:
+        """Reload the source file if it changed. Returns whether a swap happened."""
+        with self._refresh_lock:
+            if not force and _file_signature(self.path) == self._signature:
+                return False
+            self._load()
+            # connections pooled for the old snapshot are dereferenced rather than
+            # closed, so checked out ones stay valid until their queries finish
+            self.engine.dispose(close=False)
+            for callback in self._listeners:
+                callback()
+            return True
+
+    def watch(self, interval: float) -> None:
+        """Poll the source file in a daemon thread and swap on changes."""
+        if self._watcher is not None:
+            return
+
+        def loop():
+            while not self._stop.wait(interval):
+                try:
+                    self.refresh()
+                except sqlite3.Error:
+                    # the file may be mid-write, try again on the next tick
+                    continue
+
+        self._watcher = threading.Thread(target=loop, name='jbot-replica-watch', daemon=True)
+        self._watcher.start()
+
+    def close(self) -> None:
+        self._stop.set()
+        self.engine.dispose()
+        with self._lock:
+            if self._keeper is not None:
+                self._keeper.close()
+                self._keeper = None
@@ -0,0 +1,230 @@
+"""Reuse of the SQL written for earlier questions that mean the same thing.
+
+Questions are embedded locally as hashed, IDF-weighted vectors of their
+content words and of the words' character trigrams, with a few domain
+synonyms folded together, and compared by brute force against a matrix of
+the questions already answered. The SQL of a close enough match is run again
+against the current data, so only the model call that writes it is saved.
+
+Lexical similarity can't tell "redes" from "redes neurais", so a match is
+only used when `guard` agrees that both questions name the same things.
+"""
+from __future__ import annotations
+
+import re
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Iterable, Optional
+
+import numpy as np
+from pydantic import BaseModel
+
+from ..similarity import normalize
+
+_stopwords = set('''
+a ao aos as com como da das de do dos e em entre essa esse esta este eu isso
+me meu minha na nas no nos o os ou para pela pelo por pra qual quais
+que se sobre sua seu tem ter todas todos um uma uns umas vai voce
+favor pfv pls obrigado obrigada oi ola bom boa tarde noite jota
+'''.split())
+
+# words that say what is asked, not about what; any other word names
+# something (a discipline, a person, a place) and must be in both questions
+_synonyms = {
+    'professor': ('quem', 'professor', 'professores', 'professora', 'professoras', 'prof', 'docente', 'docentes',
+                  'ensina', 'ensinam', 'leciona', 'lecionam', 'ministra', 'ministram', 'responsavel'),
+    'disciplina': ('disciplina', 'disciplinas', 'materia', 'materias', 'cadeira', 'cadeiras'),
+    'horario': ('horario', 'horarios', 'hora', 'horas', 'dia', 'dias', 'quando'),
+    'turma': ('turma', 'turmas', 'oferta', 'ofertas', 'ofertada', 'ofertadas', 'oferecida', 'oferecidas'),
+    'vaga': ('vaga', 'vagas'),
+    'curso': ('curso', 'cursos', 'graduacao'),
+    'aula': ('aula', 'aulas', 'dao', 'dar'),
+    'quantos': ('quantos', 'quantas', 'numero', 'total'),
+    'sala': ('sala', 'salas', 'local', 'lugar', 'onde', 'predio'),
+}
+_canonical = {word: canon for canon, words in _synonyms.items() for word in words}
+_generic = set('''
+ementa ementas credito creditos periodo periodos semestre matriz codigo
+requisito requisitos coordenador nome completo existe existem lista listar
+mostra mostre diga fala sabe saber ha hoje amanha agora ainda tambem mais
+'''.split())
+
+_number_re = re.compile(r'\w*\d\w*')
+_literal_re = re.compile(r"'((?:[^']|'')*)'")
+
+
+def content_words(text: str) -> list[str]:
+    """Normalized words of `text` without stopwords, synonyms folded."""
+    words = normalize(text).split()
+    return [_canonical.get(w, w) for w in words if w not in _stopwords]
+
+
+def _intent(words: Iterable[str]) -> set[str]:
+    # these go with any question: "quem da aula", "horario da turma"
+    return {w for w in words if w in _synonyms and w not in ('aula', 'turma')}
+
+
+def _entities(words: Iterable[str]) -> set[str]:
+    return {w for w in words if w not in _synonyms and w not in _generic and len(w) > 2}
+
+
+def _grounded(word: str, words: set[str]) -> bool:
+    # "redes" names the same thing as "rede"; compare up to a short stem
+    stem = word[:5]
+    return any(w[:5] == stem for w in words)
+
+
+def guard(question: str, cached_question: str, sql_query: str) -> Optional[str]:
+    """Why the SQL written for `cached_question` can't answer `question`, or
+    None if it can.
+
+    Numbers and codes must be the same, and so must what is asked (who,
+    when, where, how many...); every entity named by `question` must
+    be in `cached_question` or the string literals of the SQL, and every
+    entity named by `cached_question` in `question`, so "redes" and "redes
+    neurais" don't match either way; and each literal grounded in
+    `cached_question` must still be grounded in `question`.
+    """
+    if set(_number_re.findall(normalize(question))) != set(_number_re.findall(normalize(cached_question))):
+        return 'numbers differ'
+    words = set(content_words(question))
+    cached_words = set(content_words(cached_question))
+    if _intent(words) != _intent(cached_words):
+        return 'asks something else'
+    literals = [set(normalize(lit.replace("''", "'")).split()) for lit in _literal_re.findall(sql_query)]
+    known = cached_words.union(*literals)
+    for entity in _entities(words):
+        if not _grounded(entity, known):
+            return f'"{entity}" is not in the query'
+    for entity in _entities(cached_words):
+        if not _grounded(entity, words):
+            return f'"{entity}" is not in the question'
+    for literal in literals:
+        grounded = {w for w in _entities(literal) if _grounded(w, cached_words)}
+        if grounded and not any(_grounded(w, words) for w in grounded):
+            return 'filters on something else'
+    return None
+
+
+class SemanticHit(BaseModel):
+    question: str
+    sql_query: str
+    score: float
+
+
+class SemanticCache:
+    """In-memory map from answered questions to their SQL, searched by
+    meaning.
+
+    Keeps the `max_entries` most recently used questions. `lookup` returns the
+    most similar one scoring at least `threshold` (cosine) that `guard`
+    accepts. Vectors have `dim` hashed features.
+    """
+
+    def __init__(self, threshold: float = 0.65, max_entries: int = 4000, dim: int = 2048, candidates: int = 5):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.dim = dim
+        self.candidates = candidates
+        self._lock = threading.Lock()
+        # normalized question -> (slot, question, sql_query), least recently used first
+        self._entries: OrderedDict[str, tuple[int, str, str]] = OrderedDict()
+        self._free: list[int] = []
+        self._matrix = np.zeros((0, dim), dtype=np.float32)
+        self._squares = np.zeros((0, dim), dtype=np.float32)
+        self._df = np.zeros(dim, dtype=np.float32)
+        self.stats = {'lookups': 0, 'hits': 0, 'guarded': 0}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def vector(self, question: str) -> np.ndarray:
+        """Sublinear term frequencies of the hashed features of `question`."""
+        v = np.zeros(self.dim, dtype=np.float32)
+        for word in content_words(question):
+            features = [f'w:{word}']
+            padded = f' {word} '
+            features.extend(padded[i:i + 3] for i in range(len(padded) - 2))
+            for feature in features:
+                v[zlib.crc32(feature.encode()) % self.dim] += 1.0
+        np.log1p(v, out=v)
+        return v
+
+    def add(self, question: str, sql_query: str) -> None:
+        key = normalize(question)
+        v = self.vector(question)
+        if not v.any():
+            return
+        with self._lock:
+            if key in self._entries:
+                slot = self._entries.pop(key)[0]
+                self._df -= self._matrix[slot] > 0
+            elif self._free:
+                slot = self._free.pop()
+            elif len(self._entries) >= self.max_entries:
+                _, (slot, _, _) = self._entries.popitem(last=False)
+                self._df -= self._matrix[slot] > 0
+            else:
+                slot = len(self._entries)
+                if slot >= len(self._matrix):
+                    size = max(16, 2 * len(self._matrix))
+                    self._matrix = np.resize(self._matrix, (size, self.dim))
+                    self._squares = np.resize(self._squares, (size, self.dim))
+                    self._matrix[slot:] = 0.0
+                    self._squares[slot:] = 0.0
+            self._matrix[slot] = v
+            self._squares[slot] = v * v
+            self._df += v > 0
+            self._entries[key] = (slot, question, sql_query)
+
+    def add_many(self, pairs: Iterable[tuple[str, str]]) -> None:
+        for question, sql_query in pairs:
+            self.add(question, sql_query)
+
+    def remove(self, question: str) -> None:
+        with self._lock:
+            entry = self._entries.pop(normalize(question), None)
+            if entry is not None:
+                slot = entry[0]
+                self._df -= self._matrix[slot] > 0
+                self._matrix[slot] = 0.0
+                self._squares[slot] = 0.0
+                self._free.append(slot)
+
+    def search(self, question: str, k: int = 5) -> list[SemanticHit]:
+        """Up to `k` most similar questions, best first, without the guard."""
+        q = self.vector(question)
+        with self._lock:
+            self.stats['lookups'] += 1
+            if not self._entries or not q.any():
+                return []
+            n = len(self._entries)
+            idf = np.log((1.0 + n) / (1.0 + self._df)) + 1.0
+            weighted = q * idf
+            q_norm = float(np.linalg.norm(weighted))
+            norms = np.sqrt(self._squares @ (idf * idf))
+            dots = self._matrix @ (weighted * idf)
+            scores = np.divide(dots, norms * q_norm, out=np.zeros_like(dots), where=norms > 0)
+            by_slot = {slot: (question, sql_query) for slot, question, sql_query in self._entries.values()}
+        best = np.argsort(-scores)[:k]
+        return [
+            SemanticHit(question=by_slot[i][0], sql_query=by_slot[i][1], score=float(scores[i]))
+            for i in best if i in by_slot and scores[i] > 0
+        ]
+
+    def lookup(self, question: str) -> Optional[SemanticHit]:
+        """The SQL of the closest earlier question meaning the same, if any."""
+        for hit in self.search(question, self.candidates):
+            if hit.score < self.threshold:
+                break
+            if guard(question, hit.question, hit.sql_query) is None:
+                with self._lock:
+                    self.stats['hits'] += 1
+                    key = normalize(hit.question)
+                    if key in self._entries:
+                        self._entries.move_to_end(key)
+                return hit
+            with self._lock:
+                self.stats['guarded'] += 1
+        return None
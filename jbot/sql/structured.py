@@ -0,0 +1,195 @@
+"""Query results for programs: typed columns, streamed in batches.
+
+`SQLDatabase.run_structured` yields the rows of a query in batches straight
+from the database cursor; the functions here encode them as columnar JSON,
+NDJSON or Arrow IPC without holding more than a batch in memory.
+"""
+from __future__ import annotations
+
+import base64
+import datetime
+import decimal
+import json
+from typing import Any, Iterable, Iterator, Optional, Sequence
+
+from pydantic import BaseModel
+
+FORMATS = ('json', 'ndjson', 'arrow')
+
+# widest first: a column holding several of these gets the first one present
+_TYPE_ORDER = ('blob', 'text', 'real', 'integer', 'boolean', 'null')
+
+
+class Column(BaseModel):
+    name: str
+    type: str
+    """One of 'integer', 'real', 'text', 'blob', 'boolean' or 'null' (no
+    non-null value seen)."""
+
+
+class StructuredResult:
+    """Columns of a query and an iterator over its rows, in batches.
+
+    Holds a database connection until the batches are exhausted or `close`
+    is called. `next_offset` is set, once the batches are exhausted, when
+    rows beyond `limit` remain.
+    """
+
+    def __init__(self, columns: list[Column], batches: Iterator[list[tuple]], offset: int):
+        self.columns = columns
+        self.offset = offset
+        self.next_offset: Optional[int] = None
+        self._batches = batches
+
+    def __iter__(self) -> Iterator[list[tuple]]:
+        return self._batches
+
+    def close(self) -> None:
+        self._batches.close()  # type: ignore[attr-defined]
+
+    def __enter__(self) -> StructuredResult:
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+
+def value_type(value: Any) -> str:
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'boolean'
+    if isinstance(value, int):
+        return 'integer'
+    if isinstance(value, (float, decimal.Decimal)):
+        return 'real'
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return 'blob'
+    return 'text'
+
+
+def infer_columns(names: Sequence[str], rows: Sequence[Sequence[Any]]) -> list[Column]:
+    """Column types from sample rows; SQLite doesn't declare result types."""
+    columns = []
+    for i, name in enumerate(names):
+        seen = {value_type(row[i]) for row in rows}
+        if 'integer' in seen and 'real' in seen:
+            seen.discard('integer')
+        if len(seen - {'null'}) > 1:
+            seen = {'text'}
+        columns.append(Column(name=name, type=next(t for t in _TYPE_ORDER if t in seen or t == 'null')))
+    return columns
+
+
+def json_value(value: Any) -> Any:
+    """`value` as JSON can hold it, without truncation."""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return base64.b64encode(bytes(value)).decode()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    return value
+
+
+def columnar_json(result: StructuredResult) -> dict[str, Any]:
+    """The whole result as `{"columns", "values", "rows", "offset",
+    "next_offset"}`, with `values` holding one list per column."""
+    values: list[list[Any]] = [[] for _ in result.columns]
+    rows = 0
+    with result:
+        for batch in result:
+            for row in batch:
+                for i, v in enumerate(row):
+                    values[i].append(json_value(v))
+            rows += len(batch)
+    return {
+        'columns': [c.dict() for c in result.columns],
+        'values': values,
+        'rows': rows,
+        'offset': result.offset,
+        'next_offset': result.next_offset,
+    }
+
+
+def ndjson_lines(result: StructuredResult) -> Iterator[str]:
+    """A `{"columns"}` line, one JSON array per row, then a `{"rows",
+    "next_offset"}` line."""
+    yield json.dumps({'columns': [c.dict() for c in result.columns]}) + '\n'
+    rows = 0
+    with result:
+        for batch in result:
+            yield ''.join(json.dumps([json_value(v) for v in row], ensure_ascii=False) + '\n' for row in batch)
+            rows += len(batch)
+    yield json.dumps({'rows': rows, 'offset': result.offset, 'next_offset': result.next_offset}) + '\n'
+
+
+def arrow_available() -> bool:
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _arrow_values(values: Iterable[Any], type: str) -> list[Any]:
+    # SQLite may store any value in any column; values not matching the
+    # inferred type are sent as they'd be in text
+    if type == 'text':
+        return [v if v is None or isinstance(v, str) else str(json_value(v)) for v in values]
+    expected = {'integer': int, 'real': (int, float), 'boolean': bool, 'blob': (bytes, bytearray, memoryview)}[type]
+    return [v if v is None or isinstance(v, expected) else None for v in values]
+
+
+class _Chunks:
+    """Write-only file collecting what is written, to be drained."""
+
+    closed = False
+
+    def __init__(self):
+        self._chunks: list[bytes] = []
+        self._position = 0
+
+    def write(self, data: Any) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def arrow_stream(result: StructuredResult) -> Iterator[bytes]:
+    """The result as an Arrow IPC stream, one record batch per batch. Needs
+    pyarrow. Columns with no type seen are strings; values that don't match
+    their column's type are null, except in text columns."""
+    import pyarrow as pa
+
+    types = {
+        'integer': pa.int64(), 'real': pa.float64(), 'text': pa.string(),
+        'blob': pa.binary(), 'boolean': pa.bool_(), 'null': pa.string(),
+    }
+    kinds = [c.type if c.type != 'null' else 'text' for c in result.columns]
+    schema = pa.schema([pa.field(c.name, types[c.type]) for c in result.columns])
+    sink = _Chunks()
+    with result, pa.ipc.new_stream(sink, schema) as writer:
+        for batch in result:
+            arrays = [
+                pa.array(_arrow_values((row[i] for row in batch), kind), type=schema.field(i).type)
+                for i, kind in enumerate(kinds)
+            ]
+            writer.write_batch(pa.record_batch(arrays, schema=schema))
+            yield sink.drain()
+    yield sink.drain()
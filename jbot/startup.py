@@ -0,0 +1,104 @@
+"""Startup time report: where a cold start of the API spends its time.
+
+Imports `api` in a fresh interpreter under `python -X importtime`, builds
+the chain, and breaks the time down by imported package and startup step:
+
+    python -m jbot.startup --budget 0.5 --top 15
+
+Exits with status 1 if importing `api` (the time until the server can bind)
+takes longer than `--budget` seconds.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from typing import Any, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import api
+imported = time.perf_counter() - start
+if {init}:
+    api.init()
+print(json.dumps({{"import": imported, "startup": api.startup}}))
+'''
+
+
+def parse_importtime(output: str) -> list[tuple[str, int, int]]:
+    """(module, self µs, cumulative µs) from `-X importtime` output."""
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules.append((name.strip(), int(self_us), int(cumulative_us)))
+    return modules
+
+
+def profile(cwd: str = '.', init: bool = True) -> dict[str, Any]:
+    env = dict(
+        os.environ,
+        JBOT_INIT='lazy',
+        PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])),
+    )
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', _SCRIPT.format(init=init)],
+        cwd=cwd, env=env, capture_output=True, text=True,
+    )
+    wall = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr[-3000:])
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    modules = parse_importtime(result.stderr)
+    packages: dict[str, int] = defaultdict(int)
+    for name, self_us, _ in modules:
+        packages[name.split('.')[0]] += self_us
+    report.update({
+        'process_seconds': wall,
+        'packages': {p: us / 1e6 for p, us in sorted(packages.items(), key=lambda p: -p[1])},
+        'modules': [
+            {'module': name, 'self': self_us / 1e6, 'cumulative': cumulative_us / 1e6}
+            for name, self_us, cumulative_us in sorted(modules, key=lambda m: -m[2])
+        ],
+    })
+    return report
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m jbot.startup', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cwd', default='.', help='directory api.py runs in (where db.sqlite3 is)')
+    parser.add_argument('--no-init', action='store_true', help="don't build the chain, only import api")
+    parser.add_argument('--budget', type=float, help='seconds allowed for importing api')
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--output', help='write the JSON report here')
+    args = parser.parse_args(argv)
+
+    report = profile(args.cwd, init=not args.no_init)
+    print(f'import api: {report["import"]:.3f}s (server can bind)')
+    for step, seconds in report['startup'].items():
+        print(f'  init {step:<10} {seconds:.3f}s')
+    print(f'process total: {report["process_seconds"]:.3f}s')
+    print('packages by import time:')
+    for package, seconds in list(report['packages'].items())[:args.top]:
+        print(f'  {package:<24} {seconds:.3f}s')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    if args.budget is not None and report['import'] > args.budget:
+        print(f'over budget: {report["import"]:.3f}s > {args.budget:.3f}s', file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,197 @@
+"""Warms the caches with the traffic they are about to see.
+
+With JBOT_REQUEST_LOG set, the API logs every answered request to that JSONL
+file (rotated at JBOT_REQUEST_LOG_MAX_BYTES). After startup and after
+each database snapshot swap, `Warmer` replays the most frequent prompts and
+SQL queries of that log in a background thread, so the schema description,
+SQL results and answers are cached before users ask for them. Prompts cost
+model calls, so they stop once `token_budget` tokens are spent.
+
+    python -m jbot.warm request_log.jsonl
+
+prints what would be replayed.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import threading
+import time
+from collections import Counter
+from typing import TYPE_CHECKING, Any, Optional
+
+from . import deadline as request_deadline
+from . import logfile
+from .similarity import normalize
+
+if TYPE_CHECKING:
+    from .sql.chain import SQLChain
+
+
+def mine(path: str, max_age: Optional[float] = None) -> tuple[list[tuple[str, int]], list[tuple[str, int]]]:
+    """The (prompt, count) and (SQL query, count) pairs of the log at `path`
+    (and the part of it rotated away), most frequent first.
+
+    Only prompts answered from the database without context are counted, as
+    only those are cached independently of the chat; prompts are grouped by
+    normalized text, the latest wording standing for each group. Entries
+    older than `max_age` seconds are ignored.
+    """
+    prompts: Counter = Counter()
+    wording: dict[str, str] = {}
+    queries: Counter = Counter()
+    oldest = time.time() - max_age if max_age else 0.0
+    for part in logfile.files(path):
+        with open(part, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get('at', 0.0) < oldest or entry.get('error'):
+                    continue
+                if entry.get('sql_query'):
+                    queries[entry['sql_query']] += 1
+                question = entry.get('question')
+                if question and entry.get('tool') == 'cursos' and not entry.get('context'):
+                    key = normalize(question)
+                    prompts[key] += 1
+                    wording[key] = question
+    return (
+        [(wording[key], count) for key, count in prompts.most_common()],
+        queries.most_common(),
+    )
+
+
+class Warmer:
+    """Replays the top `max_queries` queries and `max_prompts` prompts of the
+    request log at `log_path` through `chain`, once per database snapshot.
+
+    Runs in a background thread at the lowest CPU priority, pausing `pause`
+    seconds between items. Prompts stop once their model calls used
+    `token_budget` tokens. With a shared cache, only one of the processes
+    using it warms each snapshot.
+    """
+
+    def __init__(
+        self,
+        chain: SQLChain,
+        log_path: str,
+        max_prompts: int = 50,
+        max_queries: int = 200,
+        token_budget: int = 50000,
+        max_age: Optional[float] = 7 * 86400.0,
+        pause: float = 0.05,
+        item_timeout: float = 60.0,
+    ):
+        self.chain = chain
+        self.log_path = log_path
+        self.max_prompts = max_prompts
+        self.max_queries = max_queries
+        self.token_budget = token_budget
+        self.max_age = max_age
+        self.pause = pause
+        self.item_timeout = item_timeout
+        self.last_run: dict[str, Any] = {}
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        chain.db.on_invalidate(self.schedule)
+
+    def schedule(self) -> None:
+        """Warm again soon, in the background."""
+        self._wake.set()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name='jbot-warm', daemon=True)
+            self._thread.start()
+
+    def _loop(self) -> None:
+        try:
+            # niceness is per thread on Linux: live requests come first
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError):
+            pass
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            try:
+                self.last_run = self.warm()
+            except Exception as e:
+                self.last_run = {'error': repr(e)}
+
+    def warm(self) -> dict[str, Any]:
+        """Warm the caches now. Returns what was done."""
+        from langchain.callbacks import get_openai_callback
+
+        from .router import with_context
+        from .sql.chain import _query_re
+
+        start = time.perf_counter()
+        db = self.chain.db
+        token = db.cache_token()
+        cache = self.chain.answer_cache
+        report: dict[str, Any] = {'token': token, 'queries': 0, 'prompts': 0, 'tokens': 0, 'errors': 0}
+        if cache is not None and not cache.claim('warm', 'snapshot', token):
+            report['skipped'] = 'warmed by another process'
+            return report
+        if not logfile.files(self.log_path):
+            report['skipped'] = 'no request log'
+            return report
+        prompts, queries = mine(self.log_path, self.max_age)
+
+        self.chain.get_database_description()
+        db.get_queryable_names()
+
+        for sql_query, _ in queries[:self.max_queries]:
+            if db.cache_token() != token:
+                report['stopped'] = 'snapshot changed'
+                return report
+            query = _query_re.match(sql_query.strip()).group('query')
+            try:
+                with request_deadline.deadline(self.item_timeout):
+                    db.run_truncated(query, hard_limit=self.chain.hard_limit, token_budget=self.chain.sql_token_budget)
+                report['queries'] += 1
+            except Exception:
+                report['errors'] += 1
+            time.sleep(self.pause)
+
+        for question, _ in prompts[:self.max_prompts]:
+            if report['tokens'] >= self.token_budget:
+                report['stopped'] = 'token budget'
+                break
+            if db.cache_token() != token:
+                report['stopped'] = 'snapshot changed'
+                break
+            try:
+                with get_openai_callback() as cb, request_deadline.deadline(self.item_timeout):
+                    self.chain({'prompt': with_context(question, ''), 'question': question})
+                report['prompts'] += 1
+            except Exception:
+                report['errors'] += 1
+            report['tokens'] += cb.total_tokens
+            time.sleep(self.pause)
+        report['seconds'] = time.perf_counter() - start
+        return report
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m jbot.warm', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('log', help='request log (JSONL)')
+    parser.add_argument('--prompts', type=int, default=50)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--max-age', type=float, default=7.0, help='days of log to use')
+    args = parser.parse_args(argv)
+
+    prompts, queries = mine(args.log, args.max_age * 86400)
+    print(f'{len(prompts)} distinct prompts, {len(queries)} distinct queries')
+    for question, count in prompts[:args.prompts]:
+        print(f'{count:6d}  {question}')
+    print()
+    for query, count in queries[:args.queries]:
+        print(f'{count:6d}  {" ".join(query.split())}')
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,348 @@
+"""Vacancy watches: chats told when the vacancies of an offering change.
+
+Instead of asking "ainda tem vaga em GCC125?" over and over, a chat says
+"me avise de vagas em GCC125" once. `VacancyWatcher` then diffs the watched
+rows of `OfertasDisciplina` whenever the data changes: each row's vacancy
+columns are hashed and compared with the hash stored at the previous check,
+so only the watched disciplines are read and only the chats watching a
+changed row get a notification. The bridge fetches notifications from the
+API and delivers them.
+
+Watches, row hashes and notifications live in a SQLite file shared by the
+workers of `jbot.serve`; a change is stored once however many of them see it.
+"""
+from __future__ import annotations
+
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Iterable, Optional
+
+from pydantic import BaseModel
+
+from .similarity import normalize
+
+if TYPE_CHECKING:
+    from .sql.db import SQLDatabase
+
+_code_re = re.compile(r'\b([a-z]{2,4}) ?(\d{3,5})\b')
+_class_re = re.compile(r'\bturma ([a-z0-9]{1,3})\b')
+# news ("quais avisos da reitoria saíram?") also mention avisos, so listing
+# and cancelling need the vacancies or the chat's own watches named
+_list_re = re.compile(
+    r'^(quais|ver|listar?|mostr[ae]r?)\b.*\bavisos? de vagas?\b'
+    r'|^((quais sao|ver|listar?|mostr[ae]r?) )?(os )?meus avisos\b|^avisos de vagas?$'
+)
+_cancel_re = re.compile(
+    r'\b(pare|parar|para de|cancel\w*|desativ\w*|nao precisa)\b.*'
+    r'(\bme avis\w*|\bmeus avisos\b|\bavis\w*\b.*\bvagas?\b)'
+)
+_watch_re = re.compile(r'\b(me )?avis[ae]\w*\b.*\bvagas?\b|^avisar\b')
+_vacancy_re = re.compile(r'\bvagas?\b')
+
+
+class Watch(BaseModel):
+    chat: str
+    id_disc: str
+    turma: str = ''
+    """'' for every class of the discipline."""
+    created: float
+
+
+class Notification(BaseModel):
+    id: int
+    chat: str
+    text: str
+    created: float
+
+
+class Offering(BaseModel):
+    id_oferta: int
+    id_disc: str
+    turma: str
+    vagas_restantes: int
+    vagas_ocupadas: int
+
+    @property
+    def digest(self) -> str:
+        return hashlib.sha1(repr((self.vagas_restantes, self.vagas_ocupadas)).encode()).hexdigest()[:16]
+
+
+def parse_command(message: str) -> Optional[tuple[str, Optional[str], Optional[str]]]:
+    """('watch' | 'cancel' | 'list', discipline code, class) if `message`
+    asks to manage vacancy watches."""
+    text = normalize(message)
+    code = _code_re.search(text)
+    disc = f'{code.group(1)}{code.group(2)}'.upper() if code else None
+    turma = _class_re.search(text)
+    turma = turma.group(1).upper() if turma else None
+    if _list_re.search(text):
+        return 'list', None, None
+    if _cancel_re.search(text):
+        return 'cancel', disc, turma
+    if _watch_re.search(text):
+        return 'watch', disc, turma
+    return None
+
+
+def _describe(offering: Offering) -> str:
+    return f'turma {offering.turma}: {offering.vagas_restantes} vagas restantes ({offering.vagas_ocupadas} ocupadas)'
+
+
+class WatchStore:
+    """Watches, the last seen hash of each watched offering and pending
+    notifications, in the SQLite file at `path`. Notifications are kept for
+    `retention` seconds."""
+
+    def __init__(self, path: str = 'watches.sqlite3', retention: float = 7 * 86400.0):
+        self.path = path
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5.0, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode = WAL')
+        self._conn.executescript(
+            'CREATE TABLE IF NOT EXISTS watches '
+            "(chat TEXT NOT NULL, id_disc TEXT NOT NULL, turma TEXT NOT NULL DEFAULT '', created REAL NOT NULL, "
+            'PRIMARY KEY (chat, id_disc, turma));'
+            'CREATE INDEX IF NOT EXISTS watches_disc ON watches (id_disc);'
+            'CREATE TABLE IF NOT EXISTS watch_state '
+            '(id_oferta INTEGER PRIMARY KEY, id_disc TEXT NOT NULL, turma TEXT NOT NULL, digest TEXT NOT NULL, '
+            'vagas_restantes INTEGER NOT NULL, vagas_ocupadas INTEGER NOT NULL);'
+            'CREATE TABLE IF NOT EXISTS notifications '
+            '(id INTEGER PRIMARY KEY AUTOINCREMENT, chat TEXT NOT NULL, text TEXT NOT NULL, key TEXT UNIQUE, '
+            'created REAL NOT NULL, delivered REAL);'
+        )
+
+    def add(self, chat: str, id_disc: str, turma: str = '') -> None:
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO watches VALUES (?, ?, ?, ?)', (chat, id_disc, turma, time.time())
+            )
+
+    def remove(self, chat: str, id_disc: Optional[str] = None, turma: Optional[str] = None) -> int:
+        """Drop the watches of `chat`, on `id_disc` (and `turma`) if given.
+        Returns how many there were."""
+        query, args = 'DELETE FROM watches WHERE chat = ?', [chat]
+        if id_disc is not None:
+            query += ' AND id_disc = ?'
+            args.append(id_disc)
+            if turma is not None:
+                query += ' AND turma = ?'
+                args.append(turma)
+        with self._lock:
+            removed = self._conn.execute(query, args).rowcount
+            self._conn.execute('DELETE FROM watch_state WHERE id_disc NOT IN (SELECT id_disc FROM watches)')
+        return removed
+
+    def watches(self, chat: Optional[str] = None) -> list[Watch]:
+        query, args = 'SELECT chat, id_disc, turma, created FROM watches', []
+        if chat is not None:
+            query += ' WHERE chat = ?'
+            args.append(chat)
+        with self._lock:
+            rows = self._conn.execute(query + ' ORDER BY id_disc, turma', args).fetchall()
+        return [Watch(chat=c, id_disc=d, turma=t, created=at) for c, d, t, at in rows]
+
+    def watched_disciplines(self) -> list[str]:
+        with self._lock:
+            return [row[0] for row in self._conn.execute('SELECT DISTINCT id_disc FROM watches ORDER BY id_disc')]
+
+    def baseline(self, offerings: Iterable[Offering]) -> None:
+        """Record the state of offerings not seen before, without notifying."""
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR IGNORE INTO watch_state VALUES (?, ?, ?, ?, ?, ?)',
+                [(o.id_oferta, o.id_disc, o.turma, o.digest, o.vagas_restantes, o.vagas_ocupadas) for o in offerings],
+            )
+
+    def apply(self, disciplines: list[str], offerings: list[Offering], version: str) -> int:
+        """Diff the current `offerings` of `disciplines` against the stored
+        hashes, store the new ones and queue a notification for each chat
+        watching a changed offering. Returns how many were queued.
+
+        Runs as one write transaction, so processes applying the same data
+        one after the other find nothing left to do the second time.
+        """
+        now = time.time()
+        current = {o.id_oferta: o for o in offerings}
+        marks = ','.join('?' * len(disciplines))
+        with self._lock:
+            conn = self._conn
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                stored: dict[int, Offering] = {}
+                digests: dict[int, str] = {}
+                for id_oferta, id_disc, turma, digest, restantes, ocupadas in conn.execute(
+                    f'SELECT * FROM watch_state WHERE id_disc IN ({marks})', disciplines
+                ):
+                    stored[id_oferta] = Offering(id_oferta=id_oferta, id_disc=id_disc, turma=turma,
+                                                 vagas_restantes=restantes, vagas_ocupadas=ocupadas)
+                    digests[id_oferta] = digest
+                watchers: dict[str, list[tuple[str, str]]] = {}
+                for chat, id_disc, turma in conn.execute(
+                    f'SELECT chat, id_disc, turma FROM watches WHERE id_disc IN ({marks})', disciplines
+                ):
+                    watchers.setdefault(id_disc, []).append((chat, turma))
+
+                messages = []
+                for id_oferta, offering in current.items():
+                    before = stored.get(id_oferta)
+                    if before is None:
+                        text = f'Nova turma de {offering.id_disc} ofertada, {_describe(offering)}.'
+                    elif digests[id_oferta] != offering.digest:
+                        text = (
+                            f'As vagas de {offering.id_disc} mudaram, {_describe(offering)};'
+                            f' antes eram {before.vagas_restantes} restantes.'
+                        )
+                    else:
+                        continue
+                    messages.append((offering, text))
+                for id_oferta, offering in stored.items():
+                    if id_oferta not in current:
+                        messages.append((offering, f'A turma {offering.turma} de {offering.id_disc} não está mais ofertada.'))
+
+                queued = 0
+                for offering, text in messages:
+                    for chat, turma in watchers.get(offering.id_disc, []):
+                        if turma and turma != offering.turma:
+                            continue
+                        key = f'{chat}:{offering.id_oferta}:{version}'
+                        queued += conn.execute(
+                            'INSERT OR IGNORE INTO notifications (chat, text, key, created) VALUES (?, ?, ?, ?)',
+                            (chat, text, key, now),
+                        ).rowcount
+
+                conn.executemany(
+                    'INSERT OR REPLACE INTO watch_state VALUES (?, ?, ?, ?, ?, ?)',
+                    [(o.id_oferta, o.id_disc, o.turma, o.digest, o.vagas_restantes, o.vagas_ocupadas)
+                     for o in current.values()],
+                )
+                gone = [i for i in stored if i not in current]
+                conn.executemany('DELETE FROM watch_state WHERE id_oferta = ?', [(i,) for i in gone])
+                conn.execute('DELETE FROM notifications WHERE created < ?', (now - self.retention,))
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        return queued
+
+    def pending(self, limit: int = 100) -> list[Notification]:
+        """Notifications not delivered yet, oldest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT id, chat, text, created FROM notifications WHERE delivered IS NULL ORDER BY id LIMIT ?',
+                (limit,),
+            ).fetchall()
+        return [Notification(id=i, chat=c, text=t, created=at) for i, c, t, at in rows]
+
+    def ack(self, ids: Iterable[int]) -> None:
+        with self._lock:
+            self._conn.executemany(
+                'UPDATE notifications SET delivered = ? WHERE id = ?', [(time.time(), i) for i in ids]
+            )
+
+
+class VacancyWatcher:
+    """Checks the watched offerings of `db` for changes after each snapshot
+    swap, and at least every `interval` seconds for databases changed in
+    place, queueing notifications in `store`."""
+
+    def __init__(self, db: SQLDatabase, store: WatchStore, interval: float = 60.0):
+        self.db = db
+        self.store = store
+        self.interval = interval
+        self.last_check: dict[str, Any] = {}
+        self._version: Optional[str] = None
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        db.on_invalidate(self.schedule)
+
+    def schedule(self) -> None:
+        """Check soon, in the background, and every `interval` seconds after."""
+        self._wake.set()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name='jbot-watch', daemon=True)
+            self._thread.start()
+
+    def _loop(self) -> None:
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.check()
+            except Exception as e:
+                self.last_check = {'error': repr(e)}
+
+    def offerings(self, disciplines: list[str]) -> list[Offering]:
+        # codes come from `parse_command`, letters and digits only
+        codes = ','.join(f"'{d}'" for d in disciplines if d.isalnum())
+        rows = self.db._execute(
+            'SELECT id_oferta, id_disc, turma, vagas_restantes, vagas_ocupadas '
+            f'FROM OfertasDisciplina WHERE id_disc IN ({codes})'
+        )
+        return [
+            Offering(id_oferta=i, id_disc=d, turma=t, vagas_restantes=r, vagas_ocupadas=o)
+            for i, d, t, r, o in rows
+        ]
+
+    def check(self) -> int:
+        """Diff the watched offerings now, if the data changed since the last
+        check. Returns how many notifications were queued."""
+        version = self.db.cache_token()
+        if version == self._version:
+            return 0
+        start = time.perf_counter()
+        disciplines = self.store.watched_disciplines()
+        queued = 0
+        if disciplines:
+            queued = self.store.apply(disciplines, self.offerings(disciplines), version)
+        self._version = version
+        self.last_check = {
+            'version': version, 'disciplines': len(disciplines), 'queued': queued,
+            'seconds': time.perf_counter() - start, 'at': time.time(),
+        }
+        return queued
+
+    def handle(self, chat: str, message: str) -> Optional[str]:
+        """The reply to `message` if it manages vacancy watches, else None."""
+        command = parse_command(message)
+        if command is None:
+            return None
+        action, disc, turma = command
+        if action == 'list':
+            watches = self.store.watches(chat)
+            if not watches:
+                return 'Você não tem avisos de vagas. Para criar um, diga "me avise de vagas em GCC125".'
+            return 'Avisos de vagas ativos:\n' + '\n'.join(
+                f'- {w.id_disc}' + (f' turma {w.turma}' if w.turma else '') for w in watches
+            )
+        if action == 'cancel':
+            removed = self.store.remove(chat, disc, turma)
+            if not removed:
+                return 'Não encontrei esse aviso de vagas.'
+            return f'Pronto, cancelei {removed} aviso(s) de vagas.'
+        if disc is None:
+            return 'De qual disciplina? Diga o código, por exemplo "me avise de vagas em GCC125".'
+        offerings = [o for o in self.offerings([disc]) if not turma or o.turma == turma]
+        if not offerings:
+            return f'Não encontrei ofertas de {disc}' + (f' turma {turma}' if turma else '') + ' neste semestre.'
+        self.store.add(chat, disc, turma or '')
+        self.store.baseline(offerings)
+        return (
+            f'Pronto! Aviso aqui quando as vagas de {disc} mudarem. Agora:\n'
+            + '\n'.join(f'- {_describe(o)}' for o in offerings)
+        )
+
+    def hint(self, chat: str, question: str) -> Optional[str]:
+        """A suggestion to watch the discipline `question` asks the vacancies
+        of, unless `chat` already does."""
+        text = normalize(question)
+        code = _code_re.search(text)
+        if code is None or not _vacancy_re.search(text):
+            return None
+        disc = f'{code.group(1)}{code.group(2)}'.upper()
+        if any(w.id_disc == disc for w in self.store.watches(chat)):
+            return None
+        return f'Quer saber quando mudar? Diga "me avise de vagas em {disc}".'
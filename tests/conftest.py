@@ -0,0 +1,11 @@
+import pytest
+
+from jbot.bench import synthetic
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    """A small synthetic course database."""
+    path = str(tmp_path / 'db.sqlite3')
+    synthetic.build(path, scale=0.2)
+    return path
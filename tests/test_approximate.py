@@ -0,0 +1,71 @@
+import math
+
+import pytest
+
+from jbot.sql import approximate
+from jbot.sql.approximate import SampleStore
+from jbot.sql.db import SQLDatabase
+
+
+@pytest.mark.parametrize('command, scaled', [
+    ('SELECT count(*) FROM OfertasDisciplina', [True]),
+    ('SELECT sum(vagas_restantes) total FROM OfertasDisciplina', [True]),
+    ('SELECT id_curso, count(*) AS n, avg(vagas_ocupadas) FROM OfertasDisciplina GROUP BY id_curso',
+     [False, True, False]),
+])
+def test_approximable(command, scaled):
+    assert approximate.approximable(command) == scaled
+
+
+@pytest.mark.parametrize('command', [
+    'SELECT count(DISTINCT id_disc) FROM OfertasDisciplina',
+    'SELECT max(vagas_restantes) FROM OfertasDisciplina',
+    'SELECT avg(vagas_restantes) FROM OfertasDisciplina',
+    'SELECT * FROM OfertasDisciplina',
+    'SELECT id_curso, count(*) FROM OfertasDisciplina GROUP BY id_curso HAVING count(*) > 1',
+    "SELECT count(*) FROM OfertasDisciplina WHERE id_disc IN (SELECT id_disc FROM Disciplinas)",
+])
+def test_not_approximable(command):
+    assert approximate.approximable(command) is None
+
+
+def test_scale_keeps_integers():
+    rows = approximate.scale([('G010', 3, 2.5, None)], [False, True, True, True], 10.0)
+    assert rows == [('G010', 30, 25.0, None)]
+    assert isinstance(rows[0][1], int)
+
+
+def test_margin():
+    assert approximate.margin(100, 0.1) == pytest.approx(1.96 * math.sqrt(0.9 / 100))
+    assert approximate.margin(400, 0.1) == pytest.approx(approximate.margin(100, 0.1) / 2)
+    assert approximate.margin(0, 0.1) == math.inf
+
+
+def test_sample_rewrites():
+    command = 'SELECT count(*) FROM OfertasDisciplina o JOIN Cursos c ON o.id_curso = c.id_curso'
+    counted = approximate.with_sampled_count(command)
+    assert f'count(*), count(*) AS {approximate.SAMPLED_COUNT} FROM' in counted
+    assert approximate.on_sample(counted, 'OfertasDisciplina').endswith(
+        f'FROM {approximate.SAMPLE_ALIAS}."OfertasDisciplina" o JOIN Cursos c ON o.id_curso = c.id_curso'
+    )
+    assert approximate.on_sample('SELECT * FROM OfertasDisciplinas', 'OfertasDisciplina') == \
+        'SELECT * FROM OfertasDisciplinas'
+
+
+def test_run_approximate_scales_by_the_sample(db_path, tmp_path):
+    samples = SampleStore(str(tmp_path), fraction=0.5, strata={'OfertasDisciplina': 'id_curso'},
+                          min_rows=1, min_group=1)
+    db = SQLDatabase.from_uri(f'sqlite:///{db_path}', samples=samples)
+    (total,), = db._execute('SELECT count(*) FROM OfertasDisciplina')
+
+    command = 'SELECT count(*), sum(vagas_restantes) FROM OfertasDisciplina'
+    assert db.run_approximate(command, min_cost=total) is None
+    text, _, _, approximation = db.run_approximate(command, min_cost=0)
+    assert approximation.rows == total
+    assert 0 < approximation.sampled < total
+    assert approximation.margin == pytest.approx(
+        approximate.margin(approximation.sampled, approximation.sampled / total)
+    )
+    # a count of the whole sample scales back to the table's rows
+    assert text.splitlines()[0].startswith(f'- {total}\t')
+    assert approximation.describe() in text
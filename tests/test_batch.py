@@ -0,0 +1,50 @@
+import threading
+import time
+
+from jbot import deadline as request_deadline
+from jbot.batch import run_batch
+
+
+class FakeChain:
+    """Answers prompts with the deadline they ran under, or waits for it to
+    be cancelled when told to."""
+
+    def __init__(self):
+        self.started = threading.Event()
+
+    def get_database_description(self):
+        return ''
+
+    def __call__(self, inputs):
+        d = request_deadline.current()
+        if inputs['prompt'] == 'wait':
+            self.started.set()
+            while not d.expired:
+                time.sleep(0.01)
+            d.check()
+        return {'response': d.remaining(), 'sql_query': None, 'cursor': None}
+
+
+def _prompt(prompt, context):
+    return prompt
+
+
+def test_prompts_run_under_a_deadline():
+    with request_deadline.deadline(5):
+        results = list(run_batch(FakeChain(), [{'prompt': 'a'}, {'prompt': 'b'}, {'prompt': 'a'}], _prompt, timeout=30))
+    answers = [r for r in results if 'index' in r]
+    assert len(answers) == 3
+    assert all(0 < r['answer'] <= 5 for r in answers)
+    assert results[-1]['unique'] == 2
+
+    results = list(run_batch(FakeChain(), [{'prompt': 'a'}], _prompt, timeout=2))
+    assert 0 < results[0]['answer'] <= 2
+
+
+def test_cancelling_the_batch_cancels_its_prompts():
+    chain = FakeChain()
+    with request_deadline.deadline(30) as d:
+        results = run_batch(chain, [{'prompt': 'wait'}], _prompt, timeout=30)
+        threading.Thread(target=lambda: chain.started.wait(5) and d.cancel(), daemon=True).start()
+        first = next(results)
+    assert 'cancelled' in first['error']
@@ -0,0 +1,14 @@
+import pytest
+
+from jbot.cache import LocalCache, SharedCache
+from jbot.sql.db import SQLDatabase
+
+
+def test_shared_cache_needs_a_shared_token(db_path, tmp_path):
+    cache = SharedCache(str(tmp_path / 'cache.sqlite3'))
+    assert SQLDatabase.from_uri(f'sqlite:///{db_path}', cache=cache).result_cache is cache
+
+    with pytest.warns(UserWarning, match='local to the process'):
+        db = SQLDatabase.from_uri('sqlite://', cache=cache)
+    assert not db.shares_cache_token()
+    assert isinstance(db.result_cache, LocalCache)
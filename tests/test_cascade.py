@@ -0,0 +1,84 @@
+import pytest
+from langchain.chat_models.fake import FakeListChatModel
+from langchain.schema import AIMessage, HumanMessage
+
+from jbot.sql.cascade import low_confidence
+from jbot.sql.chain import SQLChain
+from jbot.sql.db import SQLDatabase
+from jbot.sql.examples import ExampleStore
+
+
+@pytest.mark.parametrize('query', [
+    "SELECT * FROM OfertasDisciplina WHERE id_disc = 'GCC125'",
+    "SELECT * FROM DisciplinasMatriz WHERE id_curso='G010'",
+    "SELECT * FROM AulasOferta WHERE dia_semana = 'terça'",
+    "SELECT * FROM Disciplinas WHERE nome_disc LIKE '%redes%'",
+])
+def test_exact_filters_are_confident(query):
+    assert low_confidence(None, query, None) is None
+
+
+@pytest.mark.parametrize('query', [
+    "SELECT * FROM Disciplinas WHERE nome_disc = 'Redes'",
+    "SELECT * FROM Professores p WHERE p.nome_prof='ana'",
+])
+def test_name_equality_escalates(query):
+    assert low_confidence(None, query, None) == 'compares a name with ='
+
+
+class RecordingChatModel(FakeListChatModel):
+    model_name: str
+    calls: list = []
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs):
+        self.calls.append(messages)
+        return super()._call(messages, stop, run_manager, **kwargs)
+
+
+def test_failed_query_escalates_to_next_model(db_path):
+    cheap = RecordingChatModel(model_name='cheap', calls=[], responses=[
+        'StepByStep: [Consultar]\nSQLQuery: SELECT nome FROM Cursoss\n',
+    ])
+    strong = RecordingChatModel(model_name='strong', calls=[], responses=[
+        'StepByStep: [Consultar]\nSQLQuery: SELECT id_curso FROM Cursos\n',
+        'Answer: Há cursos.',
+    ])
+    chain = SQLChain(
+        llm=strong, query_llms=[cheap, strong], db=SQLDatabase.from_uri(f'sqlite:///{db_path}'),
+        database_description='',
+    )
+    assert chain({'prompt': 'Quais são os cursos?'})['response'] == 'Há cursos.'
+
+    report = chain.cascade_report()
+    assert report['query:cheap']['hit_rate'] == 0
+    assert sum(report['query:cheap']['escalations'].values()) == 1
+    assert report['query:strong']['hit_rate'] == 1
+    # the strong model sees the rejected query and why it was rejected
+    retry = strong.calls[0]
+    assert isinstance(retry[-2], AIMessage) and 'Cursoss' in retry[-2].content
+    assert isinstance(retry[-1], HumanMessage) and 'rejected' in retry[-1].content
+
+
+def test_last_attempt_never_runs_other_statements(db_path):
+    db = SQLDatabase.from_uri(f'sqlite:///{db_path}')
+    (before,), = db._execute('SELECT count(*) FROM Cursos')
+    llm = RecordingChatModel(model_name='only', calls=[], responses=[
+        'StepByStep: [Consultar]\nSQLQuery: DELETE FROM Cursos\n',
+    ])
+    chain = SQLChain(llm=llm, db=db, database_description='')
+    assert chain({'prompt': 'Apague os cursos'})['response'] == 'Sorry, I failed to get an answer.'
+    assert db._execute('SELECT count(*) FROM Cursos') == [(before,)]
+    assert chain.cascade_report()['query:only']['escalations'] == {'not a SELECT query': 1}
+
+
+def test_doubtful_last_attempts_are_not_examples(db_path):
+    llm = RecordingChatModel(model_name='only', calls=[], responses=[
+        "StepByStep: [Consultar]\nSQLQuery: SELECT nome_disc FROM Disciplinas WHERE nome_disc = 'Redes de Computadores'\n",
+        'Answer: Redes de Computadores.',
+    ])
+    store = ExampleStore()
+    chain = SQLChain(llm=llm, db=SQLDatabase.from_uri(f'sqlite:///{db_path}'), database_description='',
+                     example_store=store)
+    seeded = len(store)
+    assert chain({'prompt': 'Quais disciplinas de redes?'})['response'] == 'Redes de Computadores.'
+    assert len(store) == seeded
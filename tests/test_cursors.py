@@ -0,0 +1,103 @@
+import sqlite3
+
+import pytest
+
+from langchain.chat_models.fake import FakeListChatModel
+
+from jbot.sql.chain import RESULTS_EXPIRED, SQLChain
+from jbot.sql.cursors import ResultCursorStore
+from jbot.sql.db import SQLDatabase
+
+QUERY = 'SELECT id_curso FROM Cursos ORDER BY id_curso'
+
+
+def _chain(db, **kwargs):
+    return SQLChain(
+        llm=FakeListChatModel(responses=['']), db=db, database_description='', hard_limit=3,
+        cursors=ResultCursorStore(**kwargs),
+    )
+
+
+def test_cursors_are_isolated_between_chats(db_path):
+    chain = _chain(SQLDatabase.from_uri(f'sqlite:///{db_path}'))
+    alice = chain.run_sql(QUERY, chat='alice')
+    anonymous = chain.run_sql(QUERY)
+    assert alice.cursor_id and anonymous.cursor_id
+
+    assert chain.page(chat='bob') is None
+    assert chain.page() is None
+    assert chain.page(chat=None) is None
+    # chat-less results are still reachable by their cursor id
+    page = chain.page(cursor_id=anonymous.cursor_id)
+    assert page is not None
+    assert chain.page(chat='alice').sql_result == page.sql_result
+
+
+def test_pages_without_buffered_rows(db_path):
+    db = SQLDatabase.from_uri(f'sqlite:///{db_path}')
+    chain = _chain(db, max_rows_per_chat=0)
+    expected = [row[0] for row in db._execute(QUERY)]
+    result = chain.run_sql(QUERY, chat='alice')
+    seen = []
+    while result.cursor_id is not None:
+        result = chain.page(chat='alice', limit=4)
+        lines = result.sql_result.strip('`').splitlines()
+        seen.extend(line[2:] for line in lines if line.startswith('- '))
+    assert seen == expected[3:]
+
+
+def test_pages_expire_when_data_changes(db_path):
+    chain = _chain(SQLDatabase.from_uri(f'sqlite:///{db_path}'), max_rows_per_chat=0)
+    chain.run_sql(QUERY, chat='alice')
+    conn = sqlite3.connect(db_path)
+    conn.execute("INSERT INTO Cursos (id_curso, nome_curso) VALUES ('A000', 'Curso Novo')")
+    conn.commit()
+    conn.close()
+    result = chain.page(chat='alice')
+    assert result.sql_error and RESULTS_EXPIRED in result.sql_result
+    assert chain.page(chat='alice') is None
+
+
+@pytest.mark.parametrize('max_rows', [200, 0])
+def test_cursors_are_shared_by_workers(db_path, tmp_path, max_rows):
+    path = str(tmp_path / 'cache.sqlite3')
+    workers = [
+        _chain(SQLDatabase.from_uri(f'sqlite:///{db_path}'), path=path, max_rows_per_chat=max_rows)
+        for _ in range(2)
+    ]
+    expected = [row[0] for row in workers[0].db._execute(QUERY)]
+    result = workers[0].run_sql(QUERY, chat='alice')
+    anonymous = workers[0].run_sql(QUERY)
+    assert workers[1].page(chat='bob') is None
+    assert workers[1].page() is None
+    seen = []
+    turn = 1
+    while result.cursor_id is not None:
+        result = workers[turn].page(chat='alice', limit=4)
+        lines = result.sql_result.strip('`').splitlines()
+        seen.extend(line[2:] for line in lines if line.startswith('- '))
+        turn = 1 - turn
+    assert seen == expected[3:]
+    assert workers[1].page(cursor_id=anonymous.cursor_id) is not None
+
+
+def test_clear_keeps_the_current_snapshot(tmp_path):
+    for store in (ResultCursorStore(), ResultCursorStore(str(tmp_path / 'cursors.sqlite3'))):
+        old = store.create('SELECT 1', 3, [(1,)], 'alice', token='old')
+        new = store.create('SELECT 2', 3, [(2,)], 'bob', token='new')
+        store.clear('new')
+        assert store.get(old) is None
+        assert store.get(new).rows == [(2,)]
+        store.clear()
+        assert store.get(new) is None
+
+
+@pytest.mark.parametrize('limit', [-2, 0, 1000])
+def test_page_limit_is_capped(db_path, limit):
+    chain = _chain(SQLDatabase.from_uri(f'sqlite:///{db_path}'))
+    total = len(chain.db._execute(QUERY))
+    chain.run_sql(QUERY, chat='alice')
+    result = chain.page(chat='alice', limit=limit)
+    lines = result.sql_result.strip('`').splitlines()
+    assert len([line for line in lines if line.startswith('- ')]) == 3
+    assert f'Other {total - 6} rows were omitted.' in result.sql_result
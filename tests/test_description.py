@@ -0,0 +1,45 @@
+import sqlite3
+
+from jbot.sql.db import SQLDatabase
+
+
+def test_description_fingerprinted_only_after_changes(db_path, monkeypatch):
+    db = SQLDatabase.from_uri(f'sqlite:///{db_path}')
+    fingerprints = []
+    fingerprint = db.schema_fingerprint
+    monkeypatch.setattr(db, 'schema_fingerprint', lambda: fingerprints.append(1) or fingerprint())
+
+    description = db.get_database_description()
+    assert db.get_database_description() == description
+    assert len(fingerprints) == 1
+
+    conn = sqlite3.connect(db_path)
+    conn.execute("INSERT INTO Cursos (id_curso, nome_curso) VALUES ('X999', 'Curso Novo')")
+    conn.commit()
+    conn.close()
+
+    db.get_database_description()
+    assert len(fingerprints) == 2
+
+
+def test_description_refreshed_when_values_change(db_path):
+    db = SQLDatabase.from_uri(f'sqlite:///{db_path}')
+    conn = sqlite3.connect(db_path)
+    old = conn.execute('SELECT nome_curso FROM Cursos ORDER BY rowid LIMIT 1').fetchone()[0]
+    assert old in db.get_database_description()
+
+    # same row counts, different values
+    conn.execute("UPDATE Cursos SET nome_curso = 'Curso Renomeado'")
+    conn.commit()
+    conn.close()
+
+    description = db.get_database_description()
+    assert old not in description
+    assert 'Curso Renomeado' in description
+
+
+def test_hand_written_comments_win(db_path):
+    db = SQLDatabase.from_uri(f'sqlite:///{db_path}')
+    description = db.get_database_description(comments={'Cursos': {'id_curso': 'valores como G010'}})
+    assert 'id_curso TEXT PK, -- valores como G010' in description
+    assert 'valores como G010' not in db.get_database_description()
@@ -0,0 +1,68 @@
+import json
+
+from jbot.sql import prompt_gpt4 as prompt
+from jbot.sql.examples import ExampleStore
+from jbot.sql.tokens import count_tokens
+
+EXAMPLES = [
+    ('quantas vagas restam em GCC125?', "SELECT vagas_restantes FROM OfertasDisciplina WHERE id_disc = 'GCC125'"),
+    ('quem dá aula de redes de computadores?', "SELECT nome_prof FROM Professores"),
+    ('qual o horário de cálculo I?', "SELECT * FROM AulasOferta"),
+]
+
+
+def _store(**kwargs):
+    store = ExampleStore(**kwargs)
+    for question, sql in EXAMPLES:
+        store.add(question, sql, '- 1', 'Uma resposta.')
+    return store
+
+
+def _tokens(example):
+    return count_tokens(prompt.format_example(example.dict()))
+
+
+def test_select_ranks_by_similarity_most_similar_last():
+    selected = _store().select('ainda tem vagas em GCC125?', k=2, token_budget=10000)
+    pinned = [e for e in selected if e.pinned]
+    assert [e.question for e in pinned] == ['qual é o professor favorito?']
+    # pinned examples come after the ranked ones
+    assert selected[-len(pinned):] == pinned
+    ranked = selected[:-len(pinned)]
+    assert len(ranked) == 2
+    assert ranked[-1].question == 'quantas vagas restam em GCC125?'
+
+
+def test_select_keeps_to_the_token_budget():
+    store = _store()
+    everything = store.select('quantas vagas restam em GCC125?', k=3, token_budget=10000)
+    pinned = [e for e in everything if e.pinned]
+    best = everything[-len(pinned) - 1]
+    budget = sum(_tokens(e) for e in pinned) + _tokens(best)
+    selected = store.select('quantas vagas restam em GCC125?', k=3, token_budget=budget)
+    assert selected == [best] + pinned
+    # pinned examples are always in
+    assert store.select('quantas vagas restam em GCC125?', k=3, token_budget=0) == pinned
+
+
+def test_production_examples_are_not_persisted_by_default(tmp_path):
+    path = tmp_path / 'examples.jsonl'
+    _store(path=str(path))
+    assert not path.exists()
+    _store(path=str(path), persist=True)
+    assert len(path.read_text().splitlines()) == len(EXAMPLES)
+    assert len(ExampleStore(str(path))) == len(prompt.SEED_EXAMPLES) + len(EXAMPLES)
+
+
+def test_persisted_examples_are_compacted(tmp_path):
+    path = tmp_path / 'examples.jsonl'
+    hand_written = {'question': 'quantos cursos existem?', 'sql_query': 'SELECT count(*) FROM Cursos',
+                    'answer': 'Há 9 cursos.'}
+    path.write_text(json.dumps(hand_written) + '\n')
+    store = ExampleStore(str(path), max_examples=3, persist=True)
+    for i in range(10):
+        store.add(f'pergunta número {i}', 'SELECT 1', '- 1', 'Um.')
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+    assert len(lines) < 6
+    assert lines[0]['question'] == hand_written['question']
+    assert lines[-1]['question'] == 'pergunta número 9'
@@ -0,0 +1,120 @@
+import threading
+import time
+
+import pytest
+from langchain.schema import HumanMessage
+
+from jbot import llm as jllm
+from jbot.fake_openai import FakeOpenAIServer, LatencyProfile
+from jbot.llm import HedgedChatOpenAI, LLMRequestError
+
+
+class ScriptedLatency(LatencyProfile):
+    """Latencies of the next requests, in order; then no latency."""
+
+    def __init__(self, *delays):
+        super().__init__()
+        self.delays = list(delays)
+
+    def sample(self, rng, completion_tokens=0):
+        return self.delays.pop(0) if self.delays else 0.0
+
+
+class FailingServer(FakeOpenAIServer):
+    """Answers 500 to the first `failures` requests."""
+
+    def __init__(self, failures, **kwargs):
+        super().__init__(error_rate=0.5, **kwargs)
+        self.failures = failures
+
+    def _draw(self):
+        with self._lock:
+            self.failures -= 1
+            return (0.0 if self.failures >= 0 else 1.0), 1.0
+
+
+@pytest.fixture
+def posts(monkeypatch):
+    """Start time, end time and outcome of every request the model sends."""
+    records = []
+    lock = threading.Lock()
+    post = HedgedChatOpenAI._post
+
+    def recorded(self, body, deadline, inflight):
+        start = time.monotonic()
+        outcome = 'ok'
+        try:
+            return post(self, body, deadline, inflight)
+        except jllm._Cancelled:
+            outcome = 'cancelled'
+            raise
+        except LLMRequestError:
+            outcome = 'error'
+            raise
+        finally:
+            with lock:
+                records.append((start, time.monotonic(), outcome))
+
+    monkeypatch.setattr(HedgedChatOpenAI, '_post', recorded)
+    return records
+
+
+def _ask(model):
+    return model([HumanMessage(content='quais cursos existem?')]).content
+
+
+def test_hedge_fires_after_percentile_and_cancels_loser(posts):
+    with FakeOpenAIServer(latency=ScriptedLatency(2.0, 0.0)) as server:
+        model = HedgedChatOpenAI(openai_api_base=server.url, hedge_percentile=0.9)
+        for _ in range(model.hedge_min_samples):
+            model.latency.add(0.2)
+
+        start = time.monotonic()
+        assert _ask(model).startswith('StepByStep:')
+        assert time.monotonic() - start < 1.0
+        assert server.stats['requests'] == 2
+
+        time.sleep(0.1)
+        (first, first_end, first_outcome), (second, _, second_outcome) = sorted(posts)
+        # the duplicate went out once the tail request passed the tracked p90
+        assert 0.2 <= second - first < 1.0
+        assert second_outcome == 'ok'
+        # and the slow one stopped waiting when the duplicate won
+        assert first_outcome == 'cancelled'
+        assert first_end - first < 1.0
+
+
+def test_no_hedge_without_enough_samples(posts):
+    with FakeOpenAIServer(latency=ScriptedLatency(0.3)) as server:
+        model = HedgedChatOpenAI(openai_api_base=server.url)
+        for _ in range(model.hedge_min_samples - 1):
+            model.latency.add(0.01)
+        _ask(model)
+        assert server.stats['requests'] == 1
+        assert [outcome for _, _, outcome in posts] == ['ok']
+
+
+def test_retries_server_errors(posts):
+    with FailingServer(2) as server:
+        model = HedgedChatOpenAI(openai_api_base=server.url, hedge=False, backoff_base=0.01)
+        assert _ask(model).startswith('StepByStep:')
+        assert server.stats['errors'] == 2
+        assert [outcome for _, _, outcome in sorted(posts)] == ['error', 'error', 'ok']
+
+
+def test_gives_up_after_max_retries():
+    with FailingServer(10) as server:
+        model = HedgedChatOpenAI(openai_api_base=server.url, hedge=False, backoff_base=0.01, max_retries=2)
+        with pytest.raises(LLMRequestError) as excinfo:
+            _ask(model)
+        assert excinfo.value.status == 500
+        assert server.stats['requests'] == 3
+
+
+def test_connections_are_reused():
+    with FakeOpenAIServer() as server:
+        model = HedgedChatOpenAI(openai_api_base=server.url, hedge=False)
+        for _ in range(5):
+            _ask(model)
+        assert server.stats['requests'] == 5
+        assert jllm.get_pool(server.url).opened == 1
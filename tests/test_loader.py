@@ -0,0 +1,107 @@
+import json
+import sqlite3
+
+import pytest
+
+from jbot.sql import loader
+
+
+@pytest.fixture
+def exports(tmp_path):
+    """A tiny semester export: CSV and JSON lines files."""
+    directory = tmp_path / 'exports'
+    directory.mkdir()
+    (directory / 'Cursos.csv').write_text(
+        'id_curso,nome_curso\n'
+        'G014,Ciência da Computação\n'
+        'G010,Sistemas de Informação\n',
+        encoding='utf-8',
+    )
+    (directory / 'Disciplinas.jsonl').write_text(
+        '\n'.join(json.dumps(r, ensure_ascii=False) for r in [
+            {'id_disc': 'GCC125', 'nome_disc': 'Redes de Computadores'},
+            {'id_disc': 'GCC130', 'nome_disc': 'Compiladores'},
+            {'id_disc': 'GMM114', 'nome_disc': 'Cálculo II'},
+        ]) + '\n',
+        encoding='utf-8',
+    )
+    (directory / 'OfertasDisciplina.csv').write_text(
+        'id_oferta,id_disc,id_curso,id_prof,turma,vagas_restantes,vagas_ocupadas\n'
+        '1,GCC125,G014,7,10A,5,35\n'
+        '2,GCC125,G010,,14A,0,40\n'
+        '3,GCC130,G014,NULL,10A,12,28\n',
+        encoding='utf-8',
+    )
+    return directory
+
+
+def _count(db, table):
+    conn = sqlite3.connect(db)
+    try:
+        return conn.execute(f'SELECT count(*) FROM {table}').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_load_cli(exports, tmp_path, capsys):
+    db = str(tmp_path / 'db.sqlite3')
+    assert loader.main(['--db', db, 'load', str(exports)]) == 0
+    out = capsys.readouterr().out
+    assert 'Cursos: 2 rows' in out and 'Disciplinas: 3 rows' in out and 'OfertasDisciplina: 3 rows' in out
+
+    assert (_count(db, 'Cursos'), _count(db, 'Disciplinas'), _count(db, 'OfertasDisciplina')) == (2, 3, 3)
+    # every table exists, the ones without an export stay empty
+    assert _count(db, 'AulasOferta') == 0
+    conn = sqlite3.connect(db)
+    assert conn.execute('SELECT id_prof FROM OfertasDisciplina ORDER BY id_oferta').fetchall() == [
+        (7,), (None,), (None,)
+    ]
+    indexes = {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert loader._index_name('OfertasDisciplina', 'id_disc') in indexes
+    conn.close()
+
+    # loading again replaces the rows
+    assert loader.main(['--db', db, 'load', str(exports), '--tables', 'Cursos']) == 0
+    assert (_count(db, 'Cursos'), _count(db, 'OfertasDisciplina')) == (2, 3)
+
+
+@pytest.mark.parametrize('synchronous', [0, 1, 2])
+def test_load_restores_synchronous(exports, tmp_path, synchronous):
+    conn = loader.connect(str(tmp_path / 'db.sqlite3'))
+    conn.execute(f'PRAGMA synchronous = {synchronous}')
+    counts = loader.load(conn, {'Cursos': loader.read_records(str(exports / 'Cursos.csv'))})
+    assert counts == {'Cursos': 2}
+    assert conn.execute('PRAGMA synchronous').fetchone()[0] == synchronous
+    conn.close()
+
+
+def test_failed_load_rolls_back(exports, tmp_path):
+    conn = loader.connect(str(tmp_path / 'db.sqlite3'))
+    loader.load(conn, {'Cursos': loader.read_records(str(exports / 'Cursos.csv'))})
+    bad = [{'id_oferta': 'x', 'id_disc': 'GCC125', 'id_curso': 'G014', 'turma': '10A',
+            'vagas_restantes': 1, 'vagas_ocupadas': 1}]
+    with pytest.raises(ValueError):
+        loader.load(conn, {'Cursos': [], 'OfertasDisciplina': bad})
+    assert conn.execute('SELECT count(*) FROM Cursos').fetchone()[0] == 2
+    assert conn.execute('PRAGMA synchronous').fetchone()[0] == 1
+    conn.close()
+
+
+def test_vacancy_updates_touch_changed_rows(exports, tmp_path, capsys):
+    db = str(tmp_path / 'db.sqlite3')
+    loader.main(['--db', db, 'load', str(exports)])
+    vagas = tmp_path / 'vagas.csv'
+    vagas.write_text(
+        'id_oferta,vagas_restantes,vagas_ocupadas\n'
+        '1,5,35\n'   # unchanged
+        '2,3,37\n'
+        '3,,27\n',   # only the occupied count
+        encoding='utf-8',
+    )
+    assert loader.main(['--db', db, 'vagas', str(vagas)]) == 0
+    assert 'OfertasDisciplina: 2 rows changed' in capsys.readouterr().out
+    conn = sqlite3.connect(db)
+    assert conn.execute(
+        'SELECT vagas_restantes, vagas_ocupadas FROM OfertasDisciplina ORDER BY id_oferta'
+    ).fetchall() == [(5, 35), (3, 37), (12, 27)]
+    conn.close()
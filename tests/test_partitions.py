@@ -0,0 +1,30 @@
+import shutil
+
+from jbot.sql.db import SQLDatabase
+from jbot.sql.partitions import SemesterPartitions
+
+TABLES = ['Cursos', 'Disciplinas', 'DisciplinasMatriz', 'Professores', 'OfertasDisciplina', 'AulasOferta']
+
+
+def _db(db_path, tmp_path):
+    archive = tmp_path / 'archive'
+    archive.mkdir()
+    shutil.copy(db_path, archive / '2023-1.sqlite3')
+    partitions = SemesterPartitions(str(archive), current_semester='2024-1', tables=TABLES)
+    return SQLDatabase.from_uri(f'sqlite:///{db_path}', partitions=partitions), partitions
+
+
+def test_prune(db_path, tmp_path):
+    _, partitions = _db(db_path, tmp_path)
+    assert partitions.prune("SELECT * FROM Cursos") is None
+    assert partitions.prune("SELECT * FROM CursosHistorico WHERE semestre = '2023-1'") == ['2023-1']
+    assert partitions.prune("SELECT * FROM CursosHistorico WHERE semestre = '2019-2'") == []
+    assert partitions.prune("SELECT * FROM CursosHistorico") == ['2023-1', '2024-1']
+
+
+def test_no_matching_semester_is_empty(db_path, tmp_path):
+    db, _ = _db(db_path, tmp_path)
+    count = "SELECT count(*) FROM CursosHistorico WHERE semestre = '{}'"
+    assert db._execute(count.format('2023-1'))[0][0] > 0
+    assert db._execute(count.format('2019-2'))[0][0] == 0
+    assert db._execute("SELECT * FROM OfertasDisciplinaHistorico WHERE semestre > '2030-1'") == []
@@ -0,0 +1,52 @@
+import sqlite3
+
+import pytest
+
+from jbot.sql.db import SQLDatabase
+from jbot.sql.profile import ColumnProfiler
+
+
+def test_updates_keeping_row_counts_reprofile(db_path):
+    db = SQLDatabase.from_uri(f'sqlite:///{db_path}')
+    profiler = ColumnProfiler(db)
+    assert 'OfertasDisciplina' in profiler.refresh()
+    assert profiler.refresh() == []
+
+    conn = sqlite3.connect(db_path)
+    conn.execute("UPDATE OfertasDisciplina SET vagas_restantes = 12345")
+    conn.commit()
+    conn.close()
+
+    assert 'OfertasDisciplina' in profiler.refresh()
+    columns = {c['name']: c for c in profiler.get_profile('OfertasDisciplina')['columns']}
+    assert columns['vagas_restantes']['max'] == '12345'
+    assert columns['vagas_restantes']['distinct_count'] == 1
+
+
+def test_description_from_catalog(db_path, tmp_path, monkeypatch):
+    db = SQLDatabase.from_uri(f'sqlite:///{db_path}', profile_catalog=str(tmp_path / 'catalog.sqlite3'))
+    monkeypatch.setattr(db, '_sample_distinct_rows', lambda *args: pytest.fail('rows were sampled'))
+    ddl = db.get_database_description('ddl')
+    assert 'nome_curso' in ddl and 'ex: ' in ddl
+    assert 'ex: ' in db.get_database_description('tsv')
+
+
+def test_only_changed_tables_reprofile(db_path, tmp_path, monkeypatch):
+    db = SQLDatabase.from_uri(f'sqlite:///{db_path}')
+    catalog = str(tmp_path / 'catalog.sqlite3')
+    profiler = ColumnProfiler(db, catalog)
+    assert len(profiler.refresh()) > 1
+    profiler.close()
+
+    conn = sqlite3.connect(db_path)
+    conn.execute("UPDATE Cursos SET nome_curso = 'Curso Renomeado' WHERE rowid = 1")
+    conn.commit()
+    conn.close()
+
+    # the catalog outlives restarts, only the changed table is profiled again
+    profiler = ColumnProfiler(db, catalog)
+    assert profiler.refresh() == ['Cursos']
+    assert profiler.refresh() == []
+    assert profiler.refresh(force=True) == [
+        tbl.name for tbl in db._metadata.sorted_tables if tbl.name in db._usable_tables
+    ]
@@ -0,0 +1,83 @@
+import pytest
+
+from jbot.sql.render import _candidates, _cells, render_rows
+from jbot.sql.tokens import count_tokens
+
+COLUMNS = ['nome_curso', 'nome_disc', 'turma', 'vagas']
+ROWS = [
+    (curso, disc, turma, vagas)
+    for curso in ('Ciência da Computação', 'Sistemas de Informação')
+    for disc in ('Redes de Computadores', 'Algoritmos e Estruturas de Dados', 'Compiladores')
+    for turma, vagas in (('10A', 5), ('14A', 0), ('22B', 12))
+]
+
+
+def _str(i, value):
+    return '' if value is None else str(value)
+
+
+def decode(text, columns):
+    """Rows of any encoding of `render_rows`, as lists of strings."""
+    lines = text.split('\n')
+    refs = {}
+    if lines[0].startswith('Columns: '):
+        assert lines.pop(0)[len('Columns: '):].split('\t') == list(columns)
+        if lines and lines[0].startswith('Values: '):
+            for item in lines.pop(0)[len('Values: '):].split('; '):
+                ref, value = item.split('=', 1)
+                refs[ref] = value
+    rows = []
+    key = None
+    for line in lines:
+        if line.startswith('  - '):
+            values = key + line[4:].split('\t')
+        else:
+            assert line.startswith('- ')
+            values = line[2:].split('\t')
+            if line.endswith(':') and len(values) < len(columns):
+                key = line[2:-1].split('\t')
+                continue
+        rows.append([refs.get(v, v) for v in values])
+    return rows
+
+
+def test_every_encoding_round_trips():
+    cells = _cells(ROWS, _str)
+    candidates = dict(_candidates(COLUMNS, cells))
+    assert {'rows', 'grouped(1)', 'grouped(2)', 'dictionary', 'dictionary+grouped(2)'} <= set(candidates)
+    for name, text in candidates.items():
+        assert decode(text, COLUMNS) == cells, name
+
+
+def test_picks_the_smallest_encoding():
+    result = render_rows(COLUMNS, ROWS, _str)
+    assert result.rows == len(ROWS)
+    assert decode(result.text, COLUMNS) == _cells(ROWS, _str)
+    sizes = {name: count_tokens(text) for name, text in _candidates(COLUMNS, _cells(ROWS, _str))}
+    assert result.tokens == min(sizes.values()) < result.baseline_tokens == sizes['rows']
+    assert result.encoding != 'rows'
+
+
+def test_single_row_is_plain():
+    result = render_rows(COLUMNS, ROWS[:1], _str)
+    assert (result.encoding, result.text) == ('rows', '- Ciência da Computação\tRedes de Computadores\t10A\t5')
+
+
+@pytest.mark.parametrize('token_budget', [30, 60, 100, 150])
+def test_token_budget_keeps_the_longest_prefix_that_fits(token_budget):
+    result = render_rows(COLUMNS, ROWS, _str, token_budget=token_budget)
+    assert 1 <= result.rows < len(ROWS)
+    assert result.tokens <= token_budget
+    assert decode(result.text, COLUMNS) == _cells(ROWS[:result.rows], _str)
+    # one more row no longer fits
+    assert render_rows(COLUMNS, ROWS[:result.rows + 1], _str).tokens > token_budget
+
+
+def test_token_budget_keeps_one_row():
+    result = render_rows(COLUMNS, ROWS, _str, token_budget=1)
+    assert result.rows == 1
+    assert decode(result.text, COLUMNS) == _cells(ROWS[:1], _str)
+
+
+def test_budget_not_needed():
+    assert render_rows(COLUMNS, ROWS, _str, token_budget=10_000) == render_rows(COLUMNS, ROWS, _str)
@@ -0,0 +1,30 @@
+import sqlite3
+
+from jbot.sql.db import SQLDatabase
+
+
+def test_hot_swap_invalidates_caches(db_path):
+    db = SQLDatabase.from_sqlite_replica(db_path, watch_interval=0)
+    invalidated = []
+    db.on_invalidate(lambda: invalidated.append(True))
+    version, token = db.snapshot_version, db.cache_token()
+    count = "SELECT count(*) FROM Cursos"
+    before = db._execute(count)[0][0]
+    info = db.get_table_info(['Cursos'])
+
+    assert not db._replica.refresh()
+
+    conn = sqlite3.connect(db_path)
+    conn.execute("INSERT INTO Cursos (id_curso, nome_curso) VALUES ('X999', 'Curso Novo')")
+    conn.commit()
+    conn.close()
+
+    # the replica keeps serving its snapshot until it swaps
+    assert db._execute(count)[0][0] == before
+    assert db._replica.refresh()
+    assert invalidated == [True]
+    assert db.snapshot_version > version
+    assert db.cache_token() != token
+    assert db._execute(count)[0][0] == before + 1
+    assert db.get_table_info(['Cursos']) == info
+    assert not db._replica.refresh()
@@ -0,0 +1,107 @@
+import json
+import time
+
+import pytest
+
+from jbot import deadline as request_deadline
+from jbot.router import (CoursesTool, MenuTool, NewsTool, NgramClassifier, Router, Tool, ToolResult,
+                         ToolTimeout)
+
+
+def _router(**kwargs):
+    tools = [CoursesTool(chain=None), MenuTool('cardapio.txt'), NewsTool('https://example.com/rss')]
+    return Router(tools, **kwargs)
+
+
+@pytest.mark.parametrize('question, tool', [
+    ('Quais disciplinas o professor João ministra?', 'cursos'),
+    ('ainda tem vaga em GCC125?', 'cursos'),
+    ('o que tem no RU hoje?', 'cardapio'),
+    ('qual o cardápio do jantar', 'cardapio'),
+    ('saiu algum edital novo?', 'noticias'),
+    ('quais avisos da reitoria saíram hoje?', 'noticias'),
+])
+def test_keyword_rules(question, tool):
+    route = _router().route(question)
+    assert (route.tool, route.method) == (tool, 'rules')
+
+
+def test_classifier_breaks_ties_and_guesses():
+    router = _router()
+    # keywords of both cursos and cardapio: the classifier picks among them
+    route = router.route('tem aula depois do almoco no ru')
+    assert route.tool == 'cardapio' and route.method == 'classifier'
+    route = router.route('o que vai ter de comer hoje')
+    assert route.tool == 'cardapio' and route.method == 'classifier'
+
+
+def test_ngram_classifier():
+    classifier = NgramClassifier()
+    for text in ('quais as ultimas noticias', 'noticias da semana'):
+        classifier.add(text, 'noticias')
+    for text in ('cardapio do almoco', 'o que tem no almoco'):
+        classifier.add(text, 'cardapio')
+    assert len(classifier) == 4
+    scores = classifier.scores('tem noticias novas?')
+    assert scores[0][0] == 'noticias'
+    assert scores[0][1] > scores[1][1]
+    assert classifier.scores('almoco de hoje')[0][0] == 'cardapio'
+
+
+def test_log_is_rotated_and_learned_from(tmp_path):
+    path = str(tmp_path / 'router.jsonl')
+    router = _router(log_path=path, log_max_bytes=400)
+    for _ in range(5):
+        router.route('o que tem no RU hoje?')
+    lines = open(path).readlines()
+    rotated = open(path + '.1').readlines()
+    assert len(rotated) == 4 and len(lines) == 1
+    lines += rotated
+    assert {json.loads(line)['tool'] for line in lines} == {'cardapio'}
+
+    before = len(_router().classifier)
+    assert len(_router(log_path=path).classifier) == before + 5
+
+
+class SlowTool(Tool):
+    name = 'slow'
+    cache_ttl = 60.0
+
+    def __init__(self, seconds, **kwargs):
+        super().__init__(**kwargs)
+        self.seconds = seconds
+        self.runs = 0
+
+    def run(self, question, context, chat):
+        self.runs += 1
+        d = request_deadline.current()
+        end = time.monotonic() + self.seconds
+        while time.monotonic() < end:
+            if d is not None:
+                d.check()
+            time.sleep(0.01)
+        return ToolResult(response=f'{question}!')
+
+
+def test_tool_call_caches_by_normalized_question():
+    tool = SlowTool(0)
+    assert tool.call('Olá?').response == 'Olá?!'
+    assert tool.call('ola').response == 'Olá?!'
+    assert tool.runs == 1
+    assert tool.call('ola', context='antes').tool == 'slow'
+    assert tool.runs == 2
+
+
+def test_tool_call_times_out():
+    tool = SlowTool(5, timeout=0.1)
+    with pytest.raises(ToolTimeout):
+        tool.call('demora')
+
+
+def test_tool_call_stops_at_the_deadline():
+    tool = SlowTool(5)
+    start = time.monotonic()
+    with request_deadline.deadline(0.05):
+        with pytest.raises(request_deadline.DeadlineExceeded):
+            tool.call('demora')
+    assert time.monotonic() - start < 1
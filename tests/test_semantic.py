@@ -0,0 +1,133 @@
+import numpy as np
+import pytest
+
+from jbot.sql.semantic import SemanticCache, content_words, guard
+
+TEACHER_SQL = (
+    "SELECT nome_prof FROM Professores JOIN OfertasDisciplina USING (id_prof) "
+    "JOIN Disciplinas USING (id_disc) WHERE nome_disc LIKE '%Redes de Computadores%'"
+)
+NEURAL_SQL = (
+    "SELECT nome_prof FROM Professores JOIN OfertasDisciplina USING (id_prof) "
+    "JOIN Disciplinas USING (id_disc) WHERE nome_disc LIKE '%Redes Neurais%'"
+)
+VACANCIES_SQL = "SELECT sum(vagas_restantes) FROM OfertasDisciplina WHERE id_disc = 'GCC125'"
+SCHEDULE_SQL = (
+    "SELECT dia_semana, hora_inicio FROM AulasOferta JOIN Disciplinas USING (id_disc) "
+    "WHERE nome_disc LIKE '%Cálculo II%'"
+)
+SUBJECTS_SQL = (
+    "SELECT nome_disc FROM Disciplinas JOIN DisciplinasMatriz USING (id_disc) JOIN Cursos USING (id_curso) "
+    "WHERE nome_curso LIKE '%Ciência da Computação%'"
+)
+
+
+@pytest.fixture
+def cache():
+    cache = SemanticCache()
+    cache.add_many([
+        ('quem ensina redes de computadores?', TEACHER_SQL),
+        ('quantas vagas tem em GCC125?', VACANCIES_SQL),
+        ('qual o horario das aulas de calculo 2?', SCHEDULE_SQL),
+        ('quais disciplinas do curso de ciencia da computacao?', SUBJECTS_SQL),
+    ])
+    return cache
+
+
+def test_content_words_fold_synonyms():
+    assert content_words('Quem leciona Redes?') == content_words('qual professor ensina redes')
+    assert content_words('quantas matérias') == ['quantos', 'disciplina']
+
+
+@pytest.mark.parametrize('question, cached', [
+    ('qual professor leciona redes de computadores?', 'quem ensina redes de computadores?'),
+    ('quem é o docente de Redes de Computadores', 'quem ensina redes de computadores?'),
+    ('qual o número de vagas de GCC125?', 'quantas vagas tem em GCC125?'),
+    ('quantas vagas ainda tem em gcc125', 'quantas vagas tem em GCC125?'),
+    ('que dia tem aula de cálculo 2', 'qual o horario das aulas de calculo 2?'),
+    ('quais matérias do curso de ciência da computação', 'quais disciplinas do curso de ciencia da computacao?'),
+])
+def test_paraphrases_match(cache, question, cached):
+    hit = cache.lookup(question)
+    assert hit is not None and hit.question == cached
+    assert hit.score >= cache.threshold
+
+
+@pytest.mark.parametrize('question, reason', [
+    ('quem ensina redes neurais?', '"neurais" is not in the query'),
+    ('quantas vagas tem em GCC130?', 'numbers differ'),
+    ('qual o horario das aulas de calculo 3?', 'numbers differ'),
+    ('onde sao as aulas de redes de computadores?', 'asks something else'),
+])
+def test_near_misses_rejected(cache, question, reason):
+    assert cache.lookup(question) is None
+    hit = cache.search(question, 1)[0]
+    assert guard(question, hit.question, hit.sql_query) == reason
+
+
+def test_redes_is_not_redes_neurais():
+    assert guard('quem ensina redes neurais?', 'quem ensina redes?', TEACHER_SQL) is not None
+    assert guard('quem ensina redes?', 'quem ensina redes neurais?', NEURAL_SQL) is not None
+    # plural and singular name the same thing
+    assert guard('quem ensina redes de computador?', 'quem ensina redes de computadores?', TEACHER_SQL) is None
+
+
+def test_literals_must_stay_grounded():
+    sql = "SELECT nome_prof FROM Professores WHERE nome_prof LIKE '%Hermes%'"
+    assert guard('qual o nome completo do hermes?', 'nome completo do hermes', sql) is None
+    assert guard('qual o nome completo da ana?', 'nome completo do hermes', sql) is not None
+
+
+def test_idf_weighs_rare_words_more():
+    cache = SemanticCache()
+    cache.add_many((f'quem ensina {name}?', f"SELECT '{name}'") for name in (
+        'algoritmos', 'compiladores', 'bancos de dados', 'sistemas operacionais',
+    ))
+    # "quem ensina" is in every question, the discipline decides
+    hits = cache.search('professor de compiladores', 2)
+    assert hits[0].question == 'quem ensina compiladores?'
+    assert hits[0].score > 2 * hits[1].score
+
+
+def test_vectors_are_sublinear():
+    cache = SemanticCache()
+    once, twice = cache.vector('redes'), cache.vector('redes redes')
+    assert np.allclose(twice[once > 0], np.log1p(2.0))
+
+
+def test_lru_eviction():
+    cache = SemanticCache(max_entries=2)
+    cache.add('quem ensina algoritmos?', "SELECT 'algoritmos'")
+    cache.add('quem ensina compiladores?', "SELECT 'compiladores'")
+    # a hit makes algoritmos the most recently used
+    assert cache.lookup('qual professor ensina algoritmos') is not None
+    cache.add('quem ensina geometria?', "SELECT 'geometria'")
+
+    assert len(cache) == 2
+    assert cache.lookup('quem ensina compiladores?') is None
+    assert cache.lookup('quem ensina algoritmos?') is not None
+    assert cache.lookup('quem ensina geometria?') is not None
+    assert len(cache._matrix) == 16
+
+
+def test_slots_reused_after_remove(cache):
+    slots = {slot for slot, _, _ in cache._entries.values()}
+    df = cache._df.copy()
+    cache.remove('Quem ensina Redes de Computadores?')
+    assert len(cache) == 3
+    assert cache.lookup('quem ensina redes de computadores?') is None
+    assert cache.search('quem ensina redes de computadores', 1)[0].score < cache.threshold
+
+    cache.add('quem ensina redes neurais?', NEURAL_SQL)
+    assert {slot for slot, _, _ in cache._entries.values()} == slots
+    assert cache.lookup('qual professor leciona redes neurais') is not None
+
+    cache.remove('quem ensina redes neurais?')
+    cache.add('quem ensina redes de computadores?', TEACHER_SQL)
+    assert np.array_equal(cache._df, df)
+
+
+def test_readding_replaces_the_query(cache):
+    cache.add('quem ensina redes de computadores?', TEACHER_SQL + ' LIMIT 1')
+    assert len(cache) == 4
+    assert cache.lookup('quem ensina redes de computadores').sql_query.endswith('LIMIT 1')
@@ -0,0 +1,58 @@
+import pytest
+
+from jbot.watch import Offering, WatchStore, parse_command
+
+
+@pytest.mark.parametrize('message, command', [
+    ('me avise de vagas em GCC125', ('watch', 'GCC125', None)),
+    ('Me avisa quando abrir vaga na turma 14A de gcc 125?', ('watch', 'GCC125', '14A')),
+    ('quais avisos de vagas eu tenho?', ('list', None, None)),
+    ('meus avisos', ('list', None, None)),
+    ('quais são os meus avisos?', ('list', None, None)),
+    ('pare de me avisar sobre GCC125', ('cancel', 'GCC125', None)),
+    ('cancela o aviso de vagas de GCC125 turma 14A', ('cancel', 'GCC125', '14A')),
+    ('desativar meus avisos', ('cancel', None, None)),
+])
+def test_watch_commands(message, command):
+    assert parse_command(message) == command
+
+
+@pytest.mark.parametrize('message', [
+    'quais avisos da reitoria saíram hoje?',
+    'ver avisos do DCC',
+    'mostre os avisos da semana',
+    'avisos',
+    'a reitoria cancelou o aviso da prova?',
+    'quantas vagas tem em GCC125?',
+])
+def test_news_questions_are_not_commands(message):
+    assert parse_command(message) is None
+
+
+def _offering(id_oferta, turma, restantes, ocupadas=10):
+    return Offering(id_oferta=id_oferta, id_disc='GCC125', turma=turma,
+                    vagas_restantes=restantes, vagas_ocupadas=ocupadas)
+
+
+def test_apply_notifies_changed_offerings_once(tmp_path):
+    store = WatchStore(str(tmp_path / 'watches.sqlite3'))
+    store.add('alice', 'GCC125')
+    store.add('bob', 'GCC125', '14B')
+    store.baseline([_offering(1, '14A', 5), _offering(2, '14B', 0)])
+
+    # unchanged data queues nothing
+    assert store.apply(['GCC125'], [_offering(1, '14A', 5), _offering(2, '14B', 0)], 'v1') == 0
+    # 14A lost a vacancy, 14B is gone and 14C is new
+    offerings = [_offering(1, '14A', 4, 11), _offering(3, '14C', 30, 0)]
+    assert store.apply(['GCC125'], offerings, 'v2') == 4
+    by_chat = {}
+    for n in store.pending():
+        by_chat.setdefault(n.chat, []).append(n.text)
+    assert len(by_chat['alice']) == 3
+    assert any('antes eram 5' in text for text in by_chat['alice'])
+    assert by_chat['bob'] == ['A turma 14B de GCC125 não está mais ofertada.']
+
+    # applying the same data again, as another worker would, queues nothing
+    assert store.apply(['GCC125'], offerings, 'v2') == 0
+    store.ack(n.id for n in store.pending())
+    assert store.pending() == []